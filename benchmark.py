@@ -0,0 +1,704 @@
+"""libvirt・paramiko・tcpdumpを模擬したバックエンドで挙動収集のスループットを計測する
+
+実際のKVMゲストやハニーポットを用意せずに、逐次・スタンバイ・並列・パイプラインの各モードを比較できる。
+各モードは環境変数で設定を切り替えた別プロセスで実行し、settingsやメトリクスの状態が混ざらないようにする。
+
+    python benchmark.py                   # すべてのモードを比較
+    python benchmark.py --mode pipeline   # 1つのモードのみ実行し、結果をJSONで出力
+
+模擬するレイテンシは「模擬上の秒」で指定し、--time-scale倍して実際に待機する。
+結果もすべて模擬上の秒に換算して出力するため、ハッシュ計算やファイル形式の判定のような
+CPUで処理する段階は、実際の所要時間の1/time-scale倍として表示される点に注意する。
+"""
+import argparse
+import hashlib
+import json
+import os
+import queue
+import random
+import resource
+import shlex
+import shutil
+import socket
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import xml.etree.ElementTree as ET
+from collections import defaultdict
+from itertools import count
+
+# 比較するモードと、それぞれに設定する環境変数
+MODES = {
+    "serial": {},
+    "standby": {"USE_STANDBY_VM": "1"},
+    "parallel": {"WINDOWS_WORKER_NUM": "{workers}", "LINUX_WORKER_NUM": "{workers}"},
+    "parallel-overlay": {"WINDOWS_WORKER_NUM": "{workers}", "LINUX_WORKER_NUM": "{workers}", "USE_OVERLAY_VM": "1"},
+    "pipeline": {"USE_PIPELINE": "1", "USE_STANDBY_VM": "1"},
+    "pipeline-overlay": {"USE_PIPELINE": "1", "WINDOWS_WORKER_NUM": "{workers}", "LINUX_WORKER_NUM": "{workers}",
+                         "USE_OVERLAY_VM": "1"},
+}
+
+
+class Simulation:
+    """模擬するバックエンドのレイテンシと、ハニーポット上の検体"""
+
+    def __init__(self, args):
+        self.scale = args.time_scale
+        self.revert_time = args.revert_time
+        self.dhcp_delay = args.dhcp_delay
+        self.clone_time = args.clone_time
+        self.overlay_time = args.overlay_time
+        self.ssh_connect_time = args.ssh_connect_time
+        self.sftp_bandwidth = args.sftp_bandwidth
+        self.execution_time = args.execution_time
+        self.capture_start_time = args.capture_start_time
+        self.lock = threading.Lock()
+        # ハニーポット上のパスをキー、(内容, 更新時刻)を値とする
+        self.honeypot_files = {}
+        # VMに送信したファイルのパスと大きさ
+        self.uploaded = {}
+        self.domains = {}
+        self.domain_index = count()
+        # 模擬するドメインのディスクイメージを置くディレクトリ
+        self.image_dir = None
+        # dnsmasqのリースファイルの代わりに書き出すMACアドレスとIPアドレスの組と、そのパス
+        self.leases = {}
+        self.lease_path = None
+        # libvirtのイベントのコールバック
+        self.callbacks = []
+
+    def sleep(self, simulated_seconds):
+        time.sleep(simulated_seconds * self.scale)
+
+    def set_lease(self, mac, ip_addr):
+        """リースを追加・更新（ip_addrがNoneの場合は削除）し、リースファイルを書き出す
+
+        dnsmasqと同じく、リースを更新するたびに期限を延ばす。
+        """
+
+        with self.lock:
+            if ip_addr is None:
+                self.leases.pop(mac, None)
+            else:
+                self.leases[mac] = (ip_addr, time.time() + 3600)
+            entries = [{"ip-address": ip, "mac-address": mac, "expiry-time": expiry}
+                       for mac, (ip, expiry) in self.leases.items()]
+            with open(self.lease_path + ".new", "w") as f:
+                json.dump(entries, f)
+            os.replace(self.lease_path + ".new", self.lease_path)
+
+    def emit(self, event_id, dom, *args):
+        for registered_id, callback, opaque in list(self.callbacks):
+            if registered_id == event_id:
+                callback(None, dom, *args, opaque)
+
+    def generate_corpus(self, num, size, duplicate_ratio, discard_ratio, seed, hostnames):
+        """PE32・ELF・HTMLの検体を生成し、ハニーポットに順番に置く。一部は既出の検体と同じ内容にする"""
+
+        rng = random.Random(seed)
+        unique = []
+        for i in range(num):
+            if unique and rng.random() < duplicate_ratio:
+                content = rng.choice(unique)
+            elif rng.random() < discard_ratio:
+                content = b"<html><body>" + rng.randbytes(size)
+            else:
+                content = (_fake_pe32() if rng.random() < 0.5 else _fake_elf()) + rng.randbytes(size)
+                unique.append(content)
+            hostname = hostnames[i % len(hostnames)]
+            self.honeypot_files[f"/{hostname}/binaries/specimen{i:06d}"] = (content, 1000000000.0)
+
+
+def _fake_pe32():
+    header = bytearray(0x200)
+    header[0:2] = b"MZ"
+    struct.pack_into("<I", header, 0x3c, 0x80)
+    header[0x80:0x84] = b"PE\0\0"
+    struct.pack_into("<HHIIIHH", header, 0x84, 0x14c, 1, 0, 0, 0, 0xe0, 0x0102)
+    struct.pack_into("<H", header, 0x98, 0x10b)
+    return bytes(header)
+
+
+def _fake_elf():
+    header = bytearray(0x40)
+    header[0:4] = b"\x7fELF"
+    header[4:6] = b"\x01\x01"
+    struct.pack_into("<HH", header, 16, 2, 3)
+    return bytes(header)
+
+
+def make_fake_libvirt(sim):
+    """libvirtモジュールの代わりとなるモジュールを作成する"""
+
+    libvirt = types.ModuleType("libvirt")
+    libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC = 128
+    libvirt.VIR_DOMAIN_SNAPSHOT_REVERT_RUNNING = 1
+    libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE = 0
+    libvirt.VIR_DOMAIN_XML_INACTIVE = 2
+    libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE = 0
+    libvirt.VIR_DOMAIN_EVENT_ID_AGENT_LIFECYCLE = 18
+    libvirt.VIR_CONNECT_DOMAIN_EVENT_AGENT_LIFECYCLE_STATE_CONNECTED = 1
+    libvirt.VIR_DOMAIN_EVENT_UNDEFINED = 1
+    libvirt.VIR_DOMAIN_EVENT_STARTED = 2
+    libvirt.VIR_DOMAIN_EVENT_STOPPED = 5
+    libvirt.VIR_DOMAIN_EVENT_CRASHED = 8
+    libvirt.VIR_DOMAIN_EVENT_STOPPED_DESTROYED = 1
+    libvirt.VIR_DOMAIN_EVENT_STOPPED_FROM_SNAPSHOT = 6
+    libvirt.VIR_CONNECT_DOMAIN_EVENT_AGENT_LIFECYCLE_STATE_CONNECTED = 1
+
+    class libvirtError(Exception):
+        pass
+
+    class Domain:
+        def __init__(self, name, index, disk_path):
+            self._name = name
+            self.index = index
+            self.disk_path = disk_path
+            self.running = False
+            self.snapshots = {}
+            self.transient = False
+            self.mac = f"52:54:00:00:{index // 256:02x}:{index % 256:02x}"
+            self.ip_addr = f"192.168.{122 + index // 200}.{10 + index % 200}"
+            self.boots = count()
+            self.ready_at = float("inf")
+            self.boot = None
+
+        def name(self):
+            return self._name
+
+        def UUIDString(self):
+            return f"00000000-0000-0000-0000-{self.index:012d}"
+
+        def info(self):
+            return [1 if self.running else 5]
+
+        def __boot(self):
+            # 起動からdhcp_delay後にゲストが応答し始め、リースがなければリースファイルにIPアドレスが書き込まれる
+            self.running = True
+            self.ready_at = time.monotonic() + sim.dhcp_delay * sim.scale
+            self.boot = boot = next(self.boots)
+            sim.emit(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self, libvirt.VIR_DOMAIN_EVENT_STARTED, 0)
+            threading.Timer(sim.dhcp_delay * sim.scale, self.__lease, [boot]).start()
+
+        def __lease(self, boot):
+            # 実行中のスナップショットから復元したゲストはメモリ上のリースを使い続け、DHCPで更新しない
+            if self.running and self.boot == boot and self.mac not in sim.leases:
+                sim.set_lease(self.mac, self.ip_addr)
+
+        def answers(self):
+            return self.running and time.monotonic() >= self.ready_at
+
+        def create(self):
+            self.__boot()
+            return 0
+
+        def destroy(self):
+            self.running = False
+            sim.set_lease(self.mac, None)
+            sim.emit(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self, libvirt.VIR_DOMAIN_EVENT_STOPPED,
+                     libvirt.VIR_DOMAIN_EVENT_STOPPED_DESTROYED)
+            if self.transient:
+                self.undefine()
+            return 0
+
+        def undefine(self):
+            with sim.lock:
+                sim.domains.pop(self._name, None)
+            sim.emit(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self, libvirt.VIR_DOMAIN_EVENT_UNDEFINED, 0)
+            return 0
+
+        def snapshotListNames(self):
+            return list(self.snapshots)
+
+        def snapshotCreateXML(self, xmlDesc, flags=0):
+            name = ET.fromstring(xmlDesc).find("name").text
+            self.snapshots[name] = name
+            return name
+
+        def snapshotLookupByName(self, name):
+            return self.snapshots[name]
+
+        def revertToSnapshot(self, snapshot, flags=0):
+            # 復元を始めた時点で復元前のゲストは止まり、DHCPの要求も送らない
+            self.boot = None
+            sim.sleep(sim.revert_time)
+            # dnsmasqは復元前のリースを保持したまま返し続ける
+            sim.emit(libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self, libvirt.VIR_DOMAIN_EVENT_STOPPED,
+                     libvirt.VIR_DOMAIN_EVENT_STOPPED_FROM_SNAPSHOT)
+            self.__boot()
+            return 0
+
+        def interfaceAddresses(self, source, flags=0):
+            # SRC_LEASEの問い合わせはdnsmasqのリースを返すため、復元直後は古いリースが返る
+            if self.mac not in sim.leases:
+                return {}
+            return {f"vnet{self.index}": {"addrs": [{"addr": self.ip_addr}], "hwaddr": self.mac}}
+
+        def XMLDesc(self, flags=0):
+            return (
+                f"<domain><name>{self._name}</name><uuid>{self.UUIDString()}</uuid><devices>"
+                f"<disk device='disk'><driver type='qcow2'/><source file='{self.disk_path}'/></disk>"
+                f"<interface><mac address='{self.mac}'/><target dev='vnet{self.index}'/></interface>"
+                f"</devices></domain>"
+            )
+
+    class Connection:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def close(self):
+            pass
+
+        def domainEventRegisterAny(self, dom, event_id, callback, opaque):
+            sim.callbacks.append((event_id, callback, opaque))
+            return len(sim.callbacks)
+
+        def lookupByName(self, name):
+            with sim.lock:
+                if name not in sim.domains:
+                    raise libvirtError(f"Domain not found: {name}")
+                return sim.domains[name]
+
+        def createXML(self, xml, flags=0):
+            root = ET.fromstring(xml)
+            domain = define_domain(root.find("name").text, root.find("devices/disk/source").get("file"))
+            mac = root.find("devices/interface/mac")
+            if mac is not None:
+                domain.mac = mac.get("address")
+            domain.transient = True
+            domain.create()
+            return domain
+
+    def define_domain(name, disk_path=None):
+        if disk_path is None:
+            disk_path = os.path.join(sim.image_dir, f"{name}.qcow2")
+            open(disk_path, "wb").close()
+        with sim.lock:
+            domain = Domain(name, next(sim.domain_index), disk_path)
+            sim.domains[name] = domain
+            return domain
+
+    def open_connection(uri=None):
+        return Connection()
+
+    def run_event_loop():
+        # イベントはドメインの操作と同じスレッドで直ちに呼び出すため、イベントループは何もしない
+        time.sleep(1)
+
+    libvirt.libvirtError = libvirtError
+    libvirt.virEventRegisterDefaultImpl = lambda: 0
+    libvirt.virEventRunDefaultImpl = run_event_loop
+    libvirt.open = open_connection
+    libvirt.define_domain = define_domain
+    return libvirt
+
+
+def make_fake_paramiko(sim):
+    """paramikoモジュールの代わりとなるモジュールを作成する"""
+
+    paramiko = types.ModuleType("paramiko")
+    ssh_exception = types.ModuleType("paramiko.ssh_exception")
+
+    class SSHException(Exception):
+        pass
+
+    class NoValidConnectionsError(OSError):
+        pass
+
+    class Transport:
+        def __init__(self):
+            self.active = True
+
+        def is_active(self):
+            return self.active
+
+        def set_keepalive(self, interval):
+            pass
+
+    class Attr:
+        def __init__(self, filename, size, mtime):
+            self.filename = filename
+            self.st_size = size
+            self.st_mtime = mtime
+            self.st_mode = stat.S_IFREG | 0o644
+
+    class Channel:
+        def __init__(self, duration):
+            self.closed = False
+            self.timeout = None
+            self.end_at = time.monotonic() + duration
+            self.output = [b"simulated output\n"]
+
+        def settimeout(self, timeout):
+            self.timeout = timeout
+
+        def recv(self, size):
+            if self.output:
+                return self.output.pop()
+            remaining = self.end_at - time.monotonic()
+            if self.timeout is not None and remaining > self.timeout:
+                time.sleep(self.timeout)
+                raise socket.timeout()
+            time.sleep(max(remaining, 0))
+            return b""
+
+        def recv_exit_status(self):
+            return 0
+
+    class SFTPFile:
+        def __init__(self, path, mode):
+            self.path = path
+            self.mode = mode
+            self.position = 0
+            self.written = 0
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            self.close()
+
+        def stat(self):
+            with sim.lock:
+                content, mtime = sim.honeypot_files[self.path]
+            return Attr(os.path.basename(self.path), len(content), mtime)
+
+        def prefetch(self, file_size=None):
+            pass
+
+        def set_pipelined(self, pipelined=True):
+            pass
+
+        def read(self, size):
+            with sim.lock:
+                content, _ = sim.honeypot_files[self.path]
+            chunk = content[self.position:self.position + size]
+            self.position += len(chunk)
+            sim.sleep(len(chunk) / sim.sftp_bandwidth)
+            return chunk
+
+        def write(self, data):
+            sim.sleep(len(data) / sim.sftp_bandwidth)
+            self.written += len(data)
+
+        def close(self):
+            if "w" in self.mode:
+                with sim.lock:
+                    sim.uploaded[self.path] = self.written
+
+    class SFTPClient:
+        def __init__(self):
+            self.sock = types.SimpleNamespace(closed=False)
+
+        @classmethod
+        def from_transport(cls, transport, window_size=None, max_packet_size=None):
+            return cls()
+
+        def close(self):
+            self.sock.closed = True
+
+        def listdir_attr(self, path):
+            with sim.lock:
+                return [Attr(os.path.basename(name), len(content), mtime)
+                        for name, (content, mtime) in sim.honeypot_files.items() if os.path.dirname(name) == path]
+
+        def open(self, path, mode="r"):
+            return SFTPFile(path, mode)
+
+        def stat(self, path):
+            with sim.lock:
+                return Attr(os.path.basename(path), sim.uploaded.get(path, 0), 0)
+
+        def chmod(self, path, mode):
+            pass
+
+        def remove(self, path):
+            with sim.lock:
+                sim.honeypot_files.pop(path, None)
+
+    class SSHClient:
+        def set_missing_host_key_policy(self, policy):
+            pass
+
+        def connect(self, hostname, username=None, key_filename=None, port=22, **kwargs):
+            sim.sleep(sim.ssh_connect_time)
+            self.transport = Transport()
+
+        def get_transport(self):
+            return self.transport
+
+        def exec_command(self, command, timeout=None):
+            if command.startswith("sha256sum"):
+                with sim.lock:
+                    content, _ = sim.honeypot_files[shlex.split(command)[-1]]
+                channel = Channel(0)
+                channel.output = []
+                output = f"{hashlib.sha256(content).hexdigest()}  -\n".encode()
+                return None, types.SimpleNamespace(channel=channel, read=lambda: output), None
+            channel = Channel(sim.execution_time * sim.scale)
+            channel.settimeout(timeout)
+            return None, types.SimpleNamespace(channel=channel), None
+
+        def close(self):
+            self.transport.active = False
+
+    paramiko.SSHClient = SSHClient
+    paramiko.SFTPClient = SFTPClient
+    paramiko.AutoAddPolicy = lambda: None
+    paramiko.SSHException = SSHException
+    paramiko.ssh_exception = ssh_exception
+    ssh_exception.SSHException = SSHException
+    ssh_exception.NoValidConnectionsError = NoValidConnectionsError
+    return paramiko, ssh_exception
+
+
+def make_fake_popen(sim):
+    """tcpdumpのプロセスの代わりとなるクラスを作成する"""
+
+    class FakeTcpdump:
+        def __init__(self, command, **kwargs):
+            self.pcap_path = command[command.index("-w") + 1]
+            self.interface = command[command.index("-i") + 1]
+            self.returncode = None
+            self.lines = queue.Queue()
+            self.stderr = iter(self.lines.get, None)
+            with open(self.pcap_path, "wb") as f:
+                f.write(struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+            threading.Timer(sim.capture_start_time * sim.scale, self.lines.put,
+                            [f"tcpdump: listening on {self.interface}, link-type EN10MB (Ethernet)\n"]).start()
+
+        def poll(self):
+            return self.returncode
+
+        def terminate(self):
+            for line in ("0 packets captured\n", "0 packets received by filter\n", "0 packets dropped by kernel\n"):
+                self.lines.put(line)
+            self.lines.put(None)
+            self.returncode = 0
+
+        kill = terminate
+
+        def wait(self, timeout=None):
+            return self.returncode
+
+    return FakeTcpdump
+
+
+def run_mode(args):
+    """1つのモードを実行し、結果を辞書で返す"""
+
+    sim = Simulation(args)
+    hostnames = ["honeypot"] if args.honeypots == 1 else [f"honeypot{i}" for i in range(args.honeypots)]
+    sim.generate_corpus(args.specimens, args.specimen_size, args.duplicate_ratio, args.discard_ratio, args.seed,
+                        hostnames)
+
+    work_dir = tempfile.mkdtemp(prefix="ambc-benchmark-")
+    for name in ("pcap", "specimen", "log", "images"):
+        os.mkdir(os.path.join(work_dir, name))
+    sim.image_dir = os.path.join(work_dir, "images")
+    sim.lease_path = os.path.join(work_dir, "virbr0.status")
+    with open(sim.lease_path, "w") as f:
+        f.write("[]")
+    os.environ.update({
+        "PCAP_BASE_DIR": os.path.join(work_dir, "pcap"),
+        "SPECIMEN_BASE_DIR": os.path.join(work_dir, "specimen"),
+        "LOGGING_DIR": os.path.join(work_dir, "log"),
+        "HASH_INDEX_PATH": os.path.join(work_dir, "hash_index.db"),
+        "JOURNAL_PATH": os.path.join(work_dir, "journal.db"),
+        "CATALOG_PATH": os.path.join(work_dir, "catalog.db"),
+        "SIMILARITY_INDEX_PATH": os.path.join(work_dir, "similarity_index.db"),
+        "PRE_EXECUTION_TIME": "10",
+        "EXECUTION_TIME_LIMIT": "1",
+        "KEYFILE_PATH": "/dev/null",
+        "HONEYPOT_USER_NAME": "user",
+        "HONEYPOT_SSH_PORT": "22",
+        "HONEYPOT_IP_ADDR": "honeypot",
+        "HONEYPOT_SPECIMEN_DIR_1": "/honeypot/binaries",
+        "HONEYPOT_SPECIMEN_DIR_2": "/honeypot/downloads",
+        "DHCP_LEASE_FILE": sim.lease_path,
+        "STALE_LEASE_GRACE": str(15 * sim.scale),
+        "POLLING_INTERVAL_MIN": str(args.poll_interval),
+        "POLLING_INTERVAL_MAX": str(args.poll_interval * 16),
+    })
+    if args.honeypots > 1:
+        honeypots_path = os.path.join(work_dir, "honeypots.json")
+        with open(honeypots_path, "w") as f:
+            json.dump([{"ip_addr": hostname, "specimen_dirs": [f"/{hostname}/binaries"]} for hostname in hostnames], f)
+        os.environ["HONEYPOTS_FILE"] = honeypots_path
+    if args.artifact_store:
+        os.environ["ARTIFACT_STORE_DIR"] = os.path.join(work_dir, "artifacts")
+    for key, value in MODES[args.mode].items():
+        os.environ[key] = value.format(workers=args.workers)
+
+    sys.modules["libvirt"] = libvirt = make_fake_libvirt(sim)
+    sys.modules["paramiko"], sys.modules["paramiko.ssh_exception"] = make_fake_paramiko(sim)
+    for domain_name in ("win10_32bit", "ubuntu20.04"):
+        libvirt.define_domain(domain_name)
+
+    import ingest
+    import main
+    import metrics
+    import tcpdump
+    import vm
+    import vmevents
+
+    def fake_run(command, **kwargs):
+        if command[0] == "virt-clone":
+            sim.sleep(sim.clone_time)
+            libvirt.define_domain(command[command.index("-n") + 1])
+        elif command[0] == "qemu-img":
+            sim.sleep(sim.overlay_time)
+            open(command[-1], "wb").close()
+        return subprocess.CompletedProcess(command, 0)
+
+    main.run = fake_run
+    vm.run = fake_run
+    tcpdump.Popen = make_fake_popen(sim)
+    # 固定の待機時間も模擬上の秒として扱う。execute_fileの観測時間は実際の秒で渡す
+    vmevents.LEASE_POLL_INTERVAL = 0.1 * sim.scale
+    vmevents.PROBE_INTERVAL = 1 * sim.scale
+
+    def probe_guest(ip_addr, port, timeout):
+        with sim.lock:
+            domains = list(sim.domains.values())
+        return any(domain.ip_addr == ip_addr and domain.answers() for domain in domains)
+
+    vmevents.probe_guest = probe_guest
+    ingest.sleep = sim.sleep
+    main.EXECUTION_TIME_LIMIT = args.observation_time * sim.scale
+    main.IDLE_GRACE_TIME = args.observation_time * sim.scale
+
+    # パーセンタイルを求めるため、メトリクスとは別に観測値をすべて記録する
+    observations = defaultdict(list)
+    observe = metrics.STAGE_DURATION.observe
+
+    def record(value, stage):
+        observations[stage].append(value / sim.scale)
+        observe(value, stage=stage)
+
+    metrics.STAGE_DURATION.observe = record
+
+    start = time.monotonic()
+    threading.Thread(target=main.behavior_collection, daemon=True).start()
+    while True:
+        accounted = sum(metrics.SPECIMENS.values.values()) + sum(metrics.FAILURES.values.values())
+        if accounted >= args.specimens:
+            break
+        if time.monotonic() - start > args.timeout:
+            break
+        time.sleep(0.01)
+    # ストアに保存する場合は、最後の検体と実行結果が作業ディレクトリからストアに移されるまで待つ
+    while args.artifact_store and time.monotonic() - start <= args.timeout and any(
+            filename != "observation.csv" for name in ("pcap", "specimen")
+            for _, _, filenames in os.walk(os.path.join(work_dir, name)) for filename in filenames):
+        time.sleep(0.01)
+    elapsed = (time.monotonic() - start) / sim.scale
+
+    # 検体・pcap・出力が占めるディスク容量。SQLiteのWALは上限まで使い回されるため含めない
+    disk_bytes = sum(os.path.getsize(os.path.join(dir_path, filename))
+                     for name in ("pcap", "specimen", "artifacts")
+                     for dir_path, _, filenames in os.walk(os.path.join(work_dir, name)) for filename in filenames
+                     if not filename.endswith(("-wal", "-shm")))
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    processed = metrics.SPECIMENS.values.get(("processed",), 0)
+    return {
+        "mode": args.mode,
+        "specimens": args.specimens,
+        "processed": processed,
+        "deduplicated": metrics.SPECIMENS.values.get(("deduplicated",), 0),
+        "discarded": metrics.SPECIMENS.values.get(("discarded",), 0),
+        "failed": sum(metrics.FAILURES.values.values()),
+        "completed": accounted >= args.specimens,
+        "simulated_seconds": elapsed,
+        "specimens_per_hour": accounted / elapsed * 3600,
+        "executed_per_hour": processed / elapsed * 3600,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "disk_bytes": disk_bytes,
+        "stages": {stage: percentiles(values) for stage, values in sorted(observations.items())},
+    }
+
+
+def percentiles(values):
+    values = sorted(values)
+
+    def at(q):
+        return values[min(int(q * len(values)), len(values) - 1)]
+
+    return {"count": len(values), "p50": at(0.5), "p90": at(0.9), "p99": at(0.99)}
+
+
+def compare(args):
+    """各モードを別プロセスで実行し、結果を表にして出力する"""
+
+    options = [arg for arg in sys.argv[1:] if arg != "--mode"]
+    results = []
+    for mode in MODES:
+        output = subprocess.run([sys.executable, __file__, *options, "--mode", mode],
+                                check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output))
+
+    print(f"{'mode':<18}{'specimens/h':>12}{'executed/h':>12}{'sim. time[s]':>14}{'peak RSS[MB]':>14}"
+          f"{'disk[MB]':>10}")
+    for result in results:
+        print(f"{result['mode']:<18}{result['specimens_per_hour']:>12.0f}{result['executed_per_hour']:>12.0f}"
+              f"{result['simulated_seconds']:>14.0f}{result['peak_rss_mb']:>14.1f}"
+              f"{result['disk_bytes'] / 1024 / 1024:>10.2f}"
+              + ("" if result["completed"] else "  (timeout)"))
+    print()
+    stages = sorted({stage for result in results for stage in result["stages"]})
+    print(f"{'stage p50/p90/p99 [s]':<22}" + "".join(f"{result['mode']:>20}" for result in results))
+    for stage in stages:
+        cells = []
+        for result in results:
+            p = result["stages"].get(stage)
+            cells.append(f"{p['p50']:.1f}/{p['p90']:.1f}/{p['p99']:.1f}" if p else "-")
+        print(f"{stage:<22}" + "".join(f"{cell:>20}" for cell in cells))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=MODES, help="実行するモード。省略時はすべてのモードを比較する")
+    parser.add_argument("--specimens", type=int, default=40, help="検体の数")
+    parser.add_argument("--specimen-size", type=int, default=64 * 1024, help="検体のサイズ（バイト）")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.2, help="既出の検体と同じ内容の検体の割合")
+    parser.add_argument("--discard-ratio", type=float, default=0.1, help="実行しない形式の検体の割合")
+    parser.add_argument("--honeypots", type=int, default=1, help="検体を置くハニーポットの数")
+    parser.add_argument("--workers", type=int, default=2, help="並列モードでのOSごとのワーカー数")
+    parser.add_argument("--revert-time", type=float, default=8, help="スナップショットの復元時間（秒）")
+    parser.add_argument("--dhcp-delay", type=float, default=3, help="起動・復元からIPアドレスが割り当てられるまでの時間（秒）")
+    parser.add_argument("--clone-time", type=float, default=60, help="virt-cloneの所要時間（秒）")
+    parser.add_argument("--overlay-time", type=float, default=0.2, help="オーバーレイの作成時間（秒）")
+    parser.add_argument("--ssh-connect-time", type=float, default=0.3, help="SSHの接続・認証時間（秒）")
+    parser.add_argument("--sftp-bandwidth", type=float, default=1024 * 1024, help="SFTPの帯域（バイト/秒）")
+    parser.add_argument("--execution-time", type=float, default=20, help="検体が終了するまでの時間（秒）")
+    parser.add_argument("--observation-time", type=float, default=60, help="観測時間の上限（秒）")
+    parser.add_argument("--capture-start-time", type=float, default=0.5, help="tcpdumpのキャプチャ開始までの時間（秒）")
+    parser.add_argument("--poll-interval", type=float, default=1, help="ハニーポットのポーリング間隔の最小値（秒）")
+    parser.add_argument("--time-scale", type=float, default=0.01, help="模擬上の1秒あたりに実際に待機する秒数")
+    parser.add_argument("--timeout", type=float, default=600, help="1つのモードの実行時間の上限（実際の秒）")
+    parser.add_argument("--artifact-store", action="store_true", help="検体とpcapをアーティファクトストアに保存する")
+    parser.add_argument("--seed", type=int, default=0, help="検体を生成する乱数のシード")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.mode:
+        print(json.dumps(run_mode(args)), flush=True)
+        # 類似性ハッシュを計算する子プロセスはos._exitでは終了せず、標準出力を開いたまま残るため先に終了させる
+        similarity = sys.modules.get("similarity")
+        if similarity is not None and similarity._executor is not None:
+            similarity._executor.shutdown(wait=True, cancel_futures=True)
+        # 挙動収集のスレッドは検体を待ち続けているため、終了時にスレッドプールの終了を待たない
+        os._exit(0)
+    else:
+        compare(args)
@@ -0,0 +1,148 @@
+import os
+import time
+from collections import namedtuple
+
+from util import SQLiteDatabase
+
+# 検体ごとの実行記録
+Run = namedtuple("Run", [
+    "finished", "sha256", "filename", "remote_path", "file_kind", "file_description", "domain_name", "result",
+    "returncode", "timed_out", "observed_time", "captured", "dropped", "pcap_path", "pcap_size", "error",
+])
+
+# 集計に用いることのできる列
+GROUP_COLUMNS = ("file_kind", "file_description", "domain_name", "result", "returncode", "timed_out")
+
+
+class Catalog(SQLiteDatabase):
+    """実行した検体ごとの結果をSQLiteに記録し、条件を指定して検索する
+
+    日付ごとのpcapディレクトリ、検体ディレクトリ、ログファイルに散らばった情報を1行にまとめる。
+    よく使う絞り込み（ファイル形式・実行環境・期間）には複合インデックスを張っているため、
+    数百万行でも期間を絞った検索はインデックスの範囲走査で済む。
+    """
+
+    def __init__(self, db_path, timeout=30):
+        """初期化
+
+        Arguments:
+            db_path(str): カタログを保存するSQLiteのファイルパス
+            timeout(float): SQLiteDatabaseを参照
+        """
+        super().__init__(db_path, timeout)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            "id INTEGER PRIMARY KEY, finished REAL NOT NULL, sha256 TEXT, filename TEXT, remote_path TEXT, "
+            "file_kind TEXT, file_description TEXT, domain_name TEXT, result TEXT NOT NULL, returncode INTEGER, "
+            "timed_out INTEGER NOT NULL DEFAULT 0, observed_time REAL, captured INTEGER, dropped INTEGER, "
+            "pcap_path TEXT, pcap_size INTEGER, error TEXT)"
+        )
+        for name, columns in (
+            # 期間での絞り込みと集計をテーブルを読まずに済ませる
+            ("runs_finished", "finished, file_kind, domain_name, result, returncode, timed_out"),
+            ("runs_kind", "file_kind, finished"),
+            ("runs_domain", "domain_name, finished"),
+            ("runs_returncode", "returncode, finished"),
+            ("runs_sha256", "sha256"),
+        ):
+            self.conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON runs ({columns})")
+
+    def add(self, sha256, filename, remote_path, file_kind, file_description, domain_name, result,
+            execution=None, captured=None, dropped=None, pcap_path=None, error=None):
+        """検体の実行結果を1行記録する
+
+        Args:
+            result (str): "processed"（観測を終えた）もしくは"failed"（実行に失敗した）
+            execution (ExecutionResult): 実行結果。returncodeがNoneの場合は実行時間制限に達したとみなす
+            captured (int): キャプチャしたパケット数
+            dropped (int): カーネルが取りこぼしたパケット数
+            pcap_path (str): pcapファイルのパス。記録時点のサイズも合わせて記録する
+            error (str): 実行に失敗した場合の例外
+        """
+
+        pcap_size = os.path.getsize(pcap_path) if pcap_path and os.path.exists(pcap_path) else None
+        returncode = execution.returncode if execution else None
+        timed_out = execution is not None and returncode is None
+        observed_time = execution.observed_time if execution else None
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO runs (finished, sha256, filename, remote_path, file_kind, file_description, "
+                "domain_name, result, returncode, timed_out, observed_time, captured, dropped, pcap_path, "
+                "pcap_size, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), sha256, filename, remote_path, file_kind, file_description, domain_name, result,
+                 returncode, int(timed_out), observed_time, captured, dropped, pcap_path, pcap_size,
+                 None if error is None else str(error))
+            )
+
+    @staticmethod
+    def __where(file_kind=None, domain_name=None, since=None, until=None, nonzero=False, timed_out=None,
+                sha256=None, result=None):
+        conditions, params = [], []
+        for column, value in (("file_kind", file_kind), ("domain_name", domain_name), ("sha256", sha256),
+                              ("result", result)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            conditions.append("finished >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("finished < ?")
+            params.append(until)
+        if nonzero:
+            conditions.append("returncode != 0")
+        if timed_out is not None:
+            conditions.append("timed_out = ?")
+            params.append(int(timed_out))
+        return (" WHERE " + " AND ".join(conditions) if conditions else ""), params
+
+    def query(self, limit=100, **filters):
+        """条件に合う実行記録を新しい順に返す
+
+        Args:
+            limit (int): 返す行数の上限。Noneの場合はすべて
+            filters: file_kind, domain_name, since, until（UNIX時間）, nonzero（終了コードが0以外）,
+                timed_out, sha256, resultで絞り込む
+
+        Returns:
+            list(Run): 実行記録のリスト
+        """
+
+        where, params = self.__where(**filters)
+        sql = f"SELECT {', '.join(Run._fields)} FROM runs{where} ORDER BY finished DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with self.lock:
+            return [Run(*row) for row in self.conn.execute(sql, params)]
+
+    def summary(self, group_by=("file_kind", "result"), **filters):
+        """条件に合う実行記録を列の値ごとに集計する
+
+        Returns:
+            list(tuple): 集計した列の値と件数のタプルのリスト（件数の多い順）
+        """
+
+        for column in group_by:
+            if column not in GROUP_COLUMNS:
+                raise ValueError(f"{column}では集計できません（{', '.join(GROUP_COLUMNS)}のいずれか）")
+        columns = ", ".join(group_by)
+        where, params = self.__where(**filters)
+        with self.lock:
+            return self.conn.execute(
+                f"SELECT {columns}, COUNT(*) FROM runs{where} GROUP BY {columns} ORDER BY COUNT(*) DESC", params
+            ).fetchall()
+
+    def pcaps(self):
+        """pcapを記録した実行記録から、pcapのパスと検体のSHA-256の対応を返す
+
+        同じpcapを複数回記録している場合は最新の記録のSHA-256を用いる。
+
+        Returns:
+            dict: pcapのパスをキー、検体のSHA-256を値とする辞書
+        """
+
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT pcap_path, sha256 FROM runs WHERE pcap_path IS NOT NULL ORDER BY finished").fetchall()
+        return dict(rows)
@@ -0,0 +1,216 @@
+import os
+import struct
+import sys
+from collections import Counter, namedtuple
+from subprocess import PIPE, run
+from time import perf_counter
+
+# 検体を実行するVMの種類
+VMProfile = namedtuple("VMProfile", ["is_windows", "domain_name", "vm_username"])
+WINDOWS_PROFILE = VMProfile(True, "win10_32bit", "malwa")
+LINUX_PROFILE = VMProfile(False, "ubuntu20.04", "vmuser")
+
+# 判定結果。profileがNoneの場合は実行する必要のないファイル
+FileType = namedtuple("FileType", ["kind", "description", "profile"])
+
+# 判定に用いるファイル先頭のバイト数
+HEAD_SIZE = 4096
+
+ELF_MACHINES = {
+    2: "SPARC",
+    3: "Intel 80386",
+    8: "MIPS",
+    20: "PowerPC",
+    40: "ARM",
+    42: "Renesas SH",
+    62: "x86-64",
+    183: "ARM aarch64",
+}
+
+PE_MACHINES = {
+    0x14c: "Intel 80386",
+    0x8664: "x86-64",
+    0x1c0: "ARM",
+    0xaa64: "Aarch64",
+}
+
+# HTML/SGMLとみなすファイル先頭のタグ
+MARKUP_TAGS = (b"<!doctype", b"<html", b"<head", b"<body", b"<title", b"<script", b"<iframe")
+
+TEXT_BYTES = bytes(range(0x20, 0x7f)) + b"\a\b\t\n\v\f\r\x1b"
+
+
+def classify(local_specimen_path):
+    """ファイルの先頭数KBのみを読み込み、ファイル形式と実行すべきVMを判定する
+
+    外部のfileコマンドを起動せず、マジックナンバーとヘッダを直接解析する。
+
+    Returns:
+        FileType: ファイル形式の種類、説明、実行するVM（実行しない場合はNone）
+    """
+
+    with open(local_specimen_path, "rb") as f:
+        head = f.read(HEAD_SIZE)
+        if head.startswith(b"MZ"):
+            return _classify_pe(f, head)
+        if head.startswith(b"\x7fELF"):
+            return _classify_elf(f, head)
+    size = os.path.getsize(local_specimen_path)
+    return _classify_text(head, size)
+
+
+def classify_tree(root_dir):
+    """ディレクトリ以下のすべてのファイルを判定する
+
+    Yields:
+        (str, FileType): ファイルのパスと判定結果
+    """
+
+    for path in _list_files(root_dir):
+        yield path, classify(path)
+
+
+def _list_files(root_dir):
+    """ディレクトリ以下の通常ファイルのパスを列挙する"""
+
+    for dir_path, _, filenames in os.walk(root_dir):
+        for filename in filenames:
+            path = os.path.join(dir_path, filename)
+            if os.path.isfile(path):
+                yield path
+
+
+def _read_at(f, head, offset, size):
+    """先頭の読み込み済みの範囲にあればそこから、なければシークして読み込む"""
+
+    if offset + size <= len(head):
+        return head[offset:offset + size]
+    f.seek(offset)
+    return f.read(size)
+
+
+def _classify_pe(f, head):
+    """MZで始まるファイルを判定する。PEヘッダがなければMS-DOSの実行ファイルとみなす"""
+
+    msdos = FileType("msdos", "MS-DOS executable", None)
+    if len(head) < 0x40:
+        return msdos
+    e_lfanew, = struct.unpack_from("<I", head, 0x3c)
+    # PEシグネチャ(4) + COFFヘッダ(20) + オプションヘッダのマジック(2)
+    pe_header = _read_at(f, head, e_lfanew, 26)
+    if len(pe_header) < 26 or pe_header[:4] != b"PE\0\0":
+        return msdos
+
+    machine, = struct.unpack_from("<H", pe_header, 4)
+    characteristics, = struct.unpack_from("<H", pe_header, 22)
+    magic, = struct.unpack_from("<H", pe_header, 24)
+    arch = PE_MACHINES.get(machine, hex(machine))
+
+    if magic == 0x20b:
+        # 64bitのWindowsの実行環境は用意していない
+        return FileType("pe32+", f"PE32+ executable {arch}", None)
+    if magic != 0x10b:
+        return FileType("pe", f"PE executable with unknown optional header magic {hex(magic)}", None)
+    if characteristics & 0x2000:
+        return FileType("dll", f"PE32 executable (DLL) {arch}", None)
+    return FileType("pe32", f"PE32 executable {arch}", WINDOWS_PROFILE)
+
+
+def _classify_elf(f, head):
+    """ELFファイルを判定する。共有ライブラリやオブジェクトファイルは実行しない"""
+
+    if len(head) < 6:
+        return FileType("elf-other", "truncated ELF", None)
+    ei_class, ei_data = head[4], head[5]
+    bits = {1: 32, 2: 64}.get(ei_class)
+    endian = {1: "<", 2: ">"}.get(ei_data)
+    if bits is None or endian is None:
+        return FileType("elf-other", "ELF with invalid class or data encoding", None)
+    # ELFヘッダの大きさは32bitで0x34、64bitで0x40
+    if len(head) < (0x34 if bits == 32 else 0x40):
+        return FileType("elf-other", "truncated ELF", None)
+    e_type, e_machine = struct.unpack_from(endian + "HH", head, 16)
+    arch = ELF_MACHINES.get(e_machine, f"machine {e_machine}")
+    description = f"ELF {bits}-bit {'LSB' if endian == '<' else 'MSB'}"
+
+    if e_type == 2:
+        return FileType("elf", f"{description} executable, {arch}", LINUX_PROFILE)
+    if e_type == 3:
+        # PIEの実行ファイルも共有ライブラリと同じET_DYNなので、インタプリタの有無で区別する
+        has_interp = _elf_has_interp(f, head, bits, endian)
+        if has_interp is None:
+            return FileType("elf-other", f"{description} shared object with malformed program headers, {arch}", None)
+        if has_interp:
+            return FileType("elf", f"{description} pie executable, {arch}", LINUX_PROFILE)
+        return FileType("elf-shared", f"{description} shared object, {arch}", None)
+    kind = {1: "relocatable", 4: "core file"}.get(e_type, f"type {e_type}")
+    return FileType("elf-other", f"{description} {kind}, {arch}", None)
+
+
+def _elf_has_interp(f, head, bits, endian):
+    """プログラムヘッダにPT_INTERPが含まれるかを返す。プログラムヘッダが壊れている場合はNoneを返す"""
+
+    if bits == 32:
+        e_phoff, = struct.unpack_from(endian + "I", head, 28)
+        e_phentsize, e_phnum = struct.unpack_from(endian + "HH", head, 42)
+    else:
+        e_phoff, = struct.unpack_from(endian + "Q", head, 32)
+        e_phentsize, e_phnum = struct.unpack_from(endian + "HH", head, 54)
+    if e_phnum == 0:
+        return False
+    # エントリの大きさが規定と異なるものはカーネルも実行しない
+    if e_phentsize != (32 if bits == 32 else 56):
+        return None
+    table = _read_at(f, head, e_phoff, e_phentsize * e_phnum)
+    if len(table) < e_phentsize * e_phnum:
+        return None
+    for offset in range(0, len(table) - 3, e_phentsize):
+        p_type, = struct.unpack_from(endian + "I", table, offset)
+        if p_type == 3:
+            return True
+    return False
+
+
+def _classify_text(head, size):
+    """実行ファイル以外を判定する。シェバンのあるスクリプトとASCIIテキストのみLinuxで実行する"""
+
+    if head.startswith(b"#!"):
+        interpreter = head[2:].split(b"\n", 1)[0].strip().decode(errors="replace")
+        return FileType("script", f"script text executable ({interpreter})", LINUX_PROFILE)
+
+    stripped = head.lstrip().lower()
+    if stripped.startswith(MARKUP_TAGS):
+        return FileType("html", "HTML/SGML document", None)
+
+    if not head or head.translate(None, TEXT_BYTES):
+        return FileType("data", "data", None)
+
+    # ハニーポットに記録された認証情報のみが書かれた1行のファイル
+    firstline, _, rest = head.partition(b"\n")
+    if firstline.startswith(b"root") and not rest and size <= len(head):
+        return FileType("credential", "ASCII text (credential)", None)
+    return FileType("text", "ASCII text", LINUX_PROFILE)
+
+
+def benchmark(root_dir):
+    """ディレクトリ以下のファイルについて、classifyとfileコマンドの判定時間を比較する"""
+
+    paths = list(_list_files(root_dir))
+
+    start = perf_counter()
+    kinds = Counter(classify(path).kind for path in paths)
+    classify_time = perf_counter() - start
+
+    start = perf_counter()
+    for path in paths:
+        run(["file", path], check=False, text=True, stdout=PIPE)
+    file_time = perf_counter() - start
+
+    print(f"files: {len(paths)}")
+    print(f"classify: {classify_time:.3f}s, file: {file_time:.3f}s ({file_time / max(classify_time, 1e-9):.1f}x)")
+    for kind, count in kinds.most_common():
+        print(f"  {kind}: {count}")
+
+
+if __name__ == "__main__":
+    benchmark(sys.argv[1])
@@ -0,0 +1,70 @@
+import hashlib
+import logging
+import time
+
+from util import SQLiteDatabase
+
+
+def calcurate_hash(local_specimen_path, chunk_size=1024 * 1024):
+    """ファイルのSHA-256を計算する
+
+    巨大な検体でもメモリを圧迫しないよう、chunk_sizeずつ読み込みながら計算する。
+    """
+
+    sha256 = hashlib.sha256()
+    with open(local_specimen_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class HashIndex(SQLiteDatabase):
+    """実行済みの検体のハッシュ値をSQLiteに永続化し、再起動後も重複実行を防ぐ
+
+    SQLiteのロックにより、複数の挙動収集プロセスが同じインデックスを共有できる。
+    """
+
+    def __init__(self, db_path, timeout=30):
+        """初期化
+
+        Arguments:
+            db_path(str): インデックスを保存するSQLiteのファイルパス
+            timeout(float): SQLiteDatabaseを参照
+        """
+        super().__init__(db_path, timeout)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS specimens ("
+            "sha256 TEXT PRIMARY KEY, filename TEXT, first_seen REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS specimens_filename ON specimens (filename)")
+        count, = self.conn.execute("SELECT COUNT(*) FROM specimens").fetchone()
+        logging.info(f"ハッシュインデックス{db_path}を読み込み（登録済み: {count}件）")
+
+    def __contains__(self, filehash):
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM specimens WHERE sha256 = ?", (filehash,)).fetchone()
+        return row is not None
+
+    def has_filename(self, filename):
+        """同じファイル名の検体が登録済みか否かを返す"""
+
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM specimens WHERE filename = ?", (filename,)).fetchone()
+        return row is not None
+
+    def add(self, filehash, filename=None):
+        """ハッシュ値を登録する
+
+        登録の可否の判定と登録は1つのSQL文で行うため、複数のプロセスが同時に同じ検体を登録しようとしても
+        Trueを返すのはいずれか1つのみとなる。
+
+        Returns:
+            bool: 新規に登録した場合はTrue、既に登録済みだった場合はFalse
+        """
+
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO specimens (sha256, filename, first_seen) VALUES (?, ?, ?)",
+                (filehash, filename, time.time())
+            )
+        return cursor.rowcount == 1
@@ -0,0 +1,256 @@
+import json
+import logging
+import os
+import queue
+import re
+import threading
+from collections import deque, namedtuple
+from time import monotonic, sleep
+
+from metrics import INGEST_ERRORS, INGEST_SKIPPED, INGESTED, INGESTED_BYTES, timed
+from ssh import SSH, SSHSessionPool
+from util import log_collection_error
+
+# 検体を収集するハニーポットの設定
+# digest_filenamesがTrueの場合、そのハニーポットは検体をSHA-256のファイル名で保存しているものとみなす
+Honeypot = namedtuple("Honeypot", ["name", "ip_addr", "port", "user_name", "keyfile", "specimen_dirs",
+                                   "digest_filenames"])
+
+SHA256_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+
+def load_honeypots(path, default: Honeypot):
+    """複数のハニーポットの設定をJSONファイルから読み込む
+
+    JSONファイルはハニーポットごとのオブジェクトのリストで、各オブジェクトはHoneypotのフィールド名をキーとする。
+    ip_addr以外の省略したキーはdefaultの値を用い、nameを省略した場合はip_addrを名前とする。
+
+    Returns:
+        list(Honeypot): ハニーポットの設定のリスト
+    """
+
+    with open(path) as f:
+        entries = json.load(f)
+
+    honeypots = []
+    for entry in entries:
+        unknown = set(entry) - set(Honeypot._fields)
+        if unknown:
+            raise ValueError(f"{path}に不明な項目があります: {', '.join(sorted(unknown))}")
+        honeypot = default._replace(**{"name": entry["ip_addr"], **entry})
+        honeypots.append(honeypot._replace(port=int(honeypot.port), specimen_dirs=list(honeypot.specimen_dirs)))
+
+    names = [honeypot.name for honeypot in honeypots]
+    if len(set(names)) != len(names):
+        raise ValueError(f"{path}内でハニーポットの名前が重複しています")
+    return honeypots
+
+
+class SpecimenIngester:
+    """ハニーポットの検体ディレクトリを監視し、書き込みが完了した検体をまとめて受信する
+
+    監視するディレクトリは1回のポーリングですべて列挙し、前回のポーリングからサイズと更新時刻が
+    変化していないファイルのみを書き込み完了とみなして受信する。受信した検体はハニーポットから削除し、
+    ローカルのキューに溜めておく。
+
+    ポーリング間隔は、検体の到着や書き込み中のファイルがある間は最小値に保ち、
+    何も見つからない間は最大値まで倍々に延ばす。
+    受信した検体は監視するディレクトリとSHA-256ごとのパスに置くため（SSH.receive_specimen）、
+    実行待ちの間に同じ名前の検体が届いても上書きされない。
+
+    ジャーナルを指定した場合、受信した検体をハニーポットから削除する前に記録する。
+    """
+
+    def __init__(self, honeypot, remote_dir_paths, local_dir_path, min_interval=1, max_interval=16, journal=None,
+                 is_duplicate=None, name=None):
+        """初期化
+
+        Arguments:
+            honeypot(SSHSessionPool): ハニーポットへのコネクション
+            remote_dir_paths(list(str)): 監視するリモートのディレクトリのリスト
+            local_dir_path(str): 受信するローカルのディレクトリ
+            min_interval(float): ポーリング間隔の最小値（秒）
+            max_interval(float): ポーリング間隔の最大値（秒）
+            journal(Journal): 検体の処理状態を記録するジャーナル
+            is_duplicate(callable): is_duplicate(remote_specimen_path)がTrueを返す検体は、受信せずに削除する
+            name(str): メトリクスやログに用いるハニーポットの名前
+        """
+        self.honeypot = honeypot
+        self.remote_dir_paths = remote_dir_paths
+        self.local_dir_path = local_dir_path
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.journal = journal
+        self.is_duplicate = is_duplicate
+        self.name = name or honeypot.ip_addr
+        self.interval = min_interval
+        self.queue = deque()
+        # 前回のポーリングで見つけたファイルの(サイズ, 更新時刻)
+        self.last_seen = {}
+
+    def get(self):
+        """受信済みの検体を1つ取り出す。キューが空の場合は検体が届くまで待機する。
+
+        Returns:
+            local_specimen_path (str): 受信したファイルのパス
+            remote_specimen_path (str): ハニーポット上のファイルのパス
+        """
+
+        if not self.queue:
+            logging.info("検体を待機中")
+        while not self.queue:
+            self.ingest()
+            if not self.queue:
+                sleep(self.interval)
+        return self.queue.popleft()
+
+    def ingest(self):
+        """1回分のポーリングを行い、書き込みが完了した検体をまとめて受信してキューに入れる
+
+        Returns:
+            int: 受信した検体の数
+        """
+
+        listing = self.honeypot.call(SSH.list_specimens, self.remote_dir_paths)
+        # 前回と大きさ・更新時刻が変わらないファイルは書き込みが完了したとみなし、残りは次回に確かめる
+        stable = []
+        last_seen = {}
+        for path, attr in listing.items():
+            if self.last_seen.get(path) == attr:
+                stable.append(path)
+            else:
+                last_seen[path] = attr
+        self.last_seen = last_seen
+
+        received = 0
+        for remote_specimen_path in stable:
+            if self.is_duplicate is not None and self.is_duplicate(remote_specimen_path):
+                logging.info(f"{self.name}の{remote_specimen_path}は実行済みのため受信せずに削除")
+                self.honeypot.call(SSH.remove_specimen, remote_specimen_path)
+                INGEST_SKIPPED.inc(sensor=self.name)
+                continue
+            logging.info(f"{remote_specimen_path} が{self.name}に到着")
+            with timed("honeypot_fetch"):
+                local_specimen_path, filehash = self.honeypot.call(SSH.receive_specimen, remote_specimen_path,
+                                                                   self.local_dir_path)
+            if self.journal is not None and \
+                    not self.journal.fetched(local_specimen_path, remote_specimen_path, filehash, self.name):
+                # 同じディレクトリから同じ名前・内容で届いた検体が処理待ちか、失敗として記録済み
+                logging.info(f"{self.name}の{remote_specimen_path}は記録済みの{local_specimen_path}と同一のため削除")
+                self.honeypot.call(SSH.remove_specimen, remote_specimen_path)
+                INGEST_SKIPPED.inc(sensor=self.name)
+                continue
+            self.honeypot.call(SSH.remove_specimen, remote_specimen_path)
+            self.queue.append((local_specimen_path, remote_specimen_path))
+            received += 1
+            INGESTED.inc(sensor=self.name)
+            INGESTED_BYTES.inc(listing[remote_specimen_path][0], sensor=self.name)
+
+        if stable or self.last_seen:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+
+        if received:
+            logging.info(f"{self.name}から{received}個の検体を受信（キュー内: {len(self.queue)}個）")
+        return received
+
+
+class MultiIngester:
+    """複数のハニーポットをそれぞれのスレッドでポーリングし、受信した検体を1つのキューにまとめる
+
+    ハニーポットごとにコネクションとポーリング間隔を持つため、応答の遅いハニーポットや
+    接続できないハニーポットがあっても、他のハニーポットからの受信は止まらない。
+    同じ名前の検体が複数のハニーポットから届いても上書きしないよう、ハニーポットごとのディレクトリに受信する。
+
+    ハニーポット間で同じ検体が届いた場合の重複は、共有のハッシュインデックスによってjudge_osで破棄される。
+    digest_filenamesを指定したハニーポットでは、ファイル名から実行済みと分かる検体を受信せずに削除する。
+    """
+
+    def __init__(self, honeypots, local_dir_path, min_interval=1, max_interval=16, journal=None, hash_index=None):
+        """初期化
+
+        Arguments:
+            honeypots(list(Honeypot)): 検体を収集するハニーポットの設定のリスト
+            local_dir_path(str): 受信するローカルのディレクトリ。この下にハニーポットの名前のディレクトリを作成する
+            min_interval(float): ポーリング間隔の最小値（秒）
+            max_interval(float): ポーリング間隔の最大値（秒）
+            journal(Journal): 検体の処理状態を記録するジャーナル。起動時に未完了の検体をキューに戻す
+            hash_index(HashIndex): 実行済みの検体のハッシュインデックス
+        """
+        self.queue = queue.Queue()
+        self.hash_index = hash_index
+        self.ingesters = []
+        self.sessions = {}
+        self.started = monotonic()
+
+        for honeypot in honeypots:
+            sensor_dir_path = os.path.join(local_dir_path, honeypot.name)
+            os.makedirs(sensor_dir_path, exist_ok=True)
+            # ハニーポットへのコネクションは検体ごとに張り直さず使い回す
+            session = SSHSessionPool(honeypot.ip_addr, honeypot.user_name, honeypot.keyfile, honeypot.port)
+            is_duplicate = self.__is_recorded_digest if honeypot.digest_filenames and hash_index else None
+            self.ingesters.append(SpecimenIngester(session, honeypot.specimen_dirs, sensor_dir_path, min_interval,
+                                                   max_interval, journal, is_duplicate, honeypot.name))
+            self.sessions[honeypot.name] = session
+
+        if journal is not None:
+            for item in journal.pending():
+                self.queue.put(item)
+            if self.queue.qsize():
+                logging.info(f"前回処理を終えられなかった{self.queue.qsize()}個の検体を再開")
+
+    def __is_recorded_digest(self, remote_specimen_path):
+        filename = os.path.basename(remote_specimen_path).lower()
+        return SHA256_PATTERN.fullmatch(filename) is not None and filename in self.hash_index
+
+    def start(self):
+        """ハニーポットごとのポーリングのスレッドを開始する"""
+
+        for ingester in self.ingesters:
+            threading.Thread(target=self.__poll, args=(ingester,), name=f"ingest-{ingester.name}", daemon=True).start()
+        logging.info(f"{len(self.ingesters)}台のハニーポットからの受信を開始")
+
+    def __poll(self, ingester):
+        while True:
+            try:
+                ingester.ingest()
+            except Exception as e:
+                INGEST_ERRORS.inc(sensor=ingester.name)
+                logging.warning(f"{ingester.name}からの受信に失敗")
+                log_collection_error(e)
+                # 接続できないハニーポットを過度にポーリングしないよう、間隔を延ばす
+                ingester.interval = min(ingester.interval * 2, ingester.max_interval)
+            while ingester.queue:
+                self.queue.put(ingester.queue.popleft())
+            sleep(ingester.interval)
+
+    def get(self):
+        """いずれかのハニーポットから受信した検体を1つ取り出す。キューが空の場合は検体が届くまで待機する。
+
+        Returns:
+            local_specimen_path (str): 受信したファイルのパス
+            remote_specimen_path (str): ハニーポット上のファイルのパス
+        """
+
+        if self.queue.empty():
+            logging.info("検体を待機中")
+        return self.queue.get()
+
+    def stats(self):
+        """ハニーポットごとの受信数・受信量・スループット・エラー数・コネクションの統計を返す"""
+
+        hours = (monotonic() - self.started) / 3600
+        stats = {}
+        for ingester in self.ingesters:
+            received = INGESTED.values.get((ingester.name,), 0)
+            stats[ingester.name] = {
+                "received": int(received),
+                "bytes": int(INGESTED_BYTES.values.get((ingester.name,), 0)),
+                "skipped": int(INGEST_SKIPPED.values.get((ingester.name,), 0)),
+                "errors": int(INGEST_ERRORS.values.get((ingester.name,), 0)),
+                "per_hour": round(received / hours, 1) if hours else 0,
+                "interval": ingester.interval,
+                **self.sessions[ingester.name].stats(),
+            }
+        return stats
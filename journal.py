@@ -0,0 +1,169 @@
+import logging
+import os
+import time
+from collections import namedtuple
+
+from util import SQLiteDatabase
+
+# 検体の状態
+FETCHED = "fetched"  # ハニーポットから受信済み
+HASHED = "hashed"  # ハッシュインデックスに登録済み
+CLASSIFIED = "classified"  # 実行するVMが決まり、実行待ち
+RUNNING = "running"  # VMで実行中
+DONE = "done"  # 実行済み、もしくは実行不要と判断した
+FAILED = "failed"  # 再試行の上限に達した
+
+# 再起動時に再開する状態
+PENDING_STATES = (FETCHED, HASHED, CLASSIFIED, RUNNING)
+
+# ジャーナルに記録された検体の情報
+# sensorは検体を受信したハニーポットの名前
+Entry = namedtuple("Entry", ["local_path", "remote_path", "sha256", "file_kind", "file_description", "domain_name",
+                             "state", "attempts", "sensor"])
+
+
+class Journal(SQLiteDatabase):
+    """受信した検体ごとの処理状態をSQLiteに記録し、再起動後に未完了の検体から再開できるようにする
+
+    ハニーポットから検体を削除する前にローカルのパスを記録するため、
+    挙動収集が途中で停止しても、受信した検体が解析されないまま失われることはない。
+    """
+
+    def __init__(self, db_path, timeout=30):
+        """初期化
+
+        Arguments:
+            db_path(str): ジャーナルを保存するSQLiteのファイルパス
+            timeout(float): SQLiteDatabaseを参照
+        """
+        # WALモードのため、状態の更新ごとの書き込みも軽く済む
+        super().__init__(db_path, timeout)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS journal ("
+            "local_path TEXT PRIMARY KEY, remote_path TEXT, sha256 TEXT, file_kind TEXT, file_description TEXT, "
+            "domain_name TEXT, state TEXT NOT NULL, "
+            "result TEXT, attempts INTEGER NOT NULL DEFAULT 0, error TEXT, created REAL, updated REAL, sensor TEXT)"
+        )
+        # 複数のハニーポットから受信する前に作成したジャーナルには、ハニーポットの名前の列がない
+        if "sensor" not in {row[1] for row in self.conn.execute("PRAGMA table_info(journal)")}:
+            self.conn.execute("ALTER TABLE journal ADD COLUMN sensor TEXT")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS journal_state ON journal (state)")
+        logging.info(f"ジャーナル{db_path}を読み込み（{self.counts()}）")
+
+    def __update(self, local_specimen_path, **columns):
+        assignments = ", ".join(f"{name} = ?" for name in columns)
+        with self.lock:
+            self.conn.execute(
+                f"UPDATE journal SET {assignments}, updated = ? WHERE local_path = ?",
+                (*columns.values(), time.time(), local_specimen_path)
+            )
+
+    def fetched(self, local_specimen_path, remote_specimen_path, filehash=None, sensor=None):
+        """ハニーポットから受信した検体を記録する。ハニーポットから削除する前に呼び出すこと
+
+        受信時にハッシュ値を計算した場合はfilehashに渡す。判定時にファイルを読み直さずに済む。
+        sensorには受信したハニーポットの名前を渡す。pcapと出力の保存先に用いる。
+        同じパスの記録は処理を終えた（DONE）場合のみ置き換え、処理中や失敗の記録は残す。
+
+        Returns:
+            bool: 記録した場合はTrue。同じパスの検体が処理を終えていない場合はFalse
+        """
+
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT INTO journal (local_path, remote_path, sha256, state, created, updated, sensor) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (local_path) DO UPDATE SET remote_path = excluded.remote_path, sha256 = excluded.sha256, "
+                "file_kind = NULL, file_description = NULL, domain_name = NULL, state = excluded.state, "
+                "result = NULL, attempts = 0, error = NULL, created = excluded.created, updated = excluded.updated, "
+                "sensor = excluded.sensor WHERE journal.state = ?",
+                (local_specimen_path, remote_specimen_path, filehash, FETCHED, now, now, sensor, DONE)
+            )
+        return cursor.rowcount == 1
+
+    def hashed(self, local_specimen_path, filehash):
+        """ハッシュインデックスへの登録を記録する。登録する前に呼び出すこと"""
+
+        self.__update(local_specimen_path, state=HASHED, sha256=filehash)
+
+    def classified(self, local_specimen_path, filetype):
+        """ファイル形式の判定結果と実行するVMを記録し、実行待ちにする"""
+
+        self.__update(local_specimen_path, state=CLASSIFIED, file_kind=filetype.kind,
+                      file_description=filetype.description, domain_name=filetype.profile.domain_name)
+
+    def entry(self, local_specimen_path):
+        """記録済みの検体の情報を返す。未記録の場合はNone"""
+
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT {', '.join(Entry._fields)} FROM journal WHERE local_path = ?", (local_specimen_path,)
+            ).fetchone()
+        return Entry(*row) if row else None
+
+    def running(self, local_specimen_path):
+        """実行の開始を記録する
+
+        Returns:
+            int: 今回を含めた実行の試行回数
+        """
+
+        with self.lock:
+            self.conn.execute(
+                "UPDATE journal SET state = ?, attempts = attempts + 1, updated = ? WHERE local_path = ?",
+                (RUNNING, time.time(), local_specimen_path)
+            )
+            row = self.conn.execute(
+                "SELECT attempts FROM journal WHERE local_path = ?", (local_specimen_path,)).fetchone()
+        return row[0] if row else 1
+
+    def done(self, local_specimen_path, result="processed"):
+        self.__update(local_specimen_path, state=DONE, result=result, error=None)
+
+    def retry(self, local_specimen_path, error):
+        """一時的な失敗を記録し、実行待ちに戻す"""
+
+        self.__update(local_specimen_path, state=CLASSIFIED, error=str(error))
+
+    def failed(self, local_specimen_path, error):
+        self.__update(local_specimen_path, state=FAILED, error=str(error))
+
+    def pending(self):
+        """再開すべき検体を受信した順に返す。ローカルのファイルが失われたものは失敗として記録する
+
+        Returns:
+            list((str, str)): ローカルのパスとハニーポット上のパスのリスト
+        """
+
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT local_path, remote_path FROM journal WHERE state IN ({', '.join('?' * len(PENDING_STATES))}) "
+                "ORDER BY created", PENDING_STATES
+            ).fetchall()
+        pending = []
+        for local_specimen_path, remote_specimen_path in rows:
+            if os.path.isfile(local_specimen_path):
+                pending.append((local_specimen_path, remote_specimen_path))
+            else:
+                logging.warning(f"{local_specimen_path}が存在しないため再開できません")
+                self.failed(local_specimen_path, "local file not found")
+        return pending
+
+    def completed(self):
+        """処理を終えた（実行済み・実行不要・失敗）検体のパスとハッシュ値を返す
+
+        Returns:
+            list((str, str)): ローカルのパスとSHA-256のリスト
+        """
+
+        with self.lock:
+            return self.conn.execute(
+                "SELECT local_path, sha256 FROM journal WHERE state IN (?, ?) AND sha256 IS NOT NULL", (DONE, FAILED)
+            ).fetchall()
+
+    def counts(self):
+        """状態ごとの検体の数を返す"""
+
+        with self.lock:
+            return dict(self.conn.execute("SELECT state, COUNT(*) FROM journal GROUP BY state").fetchall())
@@ -1,19 +1,54 @@
-import hashlib
+import argparse
+import asyncio
 import logging
 import os
 import sys
+import threading
+from collections import namedtuple
 from datetime import datetime
-from subprocess import PIPE, run
-
-from paramiko.ssh_exception import SSHException
-
-from settings import (EXECUTION_TIME_LIMIT, HONEYPOT_IP_ADDR,
+from time import perf_counter, time
+from functools import partial
+from subprocess import run
+
+from catalog import GROUP_COLUMNS, Catalog
+from filetype import classify
+from hashindex import HashIndex, calcurate_hash
+from ingest import Honeypot, MultiIngester, load_honeypots
+from journal import DONE, FAILED, FETCHED, PENDING_STATES, Journal
+from metrics import (QUEUE_DEPTH, SPECIMENS, start_http_server,
+                     start_textfile_exporter, timed)
+from pipeline import CollectionPipeline
+from scheduler import SKIP, Judgement, Scheduler
+from settings import (ADAPTIVE_OBSERVATION, ARTIFACT_COMPRESSLEVEL,
+                      ARTIFACT_MAX_AGE_DAYS, ARTIFACT_MAX_BYTES,
+                      ARTIFACT_STORE_DIR, BACKFILL_JOURNAL_PATH,
+                      CAPTURE_FILTER, CAPTURE_SNAPLEN, CATALOG_PATH,
+                      EXCLUDE_CONTROL_TRAFFIC, EXECUTION_TIME_LIMIT,
+                      HASH_INDEX_PATH, HONEYPOTS_FILE, HONEYPOT_IP_ADDR,
                       HONEYPOT_SPECIMEN_DIRS, HONEYPOT_SSH_PORT,
-                      HONEYPOT_USER_NAME, KEYFILE_PATH, LOGGING_DIR,
-                      PCAP_BASE_DIR, PRE_EXECUTION_TIME, SPECIMEN_BASE_DIR)
-from ssh import SSH
-from tcpdump import Tcpdump
-from vm import VM
+                      HONEYPOT_USER_NAME, IDLE_GRACE_TIME, JOURNAL_PATH,
+                      KEYFILE_PATH, LOGGING_DIR, MAX_ATTEMPTS,
+                      METRICS_HTTP_PORT, METRICS_TEXTFILE_PATH,
+                      OUTPUT_SIZE_LIMIT, PCAP_BASE_DIR, POLLING_INTERVAL_MAX,
+                      POLLING_INTERVAL_MIN, PRE_EXECUTION_TIME,
+                      SCHEDULER_AGING, SCHEDULER_CAPACITY,
+                      SIMILARITY_INDEX_PATH, SIMILARITY_MAX_SIZE,
+                      SIMILARITY_POLICY, SIMILARITY_SAMPLE_INTERVAL,
+                      SIMILARITY_THRESHOLD, SPECIMEN_BASE_DIR, USE_PIPELINE,
+                      USE_STANDBY_VM, WORKER_NUMS)
+from similarity import SimilarityIndex, fuzzy_hash_in_subprocess
+from ssh import RECONNECTABLE_ERRORS, SSH
+from store import LOG, OUTPUT, PCAP, SPECIMEN, ArtifactStore
+from tcpdump import Tcpdump, TrafficMonitor, control_traffic_filter
+from util import log_collection_error
+from vm import VM, StandbyVM
+from worker import WorkerPool, clone_vm
+
+# 検体を実行するVMのドメインネーム
+DOMAIN_NAMES = ("win10_32bit", "ubuntu20.04")
+
+# execute_specimenの結果
+Observation = namedtuple("Observation", ["execution", "pcap_path", "captured", "dropped"])
 
 
 def stop_stp(bridge_name="virbr0"):
@@ -26,68 +61,161 @@ def add_qdisc_rule():
     run(['tc', 'qdisc', 'add', 'dev', 'wlp5s0', 'root', 'tbf', 'rate', '50kbps', 'limit', '100kb', 'burst', '10kb'])
 
 
-def calcurate_hash(local_specimen_path):
-    """ファイルのハッシュ値を計算する"""
-
-    with open(local_specimen_path, "rb") as f:
-        return hashlib.sha256(f.read()).hexdigest()
-
-
 def mk_datetime_dir(base_dir):
     """実行日時を名前とするディレクトリを作成"""
     dir_name = datetime.now().strftime("%Y-%m-%d-%H-%M")
     created_dir = os.path.join(base_dir, dir_name)
-    os.mkdir(created_dir)
+    # 同じ分のうちに再起動した場合は既存のディレクトリを使う
+    os.makedirs(created_dir, exist_ok=True)
     return created_dir
 
 
-def judge_os(local_specimen_path, filehash_set):
+def open_artifact_store():
+    """ARTIFACT_STORE_DIRを指定した場合はアーティファクトストアを開く。未指定の場合はNone"""
+
+    if not ARTIFACT_STORE_DIR:
+        return None
+    return ArtifactStore(ARTIFACT_STORE_DIR, ARTIFACT_MAX_BYTES, ARTIFACT_MAX_AGE_DAYS * 86400, ARTIFACT_COMPRESSLEVEL)
+
+
+def archive_artifacts(store, local_specimen_path, filehash, pcap_path=None, output_path=None, keep_specimen=False):
+    """検体とその実行結果をアーティファクトストアに圧縮して保存し、作業ディレクトリから削除する
+
+    検体は受信時に計算したSHA-256で保存済みか否かを確かめるため、同じ検体が何度届いても圧縮するのは1度のみ。
+
+    Args:
+        store (ArtifactStore): 保存先のアーティファクトストア
+        local_specimen_path (str): 検体のパス
+        filehash (str): 検体のSHA-256
+        pcap_path (str): 検体の実行中にキャプチャしたpcapのパス
+        output_path (str): VM上での検体の出力のパス
+        keep_specimen (bool): Trueの場合は検体を削除せずに残す（バックフィルで指定したディレクトリの検体など）
+
+    Returns:
+        str: pcapの保存先のパス。pcapがない場合はNone
+    """
+
+    with timed("archive"):
+        store.put(local_specimen_path, SPECIMEN, filehash, sha256=filehash, remove=not keep_specimen)
+        if output_path is not None and os.path.exists(output_path):
+            store.put(output_path, OUTPUT, filehash, remove=True)
+        if pcap_path is not None and os.path.exists(pcap_path):
+            return store.put(pcap_path, PCAP, filehash, remove=True).path
+    return None
+
+
+def archive_logs(store, min_age=86400):
+    """LOGGING_DIRのログファイルのうち、このプロセスが書き込んでおらずmin_age秒以上更新のないものをストアに移す
+
+    同時に動いている他のプロセス（バックフィルなど）が書き込み中のログは、更新時刻が新しいため移さない。
+    """
+
+    current = {getattr(handler, "baseFilename", None) for handler in logging.getLogger().handlers}
+    for filename in sorted(os.listdir(LOGGING_DIR)):
+        path = os.path.abspath(os.path.join(LOGGING_DIR, filename))
+        if filename.endswith(".log") and path not in current and time() - os.path.getmtime(path) >= min_age:
+            store.put(path, LOG, remove=True)
+
+
+def check_near_duplicate(local_specimen_path, filehash, similarity_index):
+    """類似性ハッシュで実行済みの検体に類似するか否かを判定し、SIMILARITY_POLICYに従った扱いを決める
+
+    類似する検体がない場合のみ、その検体を類似性インデックスに登録する。
+    そのため類似する検体の集まりは、最初に実行した1つの検体で代表される。
+
+    Returns:
+        bool: 優先度を下げて実行する場合はTrue、通常どおり実行する場合はFalse、実行しない場合はNone
+    """
+
+    filename = os.path.basename(local_specimen_path)
+    if os.path.getsize(local_specimen_path) > SIMILARITY_MAX_SIZE:
+        return False
+    with timed("similarity"):
+        digest = fuzzy_hash_in_subprocess(local_specimen_path)
+        match = similarity_index.nearest(digest, exclude=filehash)
+    if match is None or match.score < SIMILARITY_THRESHOLD:
+        similarity_index.add(filehash, digest, filename)
+        return False
+
+    logging.info(f"{filename}は実行済みの{match.filename}（{match.sha256}）に類似（類似度: {match.score}）")
+    if SIMILARITY_POLICY == "deprioritize":
+        return True
+    if SIMILARITY_POLICY == "sample" and \
+            similarity_index.count_near_duplicate(match.sha256) % SIMILARITY_SAMPLE_INTERVAL == 0:
+        logging.info(f"{filename}を抜き取りで実行")
+        return False
+    return None
+
+
+def judge_os(local_specimen_path, hash_index, journal=None, similarity_index=None, archive=None):
     """ファイル形式から、実行環境のOSを判定
 
     攻撃者が何度も同じ検体を送信する可能性を考慮し、
     一度実行したファイルは重複しないよう破棄する。
+    実行済みか否かはhash_index（HashIndex）に永続化されるため、再起動後も引き継がれる。
+    内容は異なるが同じファイル名の検体を実行済みの場合は、再投下として優先度を下げる。
+    journal（Journal）を指定した場合は判定結果を記録する。受信時に計算したハッシュ値が記録されていれば
+    それを用いる。前回の起動時にハッシュ値を登録した後で処理を終えられなかった検体は、重複として破棄せずに再開する。
+    similarity_index（SimilarityIndex）を指定した場合は、実行済みの検体に類似する検体を
+    SIMILARITY_POLICYに従って破棄するか、優先度を下げる。
+    archive（archive_artifactsの部分適用）を指定した場合は、実行しない検体をアーティファクトストアに移す。
 
     Returns:
-        Windowsか否か
-        クローン元の仮想マシンのドメインネーム,
-        仮想マシンのユーザ名
-
-        実行する必要がないと判断するときはNoneを返す
+        Judgement: Windowsか否か、クローン元の仮想マシンのドメインネーム、仮想マシンのユーザ名、
+            スケジューラが優先度の判定に用いるファミリ、再投下か否かと類似する検体か否か。
+            実行する必要がないと判断するときはドメインネームがNone
     """
 
     filename = os.path.basename(local_specimen_path)
-    filehash = calcurate_hash(local_specimen_path)
-    if filehash in filehash_set:
+    entry = journal.entry(local_specimen_path) if journal is not None else None
+    filehash = entry.sha256 if entry is not None else None
+    if filehash is None:
+        with timed("hash"):
+            filehash = calcurate_hash(local_specimen_path)
+    resumed = entry is not None and entry.state != FETCHED
+    if journal is not None:
+        journal.hashed(local_specimen_path, filehash)
+    resubmission = not resumed and hash_index.has_filename(filename)
+    if not hash_index.add(filehash, filename) and not resumed:
         logging.info(f"{filename}は実行済みのためスルー")
-        return None, None, None
-    else:
-        filehash_set.add(filehash)
-
-    result = run(["file", local_specimen_path], check=False, text=True, stdout=PIPE)
-    logging.info(f"ファイル形式:  {result.stdout}")
-    tokens = result.stdout.split()
-    if 'HTML' in tokens or 'SGML' in tokens or '(DLL)' in tokens or 'shared' in tokens:
+        SPECIMENS.inc(result="deduplicated")
+        if journal is not None:
+            journal.done(local_specimen_path, "deduplicated")
+        if archive is not None:
+            archive(local_specimen_path, filehash)
+        return SKIP
+
+    with timed("classify"):
+        filetype = classify(local_specimen_path)
+    logging.info(f"ファイル形式:  {filetype.description}")
+    if filetype.profile is None:
         logging.info('ファイルを破棄')
-        return None, None, None
-    elif 'PE32' in tokens:
+        SPECIMENS.inc(result="discarded")
+        if journal is not None:
+            journal.done(local_specimen_path, "discarded")
+        if archive is not None:
+            archive(local_specimen_path, filehash)
+        return SKIP
+    elif filetype.profile.is_windows:
         logging.info("windowsで実行")
-        return True, 'win10_32bit', 'malwa'
-    elif 'ELF' in tokens or 'Bourne-Again' in tokens or 'Perl' in tokens or 'POSIX' in tokens:
-        logging.info("Linuxで実行")
-        return False, 'ubuntu20.04', 'vmuser'
-    elif 'ASCII' in tokens:
-        with open(local_specimen_path) as f:
-            firstline = f.readline()
-            secondline = f.readline()
-        if firstline.startswith("root") and not secondline:
-            logging.info("ファイルを破棄")
-            return None, None, None
-        else:
-            logging.info("Linuxで実行")
-            return False, 'ubuntu20.04', 'vmuser'
     else:
-        logging.info('ファイルを破棄')
-        return None, None, None
+        logging.info("Linuxで実行")
+
+    near_duplicate = False
+    if similarity_index is not None:
+        near_duplicate = check_near_duplicate(local_specimen_path, filehash, similarity_index)
+        if near_duplicate is None:
+            logging.info(f"{filename}は実行済みの検体に類似するためスルー")
+            SPECIMENS.inc(result="near_duplicate")
+            if journal is not None:
+                journal.done(local_specimen_path, "near_duplicate")
+            if archive is not None:
+                archive(local_specimen_path, filehash)
+            return SKIP
+
+    if journal is not None:
+        journal.classified(local_specimen_path, filetype)
+    return Judgement(*filetype.profile, filetype.description, resubmission, near_duplicate)
 
 
 def decide_remote_specimen_path(is_windows, local_specimen_path, vm_username):
@@ -98,8 +226,207 @@ def decide_remote_specimen_path(is_windows, local_specimen_path, vm_username):
         return os.path.join('/home', vm_username, filename)
 
 
+def observation_paths(local_specimen_path, pcap_dir, sensor=None, filehash=None):
+    """検体の実行中の通信を記録するpcapと、VM上での検体の出力を保存するパスを返す
+
+    「pcap_dir/ハニーポットの名前/SHA-256/検体名.pcap」とし、別のハニーポットから届いた検体や、
+    同じ名前で内容の異なる検体のpcapが互いに上書きしないようにする。
+    """
+
+    filename = os.path.basename(local_specimen_path)
+    observation_dir = os.path.join(pcap_dir, *(part for part in (sensor, filehash) if part))
+    return os.path.join(observation_dir, filename + ".pcap"), os.path.join(observation_dir, filename + ".out")
+
+
+def execute_specimen(vm, local_specimen_path, is_windows, vm_username, pcap_dir, sensor=None, filehash=None):
+    """起動済みのVMに検体を転送して実行し、その間の通信をキャプチャする
+
+    ADAPTIVE_OBSERVATIONが有効な場合、検体の終了後に通信が途絶えた時点で観測を打ち切る。
+    実際の観測時間とキャプチャしたパケット数はpcap_dir内のobservation.csvに、
+    VM上での検体の出力はpcapと同じ名前の.outファイルに記録する。
+
+    Args:
+        vm (VM): 検体を実行するVM（with文の内部で渡すこと）
+        local_specimen_path (str): 実行する検体のパス
+        is_windows (bool): Windowsで実行するか否か
+        vm_username (str): 仮想マシンのユーザ名
+        pcap_dir (str): pcapファイルを保存するディレクトリ
+        sensor (str): 検体を受信したハニーポットの名前
+        filehash (str): 検体のSHA-256
+
+    Returns:
+        Observation: 実行結果（ExecutionResult）、pcapファイルのパス、キャプチャしたパケット数と取りこぼした数
+    """
+
+    pcap_path, output_path = observation_paths(local_specimen_path, pcap_dir, sensor, filehash)
+    os.makedirs(os.path.dirname(pcap_path), exist_ok=True)
+    ip_addr, _, interface_name = vm.get_interfaces()
+    # キャプチャと同じフィルタを通過したパケットのみで通信の途絶を判定する
+    traffic_monitor = TrafficMonitor(pcap_path) if ADAPTIVE_OBSERVATION else None
+    capture_filters = [f"({CAPTURE_FILTER})"] if CAPTURE_FILTER else []
+    if EXCLUDE_CONTROL_TRAFFIC:
+        capture_filters.append(control_traffic_filter(ip_addr))
+    # PRE_EXECUTION_TIMEはキャプチャ開始を待つ時間の上限として用いる
+    tcpdump = Tcpdump(pcap_path, interface_name, snaplen=CAPTURE_SNAPLEN,
+                      bpf_filter=" and ".join(capture_filters), ready_timeout=PRE_EXECUTION_TIME)
+    with tcpdump:
+        with SSH(ip_addr, vm_username, KEYFILE_PATH) as ssh:
+            remote_specimen_path = decide_remote_specimen_path(is_windows, local_specimen_path, vm_username)
+            ssh.send_file(local_specimen_path, remote_specimen_path)
+            result = ssh.execute_file(remote_specimen_path, EXECUTION_TIME_LIMIT, traffic_monitor, IDLE_GRACE_TIME,
+                                      output_path, OUTPUT_SIZE_LIMIT)
+
+    # 並列実行時も行が混ざらないよう、1行を1回で書き込む
+    # 1列目はpcap_dirから見たpcapのパス（拡張子を除く）
+    observation_name = os.path.relpath(pcap_path, pcap_dir)[:-len(".pcap")]
+    with open(os.path.join(pcap_dir, "observation.csv"), "a") as f:
+        f.write(
+            f"{observation_name},{result.returncode},{result.observed_time:.1f},{int(result.early_terminated)},"
+            f"{tcpdump.stats.get('captured')},{tcpdump.stats.get('dropped by kernel')}\n"
+        )
+    SPECIMENS.inc(result="processed")
+    return Observation(result, pcap_path, tcpdump.stats.get('captured'), tcpdump.stats.get('dropped by kernel'))
+
+
+def run_specimen(vm, local_specimen_path, is_windows, vm_username, pcap_dir, journal, scheduler, catalog,
+                 archive=None):
+    """ジャーナルに状態を記録しながらexecute_specimenを実行し、結果をカタログに記録する
+
+    SSHの一時的なエラーで失敗した場合は、試行回数がMAX_ATTEMPTSに達するまで実行待ちに戻す。
+    再試行は新たに届いた検体の後に回す。
+    archiveを指定した場合は、処理を終えた検体とpcap・出力をアーティファクトストアに移し、
+    カタログにはストア内のpcapのパスを記録する。
+
+    Args:
+        vm (VM): 検体を実行するVM（with文の内部で渡すこと）
+        journal (Journal): 検体の処理状態を記録するジャーナル
+        scheduler (Scheduler): 再試行する検体を戻すスケジューラ
+        catalog (Catalog): 実行結果を記録するカタログ
+        archive (callable): archive_artifactsの部分適用
+        その他の引数はexecute_specimenと同じ
+    """
+
+    def finish():
+        """pcapと出力をストアに移し、カタログに記録するpcapのパスを返す"""
+
+        if archive is None:
+            return pcap_path if os.path.exists(pcap_path) else None
+        return archive(local_specimen_path, entry.sha256, pcap_path, output_path)
+
+    filename = os.path.basename(local_specimen_path)
+    attempts = journal.running(local_specimen_path)
+    entry = journal.entry(local_specimen_path)
+    pcap_path, output_path = observation_paths(local_specimen_path, pcap_dir, entry.sensor, entry.sha256)
+    details = (entry.sha256, filename, entry.remote_path, entry.file_kind, entry.file_description, vm.domain_name)
+    # 実行中に挙動収集が停止した検体は、再開時にも試行回数に数える
+    if attempts > MAX_ATTEMPTS:
+        logging.warning(f"{filename}は試行回数の上限に達したため実行しません")
+        journal.failed(local_specimen_path, "too many attempts")
+        catalog.add(*details, "failed", pcap_path=finish(), error="too many attempts")
+        return None
+
+    try:
+        observation = execute_specimen(vm, local_specimen_path, is_windows, vm_username, pcap_dir, entry.sensor,
+                                       entry.sha256)
+    except RECONNECTABLE_ERRORS as e:
+        if attempts < MAX_ATTEMPTS:
+            logging.warning(f"{filename}の実行に失敗（{attempts}回目）したため再試行: {e}")
+            journal.retry(local_specimen_path, e)
+            scheduler.put(vm.domain_name, (local_specimen_path, is_windows, vm_username), resubmission=True)
+            return None
+        journal.failed(local_specimen_path, e)
+        catalog.add(*details, "failed", pcap_path=finish(), error=e)
+        raise
+    except Exception as e:
+        journal.failed(local_specimen_path, e)
+        catalog.add(*details, "failed", pcap_path=finish(), error=e)
+        raise
+    journal.done(local_specimen_path)
+    # キャプチャを終えたpcapはこの時点で圧縮してストアに移す
+    observation = observation._replace(pcap_path=finish())
+    catalog.add(*details, "processed", observation.execution, observation.captured, observation.dropped,
+                observation.pcap_path)
+    return observation
+
+
+def open_vm(domain_name, worker_id=None, standby_vms=None):
+    """検体を実行するVMをwith文で扱えるオブジェクトとして返す
+
+    Args:
+        domain_name (str): 実行環境のVM（クローンの場合はクローン元）のドメインネーム
+        worker_id (int): 指定した場合、その番号のクローンVMを用意する
+        standby_vms (dict): ドメインネームをキーとするStandbyVMの辞書。指定した場合は準備済みのVMを使う
+    """
+
+    if worker_id is not None:
+        return clone_vm(domain_name, worker_id)
+    if standby_vms:
+        return standby_vms[domain_name].acquire()
+    return VM(domain_name)
+
+
+def close_standby_vms(standby_vms):
+    """スタンバイのVMをすべてスナップショットの状態に戻す。1台で失敗しても残りは戻す"""
+
+    for domain_name, standby_vm in standby_vms.items():
+        try:
+            standby_vm.close()
+        except Exception as e:
+            logging.error(f"{domain_name}のスタンバイのVMを戻せませんでした: {e}")
+
+
+def prepare_workers():
+    """検体を実行するVMを用意し、OSごとのワーカー数とVMを開く関数を返す
+
+    settings.WORKER_NUMSのいずれかが1以上の場合は、OSごとにその数だけクローンVMを用意し、
+    複数の検体を並列に実行する。すべて0の場合はOSごとに1台のVMでスナップショットを用いて実行する。
+    スタンバイのVMは裏で準備を続けるため、終了時は必ず返したclose_vmsを呼ぶこと。
+
+    Returns:
+        dict: ドメインネームごとのワーカー数
+        callable: vm_factory(domain_name, worker_id)で、検体を実行するVMを返す関数
+        callable: close_vms()で、スタンバイのVMをスナップショットの状態に戻す関数
+    """
+
+    # クローンを用いる場合、クローン元のVMは停止している必要がある
+    use_clone = any(WORKER_NUMS.values())
+    if not use_clone:
+        # はじめにVMをすべて起動
+        for domain_name in DOMAIN_NAMES:
+            VM.start_if_shutoff(domain_name)
+
+    # スタンバイモードでは、VMの復元とIPアドレスの取得を次の検体の受信と並行して行う
+    standby_vms = {}
+    close_vms = partial(close_standby_vms, standby_vms)
+    if not use_clone and USE_STANDBY_VM:
+        try:
+            for domain_name in DOMAIN_NAMES:
+                standby_vms[domain_name] = StandbyVM(domain_name)
+        except BaseException:
+            # 準備を始めたVMは戻してから送出する
+            close_vms()
+            raise
+
+    if use_clone:
+        worker_nums = {domain_name: num for domain_name, num in WORKER_NUMS.items() if num > 0}
+        return worker_nums, open_vm, close_vms
+
+    # スナップショットを用いる場合もOSごとにワーカーを1つ割り当て、各OSのVMが独立して検体を消化する
+    worker_nums = {domain_name: 1 for domain_name in DOMAIN_NAMES}
+
+    def vm_factory(domain_name, worker_id):
+        return open_vm(domain_name, standby_vms=standby_vms)
+
+    return worker_nums, vm_factory, close_vms
+
+
 def behavior_collection():
-    """挙動収集の一連の動作の反復"""
+    """挙動収集の一連の動作の反復
+
+    VMの用意はprepare_workersを参照。
+    実行待ちの検体はSchedulerがOSごとに保持し、初めて見るファミリの検体を優先して実行する。
+    USE_PIPELINEが有効な場合は、検体の受信・判定・実行をasyncioのパイプラインで並行して行う。
+    """
 
     stop_stp()
     add_qdisc_rule()
@@ -109,59 +436,332 @@ def behavior_collection():
 
     logging.info("start behaviour collection")
 
-    # はじめにVMをすべて起動
-    VM.start_if_shutoff("win10_32bit")
-    VM.start_if_shutoff("ubuntu20.04")
+    if METRICS_TEXTFILE_PATH:
+        start_textfile_exporter(METRICS_TEXTFILE_PATH)
+    if METRICS_HTTP_PORT:
+        start_http_server(METRICS_HTTP_PORT)
+
+    worker_nums, vm_factory, close_vms = prepare_workers()
+    try:
+        hash_index = HashIndex(HASH_INDEX_PATH)
+        # 前回処理を終えられなかった検体は、ジャーナルから読み込んで最初に処理する
+        journal = Journal(JOURNAL_PATH)
+        catalog = Catalog(CATALOG_PATH)
+        if SIMILARITY_POLICY not in ("off", "skip", "deprioritize", "sample"):
+            raise ValueError(f"SIMILARITY_POLICYが不正です: {SIMILARITY_POLICY}")
+        similarity_index = SimilarityIndex(SIMILARITY_INDEX_PATH) if SIMILARITY_POLICY != "off" else None
+        # 処理を終えた検体と実行結果は、アーティファクトストアに圧縮して移す
+        store = open_artifact_store()
+        archive = partial(archive_artifacts, store) if store is not None else None
+        if store is not None:
+            archive_logs(store)
+        # ハニーポットごとのスレッドで受信し、1つのキューにまとめる
+        default_honeypot = Honeypot(HONEYPOT_IP_ADDR, HONEYPOT_IP_ADDR, int(HONEYPOT_SSH_PORT or 22),
+                                    HONEYPOT_USER_NAME, KEYFILE_PATH, HONEYPOT_SPECIMEN_DIRS, False)
+        honeypots = load_honeypots(HONEYPOTS_FILE, default_honeypot) if HONEYPOTS_FILE else [default_honeypot]
+        ingester = MultiIngester(honeypots, specimen_dir, POLLING_INTERVAL_MIN, POLLING_INTERVAL_MAX, journal,
+                                 hash_index)
+        ingester.start()
+
+        # 実行待ちの検体はOSごとに優先度を付けて保持する
+        scheduler = Scheduler(worker_nums, SCHEDULER_AGING, SCHEDULER_CAPACITY)
+        analyze = partial(run_specimen, pcap_dir=pcap_dir, journal=journal, scheduler=scheduler, catalog=catalog,
+                          archive=archive)
+
+        if USE_PIPELINE:
+            def execute(domain_name, slot, local_specimen_path, is_windows, vm_username):
+                with vm_factory(domain_name, slot) as vm:
+                    analyze(vm, local_specimen_path, is_windows, vm_username)
+
+            pipeline = CollectionPipeline(
+                lambda: ingester.get()[0],
+                lambda local_specimen_path: judge_os(local_specimen_path, hash_index, journal, similarity_index,
+                                                     archive),
+                execute,
+                worker_nums,
+                scheduler=scheduler,
+            )
+            asyncio.run(pipeline.run())
+            return
+
+        QUEUE_DEPTH.set_function(
+            lambda: {(domain_name,): depth for domain_name, depth in scheduler.depths().items()})
+        pool = WorkerPool(worker_nums, analyze, vm_factory, scheduler)
+        pool.start()
+
+        while True:
+            try:
+                # まず検体をハニーポットから転送。書き込みが完了した検体のみがまとめて転送される
+                local_specimen_path, _ = ingester.get()
+                logging.info(f"ハニーポットごとの受信状況: {ingester.stats()}")
+
+                judgement = judge_os(local_specimen_path, hash_index, journal, similarity_index, archive)
+                if judgement.domain_name is None:
+                    continue
+
+                # 空いているワーカーに実行を任せ、次の検体の受信に移る
+                pool.submit(judgement.domain_name, local_specimen_path, judgement.is_windows, judgement.vm_username,
+                            family=judgement.family, resubmission=judgement.resubmission,
+                            near_duplicate=judgement.near_duplicate)
+            except Exception as e:
+                log_collection_error(e)
+    finally:
+        close_vms()
+
+
+def walk_specimens(dir_paths):
+    """ディレクトリ以下のファイルをすべて列挙する。ファイルを指定した場合はそのファイルのみ
+
+    受信中のファイル（.で始まるもの、.partで終わるもの）と、--from-storeで展開した
+    SPECIMEN_BASE_DIR/backfill以下の検体は含めない。
 
-    filehash_set = set()
+    Returns:
+        list(str): ファイルパスのリスト（パスの順）
+    """
+
+    extracted_dir = os.path.realpath(os.path.join(SPECIMEN_BASE_DIR, "backfill"))
+    paths = []
+    for dir_path in dir_paths:
+        if os.path.isfile(dir_path):
+            paths.append(dir_path)
+            continue
+        for root, dirnames, filenames in os.walk(dir_path):
+            dirnames[:] = [dirname for dirname in dirnames
+                           if os.path.realpath(os.path.join(root, dirname)) != extracted_dir]
+            paths.extend(os.path.join(root, filename) for filename in filenames
+                         if not filename.startswith(".") and not filename.endswith(".part"))
+    return sorted(paths)
+
+
+def report_progress(journal, total, started, baseline, stopped, interval):
+    """バックフィルの進捗とスループットを、stoppedがセットされるまでinterval秒ごとにログに出力する
+
+    Args:
+        journal (Journal): バックフィルのジャーナル
+        total (int): バックフィルの対象の検体の数
+        started (float): バックフィルを開始したperf_counterの値
+        baseline (int): 開始時点で処理を終えていた検体の数
+        stopped (threading.Event): 出力を止めるイベント
+        interval (float): 出力する間隔（秒）
+    """
 
     while True:
-        try:
-            # まず検体をハニーポットから転送　Todo: 書き込み中のファイルを転送してしまう問題をどうするか
-            with SSH(HONEYPOT_IP_ADDR, HONEYPOT_USER_NAME, KEYFILE_PATH, HONEYPOT_SSH_PORT) as ssh:
-                local_specimen_path, honeypot_specimen_path = ssh.wait_until_receive(specimen_dir, HONEYPOT_SPECIMEN_DIRS)
-                ssh.remove_specimen(honeypot_specimen_path)
-
-            is_windows, domain_name, vm_username = judge_os(local_specimen_path, filehash_set)
-            if domain_name is not None:
-                # Tcpdumpを開始しVM内で実行
-                with VM(domain_name) as vm:
-                    pcap_path = os.path.join(pcap_dir, os.path.basename(local_specimen_path) + ".pcap")
-                    ip_addr, _, interface_name = vm.get_interfaces()
-                    with Tcpdump(pcap_path, interface_name, PRE_EXECUTION_TIME):
-                        with SSH(ip_addr, vm_username, KEYFILE_PATH) as ssh:
-                            remote_specimen_path = decide_remote_specimen_path(is_windows, local_specimen_path, vm_username)
-                            ssh.send_file(local_specimen_path, remote_specimen_path)
-                            ssh.execute_file(remote_specimen_path, EXECUTION_TIME_LIMIT)
-        except EOFError as e:
-            logging.error(f"pattern1: {e}が発生。挙動収集は続行。")
-        except SSHException as e:
-            logging.error(f"pattern2: {e}が発生。挙動収集は続行。")
-        except Exception as e:
-            logging.error(f"pattern3: {e}が発生。挙動収集は続行。")
+        counts = journal.counts()
+        finished = counts.get(DONE, 0) + counts.get(FAILED, 0)
+        elapsed = perf_counter() - started
+        per_hour = (finished - baseline) / elapsed * 3600 if elapsed else 0
+        remaining = total - finished
+        eta = f"残り約{remaining / per_hour:.1f}時間" if per_hour else "残り時間不明"
+        logging.info(f"バックフィル: {finished}/{total}個を処理（{counts}）、{per_hour:.1f}個/時、{eta}")
+        if stopped.is_set():
+            return
+        stopped.wait(interval)
+
+
+def backfill(argv):
+    """保存済みの検体をディレクトリごと読み込み、空いているVMに振り分けて実行し直す
+
+    新しい実行環境を追加した場合や、過去の検体のpcapを取り直す場合に用いる。
+    進捗は挙動収集とは別のジャーナルに記録するため、中断しても同じジャーナルを指定して再実行すれば
+    処理を終えた検体を飛ばして再開できる。同じ内容の検体は1度だけ実行する。
+    実行結果は挙動収集と同じカタログに記録する。
+    --from-storeを指定した場合は、アーティファクトストアの検体を実行するたびに展開し、処理を終えた時点で削除する。
+    実行待ちの検体がOSごとの上限に達している間は次の検体を展開しないため、展開済みの検体はワーカー数と上限の分に収まる。
+    アーティファクトストアを用いる場合、pcapと出力はストアに移し、指定したディレクトリの検体は削除せずに残す。
+    """
+
+    parser = argparse.ArgumentParser(prog="main.py backfill", description="保存済みの検体をまとめて実行し直す")
+    parser.add_argument("paths", nargs="*", default=[SPECIMEN_BASE_DIR],
+                        help="検体のディレクトリもしくはファイル（省略時はSPECIMEN_BASE_DIR）")
+    parser.add_argument("--checkpoint", default=BACKFILL_JOURNAL_PATH,
+                        help="進捗を記録するジャーナルのパス。同じパスを指定すると続きから再開する")
+    parser.add_argument("--since", type=parse_time,
+                        help="この日時以降に実行を終えたとカタログに記録されている検体は実行しない（例: 7d, 2024-01-01）")
+    parser.add_argument("--report-interval", type=float, default=60, help="進捗をログに出力する間隔（秒）")
+    parser.add_argument("--from-store", action="store_true",
+                        help="ディレクトリの代わりにアーティファクトストアに保存した検体を実行し直す")
+    args = parser.parse_args(argv)
+    store = open_artifact_store()
+    if args.from_store and store is None:
+        parser.error("--from-storeにはARTIFACT_STORE_DIRの指定が必要です")
+
+    stop_stp()
+    add_qdisc_rule()
+
+    pcap_dir = mk_datetime_dir(os.path.join(PCAP_BASE_DIR, "backfill"))
+
+    if METRICS_TEXTFILE_PATH:
+        start_textfile_exporter(METRICS_TEXTFILE_PATH)
+    if METRICS_HTTP_PORT:
+        start_http_server(METRICS_HTTP_PORT)
+
+    journal = Journal(args.checkpoint)
+    catalog = Catalog(CATALOG_PATH)
+    # 挙動収集のハッシュインデックスにはすべての検体が登録済みのため、処理を終えた検体はジャーナルとカタログから判定する
+    hash_index = HashIndex(":memory:")
+    for local_specimen_path, filehash in journal.completed():
+        hash_index.add(filehash, os.path.basename(local_specimen_path))
+    if args.since is not None:
+        for record in catalog.query(None, since=args.since, result="processed"):
+            hash_index.add(record.sha256, record.filename)
+
+    # ストアの検体はSHA-256ごとに最初に保存した名前で展開する。展開先のパスが変わらないため、ジャーナルで再開できる
+    stored_specimens = {}
+    if args.from_store:
+        names = {}
+        for artifact in store.artifacts(SPECIMEN):
+            names.setdefault(artifact.sha256, artifact.name)
+        stored_specimens = {os.path.join(SPECIMEN_BASE_DIR, "backfill", sha256, name): sha256
+                            for sha256, name in names.items()}
+        local_specimen_paths = sorted(stored_specimens)
+    else:
+        local_specimen_paths = walk_specimens(args.paths)
+    counts = journal.counts()
+    baseline = counts.get(DONE, 0) + counts.get(FAILED, 0)
+    logging.info(f"バックフィルを開始: {len(local_specimen_paths)}個の検体（処理済み: {baseline}個）")
+
+    worker_nums, vm_factory, close_vms = prepare_workers()
+    try:
+        # ストアから展開する場合は、上限を指定していなくてもワーカー数の分を超えて展開しないようにする
+        capacity = SCHEDULER_CAPACITY or (max(worker_nums.values()) if args.from_store else 0)
+        scheduler = Scheduler(worker_nums, SCHEDULER_AGING, capacity)
+        archive = partial(archive_artifacts, store, keep_specimen=not args.from_store) if store is not None else None
+        analyze = partial(run_specimen, pcap_dir=pcap_dir, journal=journal, scheduler=scheduler, catalog=catalog,
+                          archive=archive)
+        pool = WorkerPool(worker_nums, analyze, vm_factory, scheduler)
+        pool.start()
+
+        stopped = threading.Event()
+        reporter = threading.Thread(target=report_progress, name="backfill-report", daemon=True, args=(
+            journal, len(local_specimen_paths), perf_counter(), baseline, stopped, args.report_interval))
+        reporter.start()
+
+        for local_specimen_path in local_specimen_paths:
+            try:
+                entry = journal.entry(local_specimen_path)
+                if entry is not None and entry.state not in PENDING_STATES:
+                    continue
+                if local_specimen_path in stored_specimens and not os.path.exists(local_specimen_path):
+                    os.makedirs(os.path.dirname(local_specimen_path), exist_ok=True)
+                    store.extract(stored_specimens[local_specimen_path], local_specimen_path)
+                if entry is None:
+                    journal.fetched(local_specimen_path, None, stored_specimens.get(local_specimen_path))
+                judgement = judge_os(local_specimen_path, hash_index, journal, archive=archive)
+                if judgement.domain_name is None:
+                    continue
+                # 実行待ちの検体が上限に達している間はここで待機し、次の検体を展開しない
+                submitted = pool.submit(judgement.domain_name, local_specimen_path, judgement.is_windows,
+                                        judgement.vm_username, family=judgement.family,
+                                        resubmission=judgement.resubmission)
+                if not submitted and local_specimen_path in stored_specimens:
+                    # 実行するワーカーのない検体は、展開したまま残さない
+                    os.remove(local_specimen_path)
+            except Exception as e:
+                log_collection_error(e)
+
+        # 実行待ちの検体をすべて処理し終えるまで待つ
+        pool.shutdown()
+        stopped.set()
+        reporter.join()
+    finally:
+        close_vms()
+    logging.info("バックフィルを終了")
+    journal.close()
+    catalog.close()
+    if store is not None:
+        store.close()
 
 
 def interactive_vm(local_specimen_path):
+    """1つの検体をVMに転送し、手動で操作できる状態にする。Enterを押すとVMを元の状態に戻す"""
+
     stop_stp()
-    is_windows, domain_name, vm_username = judge_os(local_specimen_path)
-    vm = VM(domain_name)
-    vm.__enter__()
-    ip_addr, *_ = vm.get_interfaces()
-    with SSH(ip_addr, vm_username, KEYFILE_PATH) as ssh:
-        remote_specimen_path = decide_remote_specimen_path(is_windows, local_specimen_path, vm_username)
-        ssh.send_file(local_specimen_path, remote_specimen_path)
-    return
+    # 実行済みか否かにかかわらず転送するため、挙動収集のハッシュインデックスは用いない
+    with HashIndex(":memory:") as hash_index:
+        judgement = judge_os(local_specimen_path, hash_index)
+    if judgement.domain_name is None:
+        print(f"{local_specimen_path}はVMで実行できる形式ではありません", file=sys.stderr)
+        return
+
+    VM.start_if_shutoff(judgement.domain_name)
+    with VM(judgement.domain_name) as vm:
+        ip_addr, *_ = vm.get_interfaces()
+        remote_specimen_path = decide_remote_specimen_path(judgement.is_windows, local_specimen_path,
+                                                           judgement.vm_username)
+        with SSH(ip_addr, judgement.vm_username, KEYFILE_PATH) as ssh:
+            ssh.send_file(local_specimen_path, remote_specimen_path)
+        input(f"{ip_addr}の{remote_specimen_path}に転送しました。Enterを押すとVMを元の状態に戻します")
+
+
+def parse_time(value):
+    """reportの期間指定をUNIX時間に変換する。7d・12h・30mのような相対指定か、ISO 8601形式の日時を受け付ける"""
+
+    units = {"d": 86400, "h": 3600, "m": 60}
+    if value[-1:] in units and value[:-1].isdigit():
+        return time() - int(value[:-1]) * units[value[-1]]
+    return datetime.fromisoformat(value).timestamp()
+
+
+def report(argv):
+    """カタログを検索し、結果を標準出力に表示する"""
+
+    parser = argparse.ArgumentParser(prog="main.py report", description="実行した検体のカタログを検索する")
+    parser.add_argument("--type", dest="file_kind", help="ファイル形式の種類（pe32, elf, script など）")
+    parser.add_argument("--domain", dest="domain_name", help="実行したVMのドメインネーム")
+    parser.add_argument("--since", type=parse_time, help="この日時以降に実行を終えたもの（例: 7d, 2024-01-01）")
+    parser.add_argument("--until", type=parse_time, help="この日時より前に実行を終えたもの")
+    parser.add_argument("--nonzero", action="store_true", help="終了コードが0以外のもの")
+    parser.add_argument("--timeout", dest="timed_out", action="store_const", const=True,
+                        help="実行時間制限に達したもの")
+    parser.add_argument("--sha256", help="検体のSHA-256")
+    parser.add_argument("--result", choices=("processed", "failed"), help="処理結果")
+    parser.add_argument("--limit", type=int, default=100, help="表示する行数の上限（0で無制限）")
+    parser.add_argument("--summary", metavar="COLUMNS",
+                        help=f"カンマ区切りの列ごとに件数を集計する（{', '.join(GROUP_COLUMNS)}）")
+    parser.add_argument("--catalog", default=CATALOG_PATH, help="カタログのパス")
+    args = parser.parse_args(argv)
+
+    filters = {name: getattr(args, name) for name in
+               ("file_kind", "domain_name", "since", "until", "nonzero", "timed_out", "sha256", "result")}
+    start = perf_counter()
+    with Catalog(args.catalog) as catalog:
+        if args.summary:
+            rows = catalog.summary(args.summary.split(","), **filters)
+        else:
+            rows = catalog.query(args.limit or None, **filters)
+    elapsed = perf_counter() - start
+
+    for row in rows:
+        if args.summary:
+            print("\t".join(map(str, row)))
+            continue
+        returncode = "timeout" if row.timed_out else row.returncode
+        print("\t".join(map(str, (
+            datetime.fromtimestamp(row.finished).strftime("%Y-%m-%d %H:%M:%S"), row.sha256, row.filename,
+            row.file_kind, row.domain_name, row.result, returncode, row.observed_time, row.captured,
+            row.pcap_size, row.pcap_path,
+        ))))
+    print(f"{len(rows)}件（{elapsed * 1000:.1f}ms）", file=sys.stderr)
 
 
 if __name__ == "__main__":
 
+    if sys.argv[1:2] == ["report"]:
+        report(sys.argv[2:])
+        sys.exit()
+
     logging.basicConfig(
         filename=os.path.join(LOGGING_DIR, datetime.now().strftime("%Y-%m-%d-%H-%M.log")),
         format="%(levelname)s - %(asctime)s - %(message)s",
         level=logging.INFO
     )
 
-    if len(sys.argv) == 2:
+    if sys.argv[1:2] == ["backfill"]:
+        # 進捗を確認できるよう、ログを標準エラー出力にも表示する
+        logging.getLogger().addHandler(logging.StreamHandler())
+        backfill(sys.argv[2:])
+
+    elif len(sys.argv) == 2:
         interactive_vm(sys.argv[1])
 
     else:
@@ -0,0 +1,195 @@
+import logging
+import os
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, sleep
+
+# 処理時間のヒストグラムのバケット（秒）
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# 登録されたすべてのメトリクス
+REGISTRY = []
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+class Counter:
+    """単調増加するカウンタ"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = defaultdict(float)
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self.lock:
+            self.values[key] += amount
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge:
+    """任意に増減する値。set_functionで出力時に値を計算することもできる"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        self.function = None
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def set(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, function):
+        """出力時に呼び出す関数を登録する。関数はラベルの値のタプルをキー、値を値とする辞書を返す"""
+
+        self.function = function
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        with self.lock:
+            values = dict(self.values)
+        if self.function is not None:
+            values.update(self.function())
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    """観測値の分布を累積バケットで集計する"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets) + (float("inf"),)
+        # ラベルの値のタプルをキー、[各バケットの件数, 合計, 件数]を値とする
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self.lock:
+            counts, total, count = self.values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                    lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+STAGE_DURATION = Histogram("ambc_stage_duration_seconds", "各段階の所要時間", ("stage",))
+SPECIMENS = Counter("ambc_specimens_total", "検体の処理結果ごとの件数", ("result",))
+FAILURES = Counter("ambc_failed_total", "挙動収集中に例外が発生した件数（ログのpatternごと）", ("pattern",))
+QUEUE_DEPTH = Gauge("ambc_queue_depth", "パイプラインの各段階の前で待っている検体の数", ("stage",))
+INGESTED = Counter("ambc_ingested_total", "ハニーポットごとの受信した検体の数", ("sensor",))
+INGESTED_BYTES = Counter("ambc_ingested_bytes_total", "ハニーポットごとの受信した検体の合計サイズ", ("sensor",))
+INGEST_SKIPPED = Counter("ambc_ingest_skipped_total", "ハニーポットごとの実行済みのため受信しなかった検体の数", ("sensor",))
+INGEST_ERRORS = Counter("ambc_ingest_errors_total", "ハニーポットごとのポーリング・受信に失敗した回数", ("sensor",))
+
+
+@contextmanager
+def timed(stage):
+    """with文の内部の所要時間をSTAGE_DURATIONに記録する"""
+
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_DURATION.observe(perf_counter() - start, stage=stage)
+
+
+def render():
+    """登録されたすべてのメトリクスをPrometheusのテキスト形式で返す"""
+
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path):
+    """メトリクスをファイルに書き出す。node_exporterのtextfile collectorが読みかけのファイルを読まないよう、置き換えで書き出す"""
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(render())
+    os.replace(tmp_path, path)
+
+
+def start_textfile_exporter(path, interval=15):
+    """interval秒ごとにメトリクスをファイルに書き出すスレッドを開始する"""
+
+    def export():
+        while True:
+            try:
+                write_textfile(path)
+            except OSError as e:
+                logging.warning(f"メトリクスを{path}に書き出せませんでした: {e}")
+            sleep(interval)
+
+    threading.Thread(target=export, name="metrics-textfile", daemon=True).start()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, addr="127.0.0.1"):
+    """/metricsでメトリクスを返すHTTPサーバをバックグラウンドで開始する"""
+
+    server = ThreadingHTTPServer((addr, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logging.info(f"メトリクスを http://{addr}:{port}/metrics で公開")
+    return server
@@ -0,0 +1,327 @@
+import gzip
+import logging
+import mmap
+import os
+import socket
+import sqlite3
+import struct
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+# pcapのマジックナンバーと、(エンディアン, タイムスタンプの小数部の単位)
+PCAP_MAGICS = {
+    b"\xd4\xc3\xb2\xa1": ("<", 1e-6),
+    b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+    b"\x4d\x3c\xb2\xa1": ("<", 1e-9),
+    b"\xa1\xb2\x3c\x4d": (">", 1e-9),
+}
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+
+DNS_PORT = 53
+DNS_TYPES = {1: "A", 5: "CNAME", 28: "AAAA"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pcaps (
+    path TEXT PRIMARY KEY, sha256 TEXT, size INTEGER, mtime REAL, packets INTEGER
+);
+CREATE TABLE IF NOT EXISTS flows (
+    path TEXT, sha256 TEXT, proto INTEGER, src TEXT, sport INTEGER, dst TEXT, dport INTEGER,
+    packets INTEGER, bytes INTEGER, first_seen REAL, last_seen REAL
+);
+CREATE TABLE IF NOT EXISTS dns (
+    path TEXT, sha256 TEXT, qname TEXT, rtype TEXT, answer TEXT
+);
+CREATE INDEX IF NOT EXISTS flows_sha256 ON flows (sha256);
+CREATE INDEX IF NOT EXISTS flows_dst ON flows (dst);
+CREATE INDEX IF NOT EXISTS flows_dport ON flows (dport);
+CREATE INDEX IF NOT EXISTS flows_path ON flows (path);
+CREATE INDEX IF NOT EXISTS dns_sha256 ON dns (sha256);
+CREATE INDEX IF NOT EXISTS dns_qname ON dns (qname);
+CREATE INDEX IF NOT EXISTS dns_answer ON dns (answer);
+CREATE INDEX IF NOT EXISTS dns_path ON dns (path);
+"""
+
+
+def summarize_pcap(pcap_path):
+    """pcapをメモリマップして先頭から順に解析し、フローとDNSの要約を返す
+
+    ファイル全体を読み込まず、mmap上のmemoryviewからヘッダを直接解析する。
+    アーティファクトストアに保存したgzip圧縮のpcap（.gz）は、展開しながらパケットごとに読み込む。
+
+    Returns:
+        flows (dict): (プロトコル番号, 送信元, 送信元ポート, 宛先, 宛先ポート)をキー、
+            [パケット数, バイト数, 最初の時刻, 最後の時刻]を値とする辞書
+        dns (set): (問い合わせ名, レコードの種類, 回答)の集合。問い合わせのみの場合、回答はNone
+        packets (int): パケット数
+    """
+
+    flows = {}
+    dns = set()
+    packets = 0
+    if pcap_path.endswith(".gz"):
+        with gzip.open(pcap_path, "rb") as f:
+            packets = _summarize_stream(f, pcap_path, flows, dns)
+        return flows, dns, packets
+    if os.path.getsize(pcap_path) < 24:
+        return flows, dns, packets
+
+    with open(pcap_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        buf = memoryview(mm)
+        try:
+            if bytes(buf[:4]) not in PCAP_MAGICS:
+                logging.warning(f"{pcap_path}はpcap形式ではありません")
+                return flows, dns, packets
+            endian, ts_unit = PCAP_MAGICS[bytes(buf[:4])]
+            linktype, = struct.unpack_from(endian + "I", buf, 20)
+            record = struct.Struct(endian + "IIII")
+
+            offset = 24
+            while offset + 16 <= len(buf):
+                ts_sec, ts_frac, incl_len, orig_len = record.unpack_from(buf, offset)
+                offset += 16
+                if offset + incl_len > len(buf):
+                    # キャプチャ中のファイルの末尾
+                    break
+                packets += 1
+                try:
+                    _parse_packet(buf[offset:offset + incl_len], linktype, ts_sec + ts_frac * ts_unit, orig_len,
+                                  flows, dns)
+                except (struct.error, IndexError, ValueError):
+                    # snaplenで切り詰められたパケットや壊れたパケット
+                    pass
+                offset += incl_len
+        finally:
+            buf.release()
+
+    return flows, dns, packets
+
+
+def _summarize_stream(f, pcap_path, flows, dns):
+    """ファイルオブジェクトからpcapを順に読み込んで解析し、パケット数を返す"""
+
+    header = f.read(24)
+    if len(header) < 24:
+        return 0
+    if header[:4] not in PCAP_MAGICS:
+        logging.warning(f"{pcap_path}はpcap形式ではありません")
+        return 0
+    endian, ts_unit = PCAP_MAGICS[header[:4]]
+    linktype, = struct.unpack_from(endian + "I", header, 20)
+    record = struct.Struct(endian + "IIII")
+
+    packets = 0
+    while True:
+        record_header = f.read(16)
+        if len(record_header) < 16:
+            break
+        ts_sec, ts_frac, incl_len, orig_len = record.unpack(record_header)
+        packet = f.read(incl_len)
+        if len(packet) < incl_len:
+            # 途中で切れたファイルの末尾
+            break
+        packets += 1
+        try:
+            _parse_packet(memoryview(packet), linktype, ts_sec + ts_frac * ts_unit, orig_len, flows, dns)
+        except (struct.error, IndexError, ValueError):
+            pass
+    return packets
+
+
+def _parse_packet(packet, linktype, timestamp, length, flows, dns):
+    """1パケットを解析し、flowsとdnsを更新する"""
+
+    if linktype == LINKTYPE_ETHERNET:
+        ethertype, = struct.unpack_from("!H", packet, 12)
+        offset = 14
+        while ethertype in (0x8100, 0x88a8):  # VLANタグ
+            ethertype, = struct.unpack_from("!H", packet, offset + 2)
+            offset += 4
+    elif linktype == LINKTYPE_LINUX_SLL:
+        ethertype, = struct.unpack_from("!H", packet, 14)
+        offset = 16
+    elif linktype == LINKTYPE_RAW:
+        ethertype = 0x0800 if packet[0] >> 4 == 4 else 0x86dd
+        offset = 0
+    else:
+        return
+
+    if ethertype == 0x0800:
+        ihl = (packet[offset] & 0x0f) * 4
+        fragment, = struct.unpack_from("!H", packet, offset + 6)
+        proto = packet[offset + 9]
+        src = socket.inet_ntop(socket.AF_INET, packet[offset + 12:offset + 16])
+        dst = socket.inet_ntop(socket.AF_INET, packet[offset + 16:offset + 20])
+        # 先頭以外のフラグメントにはポート番号が含まれない
+        l4_offset = offset + ihl if fragment & 0x1fff == 0 else None
+    elif ethertype == 0x86dd:
+        proto = packet[offset + 6]
+        src = socket.inet_ntop(socket.AF_INET6, packet[offset + 8:offset + 24])
+        dst = socket.inet_ntop(socket.AF_INET6, packet[offset + 24:offset + 40])
+        l4_offset = offset + 40
+    else:
+        return
+
+    sport = dport = 0
+    if proto in (6, 17) and l4_offset is not None:
+        sport, dport = struct.unpack_from("!HH", packet, l4_offset)
+
+    key = (proto, src, sport, dst, dport)
+    flow = flows.get(key)
+    if flow is None:
+        flows[key] = [1, length, timestamp, timestamp]
+    else:
+        flow[0] += 1
+        flow[1] += length
+        flow[3] = timestamp
+
+    if proto == 17 and DNS_PORT in (sport, dport):
+        _parse_dns(packet, l4_offset + 8, dns)
+
+
+def _read_name(packet, offset, start):
+    """DNSの名前を読み、(名前, 名前の直後のオフセット)を返す。圧縮ポインタにも対応する"""
+
+    labels = []
+    end = None
+    for _ in range(128):  # ポインタのループ対策
+        length = packet[offset]
+        if length & 0xc0 == 0xc0:
+            pointer, = struct.unpack_from("!H", packet, offset)
+            if end is None:
+                end = offset + 2
+            offset = start + (pointer & 0x3fff)
+        elif length == 0:
+            return ".".join(labels).lower(), end if end is not None else offset + 1
+        else:
+            labels.append(bytes(packet[offset + 1:offset + 1 + length]).decode("ascii", errors="replace"))
+            offset += 1 + length
+    raise ValueError("DNSの名前のポインタがループしています")
+
+
+def _parse_dns(packet, start, dns):
+    """DNSメッセージの問い合わせとA/AAAA/CNAMEの回答をdnsに追加する"""
+
+    flags, qdcount, ancount = struct.unpack_from("!HHH", packet, start + 2)
+    offset = start + 12
+    for _ in range(qdcount):
+        qname, offset = _read_name(packet, offset, start)
+        qtype, = struct.unpack_from("!H", packet, offset)
+        offset += 4
+        if not flags & 0x8000:
+            dns.add((qname, DNS_TYPES.get(qtype, str(qtype)), None))
+
+    for _ in range(ancount):
+        name, offset = _read_name(packet, offset, start)
+        rtype, _, _, rdlength = struct.unpack_from("!HHIH", packet, offset)
+        offset += 10
+        if rtype == 1 and rdlength == 4:
+            dns.add((name, "A", socket.inet_ntop(socket.AF_INET, packet[offset:offset + 4])))
+        elif rtype == 28 and rdlength == 16:
+            dns.add((name, "AAAA", socket.inet_ntop(socket.AF_INET6, packet[offset:offset + 16])))
+        elif rtype == 5:
+            dns.add((name, "CNAME", _read_name(packet, offset, start)[0]))
+        offset += rdlength
+
+
+class PcapIndex:
+    """pcapから抽出したフローとDNSの要約を検体のハッシュ値ごとに保存し、検索できるようにする"""
+
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.conn.close()
+
+    def update(self, catalog, max_workers=None):
+        """カタログに記録されたpcapのうち、未登録もしくは更新されたものを並列に解析して登録する
+
+        pcapに対応する検体のSHA-256はカタログの記録から得るため、pcapの置き場所（PCAP_BASE_DIR以下の
+        ハニーポットごとのディレクトリや、アーティファクトストアに圧縮して保存したもの）によらない。
+
+        Args:
+            catalog (Catalog): 実行記録のカタログ
+            max_workers (int): 解析に用いるプロセス数。Noneの場合はCPUの数
+
+        Returns:
+            int: 新たに解析したpcapの数
+        """
+
+        indexed = {path: (size, mtime) for path, size, mtime in self.conn.execute("SELECT path, size, mtime FROM pcaps")}
+        hashes = catalog.pcaps()
+        targets = []
+        for path in hashes:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # 保存期間を過ぎて削除されたpcapや、別のホストで記録されたpcap
+                continue
+            if indexed.get(path) != (stat.st_size, stat.st_mtime):
+                targets.append((path, stat.st_size, stat.st_mtime))
+
+        if not targets:
+            return 0
+        logging.info(f"{len(targets)}個のpcapを解析")
+
+        with ProcessPoolExecutor(max_workers) as executor:
+            summaries = executor.map(summarize_pcap, [path for path, *_ in targets], chunksize=8)
+            for (path, size, mtime), (flows, dns, packets) in zip(targets, summaries):
+                with self.conn:
+                    self.__store(path, hashes[path], size, mtime, flows, dns, packets)
+        return len(targets)
+
+    def __store(self, path, sha256, size, mtime, flows, dns, packets):
+        """1つのpcapの要約を登録する。既に登録済みの場合は置き換える"""
+
+        self.conn.execute("DELETE FROM flows WHERE path = ?", (path,))
+        self.conn.execute("DELETE FROM dns WHERE path = ?", (path,))
+        self.conn.execute("INSERT OR REPLACE INTO pcaps VALUES (?, ?, ?, ?, ?)", (path, sha256, size, mtime, packets))
+        self.conn.executemany(
+            "INSERT INTO flows VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(path, sha256, *key, *values) for key, values in flows.items()]
+        )
+        self.conn.executemany(
+            "INSERT INTO dns VALUES (?, ?, ?, ?, ?)",
+            [(path, sha256, *record) for record in dns]
+        )
+
+    def specimens_contacting(self, ip_addr):
+        """指定したIPアドレスと通信した検体のハッシュ値を返す"""
+
+        rows = self.conn.execute(
+            "SELECT sha256 FROM flows WHERE dst = ? UNION SELECT sha256 FROM flows WHERE src = ?", (ip_addr, ip_addr)
+        )
+        return [sha256 for sha256, in rows]
+
+    def specimens_resolving(self, domain):
+        """指定したドメインを名前解決した検体のハッシュ値を返す"""
+
+        rows = self.conn.execute("SELECT DISTINCT sha256 FROM dns WHERE qname = ?", (domain.lower().rstrip("."),))
+        return [sha256 for sha256, in rows]
+
+    def specimens_by_port(self, port):
+        """指定した宛先ポートに通信した検体のハッシュ値を返す"""
+
+        rows = self.conn.execute("SELECT DISTINCT sha256 FROM flows WHERE dport = ?", (port,))
+        return [sha256 for sha256, in rows]
+
+
+if __name__ == "__main__":
+    from catalog import Catalog
+    from settings import CATALOG_PATH, PCAP_INDEX_PATH
+
+    logging.basicConfig(format="%(levelname)s - %(asctime)s - %(message)s", level=logging.INFO)
+    with PcapIndex(PCAP_INDEX_PATH) as index, Catalog(CATALOG_PATH) as catalog:
+        if len(sys.argv) == 3:
+            query = {"ip": index.specimens_contacting, "domain": index.specimens_resolving,
+                     "port": lambda port: index.specimens_by_port(int(port))}[sys.argv[1]]
+            print("\n".join(query(sys.argv[2])))
+        else:
+            logging.info(f"{index.update(catalog)}個のpcapを登録")
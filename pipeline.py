@@ -0,0 +1,111 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import QUEUE_DEPTH
+from scheduler import Scheduler
+from util import log_collection_error
+
+
+class CollectionPipeline:
+    """検体の受信・判定・VMでの実行をasyncioで並行して動かす
+
+    受信と判定の間は上限付きのキューで、判定と実行の間はOSごとに優先度を付けるSchedulerでつながっており、
+    VMで検体を実行している間にも次の検体の受信やハッシュ計算、ファイル形式の判定を進める。
+    Schedulerのキューが上限に達している間は判定を止め、受信も受信と判定の間のキューが埋まった時点で止まる。
+    libvirtやparamikoのようなブロックする処理はスレッドプールで実行する。
+    """
+
+    def __init__(self, fetch, classify, execute, slots: dict, queue_size=8, report_interval=60, scheduler=None):
+        """初期化
+
+        Arguments:
+            fetch(callable): 次の検体を受信してそのパスを返す。検体が届くまでブロックしてよい
+            classify(callable): classify(local_specimen_path)の形で呼び出し、
+                Judgementを返す。実行しない場合ドメインネームはNone
+            execute(callable): execute(domain_name, slot, local_specimen_path, is_windows, vm_username)の形で呼び出し、
+                VM内で検体を実行する。slotは同じドメインで同時に実行する中での番号
+            slots(dict): ドメインネームをキー、同時に実行する数を値とする辞書
+            queue_size(int): 受信と判定の間のキューの長さの上限。schedulerを省略した場合は、
+                ドメインごとの実行待ちの検体の数の上限にも用いる
+            report_interval(float): キューの長さをログに出力する間隔（秒）
+            scheduler(Scheduler): 実行待ちの検体を保持するスケジューラ。省略した場合は新たに作成する
+        """
+        self.fetch = fetch
+        self.classify = classify
+        self.execute = execute
+        self.slots = slots
+        self.queue_size = queue_size
+        self.report_interval = report_interval
+        self.classify_queue = None
+        self.scheduler = scheduler or Scheduler(slots, capacity=queue_size)
+
+    def depths(self):
+        """各段階の前で待っている検体の数を返す"""
+
+        depths = {"classify": self.classify_queue.qsize() if self.classify_queue else 0}
+        depths.update(self.scheduler.depths())
+        return depths
+
+    async def run(self):
+        """パイプラインを開始する。各段階は例外が発生しても検体単位で続行する"""
+
+        self.classify_queue = asyncio.Queue(self.queue_size)
+        QUEUE_DEPTH.set_function(lambda: {(stage,): depth for stage, depth in self.depths().items()})
+        # 受信と判定にそれぞれ1スレッド、実行にスロット数分のスレッドを割り当てる
+        # 実行のスレッドは、スケジューラから検体を取り出す間もブロックする
+        executor = ThreadPoolExecutor(max_workers=2 + sum(self.slots.values()), thread_name_prefix="pipeline")
+
+        stages = [self.__fetch_stage(executor), self.__classify_stage(executor), self.__report_stage()]
+        for domain_name, num in self.slots.items():
+            for slot in range(num):
+                stages.append(self.__execute_stage(executor, domain_name, slot))
+        try:
+            await asyncio.gather(*stages)
+        finally:
+            # スケジューラで待機している実行のスレッドを解放する
+            self.scheduler.close()
+            executor.shutdown(wait=False)
+
+    async def __fetch_stage(self, executor):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                local_specimen_path = await loop.run_in_executor(executor, self.fetch)
+            except Exception as e:
+                log_collection_error(e)
+                continue
+            await self.classify_queue.put(local_specimen_path)
+
+    async def __classify_stage(self, executor):
+        loop = asyncio.get_running_loop()
+        while True:
+            local_specimen_path = await self.classify_queue.get()
+            try:
+                judgement = await loop.run_in_executor(executor, self.classify, local_specimen_path)
+            except Exception as e:
+                log_collection_error(e)
+                continue
+            if judgement.domain_name is None:
+                continue
+            # キューが上限に達している間はputがブロックするため、イベントループを止めないようスレッドで待つ
+            await loop.run_in_executor(
+                executor, self.scheduler.put, judgement.domain_name,
+                (local_specimen_path, judgement.is_windows, judgement.vm_username),
+                judgement.family, judgement.resubmission, judgement.near_duplicate)
+
+    async def __execute_stage(self, executor, domain_name, slot):
+        loop = asyncio.get_running_loop()
+        while True:
+            task = await loop.run_in_executor(executor, self.scheduler.get, domain_name)
+            if task is None:
+                return
+            try:
+                await loop.run_in_executor(executor, self.execute, domain_name, slot, *task)
+            except Exception as e:
+                log_collection_error(e)
+
+    async def __report_stage(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            logging.info(f"パイプラインのキューの長さ: {self.depths()}")
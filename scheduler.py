@@ -0,0 +1,120 @@
+import heapq
+import logging
+import threading
+from collections import Counter, namedtuple
+from itertools import count
+
+# 検体の判定結果。実行しない場合はdomain_nameがNone
+Judgement = namedtuple("Judgement", ["is_windows", "domain_name", "vm_username", "family", "resubmission",
+                                     "near_duplicate"])
+SKIP = Judgement(None, None, None, None, False, False)
+
+# 優先度。値が小さいほど先に実行する
+NOVEL = 0  # これまでに見たことのないファミリ（ファイル形式とアーキテクチャ）の検体
+KNOWN = 1  # 既に見たファミリの検体
+RESUBMISSION = 2  # 過去に実行したものと同じファイル名で、内容の異なる検体
+NEAR_DUPLICATE = 3  # 類似性ハッシュが実行済みの検体と近い検体
+PRIORITY_NAMES = {NOVEL: "novel", KNOWN: "known", RESUBMISSION: "resubmission", NEAR_DUPLICATE: "near_duplicate"}
+
+
+class Scheduler:
+    """取り込んだ検体をOSごとのキューに振り分け、優先度の高いものから実行させる
+
+    実行待ちのキューはドメインごとに独立しているため、一方のOSの検体が大量に届いても、
+    もう一方のVMは自分のキューの検体を消化し続けられる。
+
+    同じファミリの検体が大量に届いても珍しい検体が埋もれないよう、初めて見るファミリの検体を先に、
+    同じファイル名で再投下された検体を後に実行する。ただし優先度の低い検体が飢餓状態にならないよう、
+    後から到着した検体に追い越されるのは、優先度1段階あたりaging個までとする。
+
+    capacityを指定した場合、そのドメインの実行待ちの検体がcapacity個に達するとputは空きができるまで待機する。
+    判定や展開を実行より先に進めすぎず、実行待ちの検体がディスクやメモリを使い続けないようにする。
+    """
+
+    def __init__(self, domain_names, aging=8, capacity=None):
+        """初期化
+
+        Arguments:
+            domain_names(iterable(str)): キューを用意するドメインネーム
+            aging(int): 優先度が1段階低い検体を、後から到着した検体が追い越せる数
+            capacity(int): ドメインごとの実行待ちの検体の数の上限。Noneもしくは0の場合は上限なし
+        """
+        self.aging = aging
+        self.capacity = capacity or None
+        self.queues = {domain_name: [] for domain_name in domain_names}
+        self.seen_families = set()
+        self.sequence = count()
+        self.closed = False
+        self.dispatched = Counter()
+        self.condition = threading.Condition()
+
+    def priority(self, family, resubmission=False, near_duplicate=False):
+        """検体の優先度を決め、そのファミリを既知として記録する"""
+
+        if near_duplicate:
+            return NEAR_DUPLICATE
+        if resubmission:
+            return RESUBMISSION
+        if family is None or family in self.seen_families:
+            return KNOWN
+        self.seen_families.add(family)
+        return NOVEL
+
+    def put(self, domain_name, task, family=None, resubmission=False, near_duplicate=False):
+        """検体をキューに入れる。そのドメインのキューがcapacityに達している場合は空きができるまで待機する
+
+        Args:
+            domain_name (str): 検体を実行するVMのドメインネーム
+            task (tuple): 実行する側に渡す引数
+            family (str): 検体のファミリ。初めて見るファミリの検体を優先する
+            resubmission (bool): 同じファイル名で再投下された検体か否か
+            near_duplicate (bool): 実行済みの検体に類似する検体か否か。最も後に実行する
+
+        Returns:
+            bool: キューに入れた場合はTrue、そのドメインのキューが存在しない場合はFalse
+        """
+
+        if domain_name not in self.queues:
+            logging.warning(f"{domain_name}で実行するワーカーが存在しないため、検体を破棄")
+            return False
+        queue = self.queues[domain_name]
+        with self.condition:
+            # closeした後は実行する側が残りを取り出し切るため、待機しない
+            self.condition.wait_for(lambda: self.capacity is None or len(queue) < self.capacity or self.closed)
+            priority = self.priority(family, resubmission, near_duplicate)
+            sequence = next(self.sequence)
+            # 到着順に優先度ごとの猶予を加えた値を順序とすることで、追い越される数に上限を設ける
+            heapq.heappush(queue, (sequence + priority * self.aging, sequence, priority, task))
+            self.condition.notify_all()
+        return True
+
+    def get(self, domain_name, timeout=None):
+        """そのドメインのキューから最も優先度の高い検体を取り出す。キューが空の場合は検体が届くまで待機する
+
+        Returns:
+            tuple: putで渡したtask。closeした後にキューが空になった場合、またはタイムアウトした場合はNone
+        """
+
+        queue = self.queues[domain_name]
+        with self.condition:
+            if not self.condition.wait_for(lambda: queue or self.closed, timeout) or not queue:
+                return None
+            _, _, priority, task = heapq.heappop(queue)
+            self.dispatched[PRIORITY_NAMES[priority]] += 1
+            # キューの空きを待っているputを起こす
+            self.condition.notify_all()
+        logging.info(f"{domain_name}: 優先度'{PRIORITY_NAMES[priority]}'の検体を実行（待機中: {len(queue)}個）")
+        return task
+
+    def depths(self):
+        """ドメインごとの実行待ちの検体の数を返す"""
+
+        with self.condition:
+            return {domain_name: len(queue) for domain_name, queue in self.queues.items()}
+
+    def close(self):
+        """新たな検体を受け付けないことを通知する。getはキューが空になった時点でNoneを返すようになる"""
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
@@ -14,5 +14,89 @@ HONEYPOT_SPECIMEN_DIRS = [
     os.environ.get("HONEYPOT_SPECIMEN_DIR_1"),
     os.environ.get("HONEYPOT_SPECIMEN_DIR_2"),
 ]
+# 複数のハニーポットから収集する場合、それらを列挙したJSONファイルのパス（書式はingest.load_honeypotsを参照）
+# 未指定の場合は上記のHONEYPOT_*で指定した1台から収集する
+HONEYPOTS_FILE = os.environ.get("HONEYPOTS_FILE")
 SPECIMEN_BASE_DIR = os.environ.get("SPECIMEN_BASE_DIR")
 LOGGING_DIR = os.environ.get("LOGGING_DIR")
+# 並列実行時にOSごとに用意するワーカー（クローンVM）の数。すべて0の場合は逐次実行する
+WORKER_NUMS = {
+    "win10_32bit": int(os.environ.get("WINDOWS_WORKER_NUM", 0)),
+    "ubuntu20.04": int(os.environ.get("LINUX_WORKER_NUM", 0)),
+}
+# ハニーポットをポーリングする間隔（秒）。検体が届かない間は最小値から最大値まで延ばしていく
+POLLING_INTERVAL_MIN = float(os.environ.get("POLLING_INTERVAL_MIN", 1))
+POLLING_INTERVAL_MAX = float(os.environ.get("POLLING_INTERVAL_MAX", 16))
+# 優先度が1段階低い検体を、後から到着した検体が追い越せる数。大きいほど優先度を重視し、小さいほど到着順に近づく
+SCHEDULER_AGING = int(os.environ.get("SCHEDULER_AGING", 8))
+# OSごとの実行待ちの検体の数の上限。達すると判定を止めて実行を待つ。0の場合は上限なし
+SCHEDULER_CAPACITY = int(os.environ.get("SCHEDULER_CAPACITY", 32))
+# 実行済みの検体のハッシュ値を永続化するSQLiteのパス。複数の挙動収集プロセスで共有できる
+HASH_INDEX_PATH = os.environ.get("HASH_INDEX_PATH", "hash_index.db")
+# 実行済みの検体に類似する検体（類似性ハッシュの類似度がSIMILARITY_THRESHOLD以上）の扱い
+# off: 判定しない、skip: 実行しない、deprioritize: 他の検体の後に実行する、sample: SIMILARITY_SAMPLE_INTERVAL個に1個だけ実行する
+SIMILARITY_POLICY = os.environ.get("SIMILARITY_POLICY", "off")
+SIMILARITY_THRESHOLD = int(os.environ.get("SIMILARITY_THRESHOLD", 80))
+SIMILARITY_SAMPLE_INTERVAL = int(os.environ.get("SIMILARITY_SAMPLE_INTERVAL", 10))
+# 類似性ハッシュを計算する検体のサイズの上限（バイト）。これより大きい検体は類似判定をせずに実行する
+SIMILARITY_MAX_SIZE = int(os.environ.get("SIMILARITY_MAX_SIZE", 2 * 1024 * 1024))
+# 実行済みの検体の類似性ハッシュを永続化するSQLiteのパス
+SIMILARITY_INDEX_PATH = os.environ.get("SIMILARITY_INDEX_PATH", "similarity_index.db")
+# 受信した検体ごとの処理状態を記録するSQLiteのパス。再起動時は未完了の検体から再開する
+JOURNAL_PATH = os.environ.get("JOURNAL_PATH", "journal.db")
+# 保存済みの検体を実行し直すバックフィルの進捗を記録するSQLiteのパス。同じパスで再実行すると続きから再開する
+BACKFILL_JOURNAL_PATH = os.environ.get("BACKFILL_JOURNAL_PATH", "backfill.db")
+# 検体・pcap・出力・ログをSHA-256をキーとして圧縮して保存するディレクトリ。未指定の場合はPCAP_BASE_DIRとSPECIMEN_BASE_DIRに非圧縮のまま残す
+ARTIFACT_STORE_DIR = os.environ.get("ARTIFACT_STORE_DIR")
+# アーティファクトストアの容量（圧縮後のバイト数）と保存期間（日）の上限。超えたものは古いものから削除する。0の場合は無制限
+ARTIFACT_MAX_BYTES = int(os.environ.get("ARTIFACT_MAX_BYTES", 0))
+ARTIFACT_MAX_AGE_DAYS = float(os.environ.get("ARTIFACT_MAX_AGE_DAYS", 0))
+# アーティファクトストアのgzipの圧縮レベル（1〜9）
+ARTIFACT_COMPRESSLEVEL = int(os.environ.get("ARTIFACT_COMPRESSLEVEL", 6))
+# SSHの一時的なエラーで実行に失敗した検体を再試行する回数の上限（初回を含む）
+MAX_ATTEMPTS = int(os.environ.get("MAX_ATTEMPTS", 3))
+# 実行した検体ごとの結果（ハッシュ値、ファイル形式、終了コード、pcap等）を記録するSQLiteのパス
+CATALOG_PATH = os.environ.get("CATALOG_PATH", "catalog.db")
+# libvirtのdnsmasqが書き出すDHCPのリースファイル。更新を監視し、ゲストにIPアドレスが割り当てられた時点で待機を終える
+DHCP_LEASE_FILE = os.environ.get("DHCP_LEASE_FILE", "/var/lib/libvirt/dnsmasq/virbr0.status")
+# ゲストにIPアドレスが割り当てられるまで待つ時間の上限（秒）。超えた場合はVMを作り直して再試行する
+IP_ACQUISITION_TIMEOUT = float(os.environ.get("IP_ACQUISITION_TIMEOUT", 120))
+# スナップショットの復元前のリースは、ゲストがそのIPアドレスのこのポートで接続を受け付けるか、
+# 復元からSTALE_LEASE_GRACE秒が過ぎるまで用いない（dnsmasqは復元後も同じリースを返し、ゲストも更新しないことがある）
+STALE_LEASE_PROBE_PORT = int(os.environ.get("STALE_LEASE_PROBE_PORT", 22))
+STALE_LEASE_GRACE = float(os.environ.get("STALE_LEASE_GRACE", 15))
+# 起動時に終了処理中のVMが停止するまで待つ時間の上限（秒）。超えた場合は強制終了する
+VM_STATE_TIMEOUT = float(os.environ.get("VM_STATE_TIMEOUT", 60))
+# SFTPのチャネルのウィンドウサイズと最大パケットサイズ（バイト）。ウィンドウが大きいほど遅延の大きい回線で速くなる
+SFTP_WINDOW_SIZE = int(os.environ.get("SFTP_WINDOW_SIZE", 8 * 1024 * 1024))
+SFTP_MAX_PACKET_SIZE = int(os.environ.get("SFTP_MAX_PACKET_SIZE", 32768))
+# SFTPの転送でローカルのファイルを読み書きする単位（バイト）
+SFTP_CHUNK_SIZE = int(os.environ.get("SFTP_CHUNK_SIZE", 1024 * 1024))
+# 1の場合、ハニーポットから受信した検体のSHA-256をハニーポット上でも計算し、一致を確認してから削除する
+VERIFY_REMOTE_HASH = bool(int(os.environ.get("VERIFY_REMOTE_HASH", 1)))
+# 1の場合、逐次実行時にVMの復元とIPアドレスの取得を裏で済ませておく
+USE_STANDBY_VM = bool(int(os.environ.get("USE_STANDBY_VM", 0)))
+# 準備を終えてからこの秒数を超えて使われなかった待機中のVMは、使う前にスナップショットを復元し直す。0の場合は復元し直さない
+# 待機中にWindows Defenderなどが有効に戻り、検体の挙動が変わるのを防ぐ
+STANDBY_MAX_IDLE = float(os.environ.get("STANDBY_MAX_IDLE", 600))
+# 1の場合、並列実行時のVMをvirt-cloneではなくqcow2のオーバーレイで用意する
+USE_OVERLAY_VM = bool(int(os.environ.get("USE_OVERLAY_VM", 0)))
+# オーバーレイを作成するディレクトリ。未指定の場合はクローン元のディスクイメージと同じディレクトリ
+OVERLAY_DIR = os.environ.get("OVERLAY_DIR")
+# 1の場合、検体の終了後に通信がIDLE_GRACE_TIME秒途絶えた時点で観測を打ち切る（上限はEXECUTION_TIME_LIMIT）
+ADAPTIVE_OBSERVATION = bool(int(os.environ.get("ADAPTIVE_OBSERVATION", 0)))
+IDLE_GRACE_TIME = int(os.environ.get("IDLE_GRACE_TIME", 30))
+# VM上での検体の出力を保存する上限（バイト）。超えた分は切り捨てる
+OUTPUT_SIZE_LIMIT = int(os.environ.get("OUTPUT_SIZE_LIMIT", 1024 * 1024))
+# パケットごとに保存する最大バイト数（0の場合はtcpdumpの既定値）と、キャプチャに追加で適用するBPFフィルタ
+CAPTURE_SNAPLEN = int(os.environ.get("CAPTURE_SNAPLEN", 0))
+CAPTURE_FILTER = os.environ.get("CAPTURE_FILTER")
+# 1の場合、ホストからVMへのSSHによる制御用の通信をキャプチャしない
+EXCLUDE_CONTROL_TRAFFIC = bool(int(os.environ.get("EXCLUDE_CONTROL_TRAFFIC", 1)))
+# pcapから抽出したフローとDNSの要約を保存するSQLiteのパス
+PCAP_INDEX_PATH = os.environ.get("PCAP_INDEX_PATH", "pcap_index.db")
+# 1の場合、検体の受信・判定・実行をasyncioのパイプラインで並行して行う
+USE_PIPELINE = bool(int(os.environ.get("USE_PIPELINE", 0)))
+# 各段階の所要時間や処理件数をPrometheusのテキスト形式で書き出すファイルのパスと、/metricsで公開するHTTPのポート（0の場合は公開しない）
+METRICS_TEXTFILE_PATH = os.environ.get("METRICS_TEXTFILE_PATH")
+METRICS_HTTP_PORT = int(os.environ.get("METRICS_HTTP_PORT", 0))
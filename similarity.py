@@ -0,0 +1,276 @@
+import logging
+import multiprocessing
+import os
+import re
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from util import SQLiteDatabase
+
+try:
+    # ssdeepのCの拡張モジュールがあればダイジェストの計算に用いる（ダイジェストの形式は同じ）
+    import ssdeep
+except ImportError:
+    ssdeep = None
+
+# ssdeep（spamsum）のパラメータ
+SPAMSUM_LENGTH = 64
+MIN_BLOCKSIZE = 3
+ROLLING_WINDOW = 7
+HASH_PRIME = 0x01000193
+HASH_INIT = 0x28021967
+B64 = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+
+# ファイルを読み込む単位（バイト）
+CHUNK_SIZE = 64 * 1024
+
+# 比較の対象とする共通部分文字列の長さ。これより短い共通部分しか持たないダイジェストの類似度は0となる
+NGRAM_LENGTH = 7
+
+# 4文字以上連続する同じ文字は3文字に縮める（パディングなどの繰り返しが類似度を押し上げないようにする）
+REPEAT_PATTERN = re.compile(r"(.)\1{3,}")
+
+# 類似する検体の検索結果
+Match = namedtuple("Match", ["sha256", "filename", "score"])
+
+# fuzzy_hash_in_subprocessでダイジェストを計算するプロセス
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def fuzzy_hash(local_specimen_path):
+    """ファイルのcontext-triggered piecewise hash（ssdeep互換のダイジェスト）を計算する
+
+    ファイルの内容から決まる位置で区切った断片ごとのハッシュ値を並べるため、末尾への設定の追記や
+    パディングなどの部分的な変更では、ダイジェストの大部分が変わらない。
+    ssdeepのモジュールがない場合は純Pythonで計算する。ファイルはCHUNK_SIZEずつ読み込むため、
+    検体の大きさによらずメモリは増えないが、1MBあたり1秒程度かかる。
+
+    Returns:
+        str: "ブロックサイズ:ダイジェスト1:ダイジェスト2"の形式の文字列
+    """
+
+    if ssdeep is not None:
+        return ssdeep.hash_from_file(local_specimen_path)
+
+    with open(local_specimen_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        block_size = MIN_BLOCKSIZE
+        while block_size * SPAMSUM_LENGTH < size:
+            block_size *= 2
+
+        while True:
+            f.seek(0)
+            digest1, digest2 = _spamsum(f, block_size)
+            # 区切りが少なすぎる場合はブロックサイズを半分にしてやり直す
+            if block_size > MIN_BLOCKSIZE and len(digest1) < SPAMSUM_LENGTH // 2:
+                block_size //= 2
+            else:
+                return f"{block_size}:{digest1}:{digest2}"
+
+
+def fuzzy_hash_in_subprocess(local_specimen_path):
+    """fuzzy_hashを別プロセスで計算する
+
+    純Pythonの計算は1バイトごとにGILを取るため、スレッドで計算すると同じプロセスで受信や実行を
+    担うスレッドが止まる。ssdeepのモジュールがない場合は、1つの子プロセスに計算を任せてそれを避ける。
+    """
+
+    global _executor
+
+    if ssdeep is not None:
+        return fuzzy_hash(local_specimen_path)
+    with _executor_lock:
+        if _executor is None:
+            # 呼び出し元は多数のスレッドがロックを持ちうるため、forkではなくforkserverで子プロセスを作る
+            _executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("forkserver"))
+    return _executor.submit(fuzzy_hash, local_specimen_path).result()
+
+
+def _spamsum(f, block_size):
+    window = [0] * ROLLING_WINDOW
+    h1 = h2 = h3 = n = 0
+    hash1 = hash2 = HASH_INIT
+    digest1, digest2 = [], []
+    double_block_size = block_size * 2
+    limit1, limit2 = SPAMSUM_LENGTH - 1, SPAMSUM_LENGTH // 2 - 1
+
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+        for c in chunk:
+            hash1 = ((hash1 * HASH_PRIME) & 0xFFFFFFFF) ^ c
+            hash2 = ((hash2 * HASH_PRIME) & 0xFFFFFFFF) ^ c
+            # 直近ROLLING_WINDOWバイトから計算するローリングハッシュ
+            h2 += ROLLING_WINDOW * c - h1
+            h1 += c - window[n]
+            window[n] = c
+            n = n + 1 if n < ROLLING_WINDOW - 1 else 0
+            h3 = ((h3 << 5) & 0xFFFFFFFF) ^ c
+            rolling = (h1 + h2 + h3) & 0xFFFFFFFF
+
+            if rolling % block_size == block_size - 1:
+                if len(digest1) < limit1:
+                    digest1.append(B64[hash1 % 64])
+                    hash1 = HASH_INIT
+                if rolling % double_block_size == double_block_size - 1 and len(digest2) < limit2:
+                    digest2.append(B64[hash2 % 64])
+                    hash2 = HASH_INIT
+
+    if (h1 + h2 + h3) & 0xFFFFFFFF:
+        digest1.append(B64[hash1 % 64])
+        digest2.append(B64[hash2 % 64])
+    return "".join(digest1), "".join(digest2)
+
+
+def _parse(digest):
+    block_size, digest1, digest2 = digest.split(":", 2)
+    return int(block_size), REPEAT_PATTERN.sub(r"\1\1\1", digest1), REPEAT_PATTERN.sub(r"\1\1\1", digest2)
+
+
+def _ngrams(digest_part):
+    return {digest_part[i:i + NGRAM_LENGTH] for i in range(len(digest_part) - NGRAM_LENGTH + 1)}
+
+
+def _edit_distance(s1, s2):
+    """挿入・削除のコストを1、置換のコストを2とする編集距離"""
+
+    previous = list(range(len(s2) + 1))
+    for i, c1 in enumerate(s1, 1):
+        current = [i]
+        for j, c2 in enumerate(s2, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (0 if c1 == c2 else 2)))
+        previous = current
+    return previous[-1]
+
+
+def _score_strings(s1, s2, block_size):
+    if not _ngrams(s1) & _ngrams(s2):
+        return 0
+    score = _edit_distance(s1, s2) * SPAMSUM_LENGTH // (len(s1) + len(s2))
+    score = 100 - 100 * score // SPAMSUM_LENGTH
+    # ブロックサイズが小さい場合、短いダイジェスト同士が偶然一致しただけで類似度が高くならないよう上限を設ける
+    if block_size >= (99 + MIN_BLOCKSIZE) // MIN_BLOCKSIZE * MIN_BLOCKSIZE:
+        return score
+    return min(score, block_size // MIN_BLOCKSIZE * min(len(s1), len(s2)))
+
+
+def compare(digest_a, digest_b):
+    """2つのダイジェストの類似度を0から100で返す（ssdeepのcompareと同じ基準）"""
+
+    block_size_a, a1, a2 = _parse(digest_a)
+    block_size_b, b1, b2 = _parse(digest_b)
+    if block_size_a == block_size_b:
+        if a1 == b1:
+            return 100
+        return max(_score_strings(a1, b1, block_size_a), _score_strings(a2, b2, block_size_a * 2))
+    if block_size_a == block_size_b * 2:
+        return _score_strings(a1, b2, block_size_a)
+    if block_size_b == block_size_a * 2:
+        return _score_strings(a2, b1, block_size_b)
+    return 0
+
+
+class SimilarityIndex(SQLiteDatabase):
+    """これまでに実行した検体のダイジェストをSQLiteに保存し、類似する検体を高速に検索する
+
+    ダイジェストの長さNGRAM_LENGTHの部分文字列を転置インデックスに登録する。
+    ssdeepの類似度はこの長さの共通部分文字列を持たない組み合わせでは0となるため、
+    部分文字列が一致した候補のみを比較すれば、すべての履歴と比較したのと同じ結果が得られる。
+    """
+
+    def __init__(self, db_path, timeout=30):
+        """初期化
+
+        Arguments:
+            db_path(str): インデックスを保存するSQLiteのファイルパス
+            timeout(float): SQLiteDatabaseを参照
+        """
+        super().__init__(db_path, timeout)
+        # WALモードでは、電源断時に直近のコミットが失われうるのみでデータベースは壊れない
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS digests ("
+            "sha256 TEXT PRIMARY KEY, digest TEXT NOT NULL, filename TEXT, first_seen REAL, "
+            "near_duplicates INTEGER NOT NULL DEFAULT 0)"
+        )
+        # ブロックサイズごとの部分文字列から、それを含むダイジェストを引く
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS ngrams (block_size INTEGER, ngram TEXT, sha256 TEXT, "
+            "PRIMARY KEY (block_size, ngram, sha256)) WITHOUT ROWID"
+        )
+        count, = self.conn.execute("SELECT COUNT(*) FROM digests").fetchone()
+        logging.info(f"類似性インデックス{db_path}を読み込み（登録済み: {count}件）")
+
+    @staticmethod
+    def __keys(digest):
+        """ダイジェストを、比較しうるブロックサイズとその部分文字列の集合の組にする"""
+
+        block_size, digest1, digest2 = _parse(digest)
+        return [(block_size, _ngrams(digest1)), (block_size * 2, _ngrams(digest2))]
+
+    def add(self, sha256, digest, filename=None):
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO digests (sha256, digest, filename, first_seen) VALUES (?, ?, ?, ?)",
+                    (sha256, digest, filename, time.time())
+                )
+                if cursor.rowcount == 1:
+                    self.conn.executemany(
+                        "INSERT OR IGNORE INTO ngrams (block_size, ngram, sha256) VALUES (?, ?, ?)",
+                        [(block_size, ngram, sha256) for block_size, ngrams in self.__keys(digest) for ngram in ngrams]
+                    )
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def nearest(self, digest, exclude=None):
+        """最も類似する登録済みの検体を返す
+
+        Args:
+            digest (str): 検索するダイジェスト
+            exclude (str): 候補から除くSHA-256（検索する検体自身）
+
+        Returns:
+            Match: 最も類似度の高い検体。共通部分を持つ検体がない場合はNone
+        """
+
+        candidates = set()
+        with self.lock:
+            # ブロックサイズごとに主キーの範囲を引くことで、登録数によらず候補の数に比例する時間で済ませる
+            for block_size, ngrams in self.__keys(digest):
+                if not ngrams:
+                    continue
+                candidates.update(self.conn.execute(
+                    "SELECT d.sha256, d.filename, d.digest FROM ngrams n JOIN digests d ON d.sha256 = n.sha256 "
+                    f"WHERE n.block_size = ? AND n.ngram IN ({', '.join('?' * len(ngrams))})",
+                    (block_size, *ngrams)
+                ).fetchall())
+
+        best = None
+        for sha256, filename, candidate in candidates:
+            if sha256 == exclude:
+                continue
+            score = compare(digest, candidate)
+            if best is None or score > best.score:
+                best = Match(sha256, filename, score)
+        return best
+
+    def count_near_duplicate(self, sha256):
+        """その検体に類似する検体が届いた回数を1増やし、増やした後の回数を返す"""
+
+        with self.lock:
+            self.conn.execute("UPDATE digests SET near_duplicates = near_duplicates + 1 WHERE sha256 = ?", (sha256,))
+            row = self.conn.execute("SELECT near_duplicates FROM digests WHERE sha256 = ?", (sha256,)).fetchone()
+        return row[0] if row else 0
+
+
+if __name__ == "__main__":
+    # python similarity.py FILE [FILE ...] でダイジェストと、1つ目のファイルとの類似度を表示する
+    digests = [fuzzy_hash(path) for path in sys.argv[1:]]
+    for path, digest in zip(sys.argv[1:], digests):
+        print(f"{compare(digests[0], digest):3d}  {digest}  {os.path.basename(path)}")
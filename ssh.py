@@ -1,12 +1,57 @@
+import gzip
 import logging
 import os
 import socket
+import stat
+import sys
+import tempfile
 import threading
-from time import sleep
+from collections import namedtuple
+from time import monotonic, sleep
 
 import paramiko
 
-from util import die
+from metrics import STAGE_DURATION, timed
+from settings import SFTP_CHUNK_SIZE, SFTP_MAX_PACKET_SIZE, SFTP_WINDOW_SIZE, VERIFY_REMOTE_HASH
+from transfer import TransferVerificationError, download, remote_sha256, upload
+
+# 検体の実行結果。returncodeは実行時間制限に達した場合None、
+# early_terminatedは通信が途絶えたため観測を打ち切った場合True
+ExecutionResult = namedtuple("ExecutionResult", ["returncode", "observed_time", "early_terminated"])
+
+
+def read_output(output_path):
+    """execute_fileが保存した検体の出力を読み込み、文字列として返す
+
+    utf-8, shift-jisの順にデコードを試み、いずれも失敗した場合は置換文字を用いてutf-8でデコードする。
+    アーティファクトストアに保存した出力（.gz）はそのまま展開して読み込む。
+    """
+
+    opener = gzip.open if output_path.endswith(".gz") else open
+    with opener(output_path, "rb") as f:
+        data = f.read()
+    for encoding in ("utf-8", "shift-jis"):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            pass
+    return data.decode("utf-8", errors="replace")
+
+
+def source_dir_name(remote_dir_path):
+    """監視するリモートのディレクトリを、受信先のサブディレクトリの名前にする（/srv/cowrie/dl → srv_cowrie_dl）"""
+
+    return remote_dir_path.strip("/").replace("/", "_") or "_"
+
+
+# SSHSessionPoolが再接続によって回復を試みる例外
+RECONNECTABLE_ERRORS = (
+    paramiko.SSHException,
+    paramiko.ssh_exception.NoValidConnectionsError,
+    EOFError,
+    ConnectionError,
+    socket.timeout,
+)
 
 
 class SSH:
@@ -24,6 +69,8 @@ class SSH:
         self.username = username
         self.key_file_path = key_file_path
         self.port = port
+        self.client = None
+        self.sftp_conn = None
 
     def __enter__(self):
         self.client = paramiko.SSHClient()
@@ -37,8 +84,30 @@ class SSH:
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        if self.sftp_conn is not None:
+            self.sftp_conn.close()
+            self.sftp_conn = None
         self.client.close()
 
+    def is_active(self):
+        """コネクションが生きているかを返す"""
+
+        if self.client is None:
+            return False
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def open_sftp(self):
+        """SFTPチャネルを返す。一度開いたチャネルはコネクションを閉じるまで使い回す。
+
+        ウィンドウサイズと最大パケットサイズはSFTP_WINDOW_SIZEとSFTP_MAX_PACKET_SIZEで指定する。
+        """
+
+        if self.sftp_conn is None or self.sftp_conn.sock.closed:
+            self.sftp_conn = paramiko.SFTPClient.from_transport(
+                self.client.get_transport(), window_size=SFTP_WINDOW_SIZE, max_packet_size=SFTP_MAX_PACKET_SIZE)
+        return self.sftp_conn
+
     def send_file(self, local_specimen_path, remote_specimen_path):
         """SFTPでファイルの送信
 
@@ -47,40 +116,45 @@ class SSH:
             remote_specimen_path (str): 送信先のパス
         """
 
-        with self.client.open_sftp() as sftp_conn:
-            sftp_conn.put(local_specimen_path, remote_specimen_path)
+        with timed("sftp_send"):
+            sftp_conn = self.open_sftp()
+            upload(sftp_conn, local_specimen_path, remote_specimen_path, SFTP_CHUNK_SIZE)
             sftp_conn.chmod(remote_specimen_path, 0o755)
 
-    def execute_file(self, remote_specimen_path, ovservation_time):
-        """検体を実行し、VM上での検体の出力を出力しながら、一定時間待機する。
+    def execute_file(self, remote_specimen_path, ovservation_time, traffic_monitor=None, idle_grace_time=30,
+                     output_path=None, output_limit=1024 * 1024):
+        """検体を実行し、VM上での検体の出力をファイルに書き出しながら、一定時間待機する。
+
+        traffic_monitorを指定した場合は、検体の終了後に通信がidle_grace_time秒途絶えた時点で観測を打ち切る。
+        検体が終了しない場合や通信が続く場合は、従来通りovservation_time秒で打ち切る。
+
+        検体の出力はメモリに溜めずに少しずつoutput_pathに書き出し、output_limitバイトを超えた分は読み捨てる。
 
         Args:
             remote_specimen_path (str): 実行するファイルのパス
+            ovservation_time (int): 観測時間の上限（秒）
+            traffic_monitor (TrafficMonitor): キャプチャ中のpcapのパケット数を監視するオブジェクト
+            idle_grace_time (float): 観測を打ち切るまでに通信が途絶えている必要のある時間（秒）
+            output_path (str): 検体の出力を書き出すパス。Noneの場合は読み捨てる
+            output_limit (int): 書き出す出力の上限（バイト）
+
+        Returns:
+            ExecutionResult: 実行結果と実際の観測時間
         """
 
-        # 別のスレッドで、実行時間制限だけsleepする関数を実行する。
-        # これにより、もしexec_command関数で実行したコマンドが時間内に終了しても、
-        # 制限時間までスレッドがjoinするのを待つことで毎回一定時間パケットキャプチャするようにしている。
-        def execution_time_limit(time):
-            sleep(time)
-        thread = threading.Thread(target=execution_time_limit, args=(ovservation_time,))
-        thread.start()
+        # もしexec_command関数で実行したコマンドが時間内に終了しても、
+        # 制限時間まで待機することで毎回一定時間パケットキャプチャするようにしている。
+        start = monotonic()
+        deadline = start + ovservation_time
+        returncode = None
+        early_terminated = False
 
         try:
             command = f"{remote_specimen_path} 2>&1"
             logging.info(f"Command: {command}")
             _, stdout, _ = self.client.exec_command(command, timeout=ovservation_time)
-            data = stdout.read()
-
-            try:
-                logging.info(f"出力（utf-8）:\n{data.decode()}")
-            except UnicodeDecodeError as e:
-                logging.warning(f"出力がutf-8でデコードできませんでした。: {e}")
-
-            try:
-                logging.info(f"出力（shift-jis）:\n{data.decode('shift-jis')}")
-            except UnicodeDecodeError as e:
-                logging.warning(f"出力がshift-jisでデコードできませんでした。: {e}")
+            written, truncated = self.__save_output(stdout.channel, deadline, output_path or os.devnull, output_limit)
+            logging.info(f"出力を{output_path}に保存（{written}バイト, 切り捨て{truncated}バイト）")
 
         except socket.timeout:
             logging.info("実行時間制限")
@@ -88,66 +162,231 @@ class SSH:
             returncode = stdout.channel.recv_exit_status()
             logging.info(f"実行終了 return code = {returncode}")
         finally:
-            thread.join()
-            logging.info("パケット観測終了")
+            if returncode is not None and traffic_monitor is not None:
+                early_terminated = traffic_monitor.wait_idle(idle_grace_time, deadline)
+            else:
+                sleep(max(deadline - monotonic(), 0))
+            observed_time = monotonic() - start
+            STAGE_DURATION.observe(observed_time, stage="execution")
+            if early_terminated:
+                logging.info(f"通信が{idle_grace_time}秒途絶えたため、{observed_time:.1f}秒でパケット観測を早期終了")
+            else:
+                logging.info("パケット観測終了")
+
+        return ExecutionResult(returncode, observed_time, early_terminated)
 
-    def wait_until_receive(self, local_dir_path: str, remote_dir_paths):
-        """指定されたパスを監視する．ファイルを発見したら受信して，そのパスを返す．
+    def __save_output(self, channel, deadline, output_path, output_limit, chunk_size=32768):
+        """チャネルの出力をチャンクごとにファイルへ書き出す。上限を超えた分は末尾に切り捨てた旨を記す
+
+        Returns:
+            written (int): 書き出したバイト数
+            truncated (int): 読み捨てたバイト数
+
+        Raises:
+            socket.timeout: deadlineまでに出力が終わらなかった場合
+        """
+
+        written = 0
+        truncated = 0
+        with open(output_path, "wb") as f:
+            try:
+                while True:
+                    # 出力が続いてもdeadlineで打ち切れるよう、受信ごとにタイムアウトを設定し直す
+                    channel.settimeout(max(deadline - monotonic(), 0.001))
+                    chunk = channel.recv(chunk_size)
+                    if not chunk:
+                        break
+                    room = output_limit - written
+                    f.write(chunk[:room])
+                    written += min(len(chunk), room)
+                    truncated += max(len(chunk) - room, 0)
+            finally:
+                if truncated:
+                    f.write(f"\n[... {truncated} bytes truncated ...]\n".encode())
+        return written, truncated
+
+    def list_specimens(self, remote_dir_paths):
+        """監視するディレクトリ内の通常ファイルを1回の走査ですべて列挙する
 
         Args:
-            local_dir_path (str): 受信するローカルのディレクトリ
             remote_dir_paths (list(str)): 監視するリモートのディレクトリのリスト
 
         Returns:
-            local_specimen_path (str): 受信したファイルのパス
-            remote_specimen_path (str): 送信したファイルのパス
+            dict: リモートのファイルパスをキー、(サイズ, 更新時刻)を値とする辞書
 
-        Notes:
-            remote_dir_pathに読み書き実行権限が必要
-
-        Todo:
-            取りに行くファイルのパーミッション　読み書き
+        Raises:
+            FileNotFoundError: 監視するディレクトリが存在しない場合
         """
 
-        def find_specimen(remote_dir_paths):
-            """指定されたパスを監視し、ファイルを発見したらパスを返す。何も存在しなければNoneを返す。"""
+        sftpconn = self.open_sftp()
+        specimens = {}
+        for path in remote_dir_paths:
+            try:
+                attrs = sftpconn.listdir_attr(path)
+            except FileNotFoundError as e:
+                # 終了せずに送出し、ハニーポットごとの受信失敗として扱わせる
+                raise FileNotFoundError(e.errno, f"指定した監視するディレクトリが存在しません。: {path}") from e
+            for attr in attrs:
+                if stat.S_ISREG(attr.st_mode):
+                    specimens[os.path.join(path, attr.filename)] = (attr.st_size, attr.st_mtime)
+        return specimens
 
-            for path in remote_dir_paths:
-                specimen_list = sftpconn.listdir(path)
-                if specimen_list:
-                    return os.path.join(path, specimen_list[0])
-            return None
+    def receive_specimen(self, remote_specimen_path, local_dir_path, verify_hash=VERIFY_REMOTE_HASH):
+        """リモートのファイルを指定したディレクトリに受信する
 
-        with self.client.open_sftp() as sftpconn:
-            try:
-                remote_specimen_path = find_specimen(remote_dir_paths)
-            except IOError as e:
-                die("指定した監視するディレクトリが存在しません。", e)
-            if not remote_specimen_path:
-                logging.info("検体を待機中")
-            while not remote_specimen_path:
-                sleep(10)
-                remote_specimen_path = find_specimen(remote_dir_paths)
-            else:
-                logging.info(f"{remote_specimen_path} がハニーポットに到着")
-                specimen_filename = os.path.basename(remote_specimen_path)
-                local_specimen_path = os.path.join(local_dir_path, specimen_filename)
-                logging.info(f"{specimen_filename}を{local_specimen_path}に転送")
-                sftpconn.get(remote_specimen_path, local_specimen_path)
-                logging.info("転送完了")
-                return local_specimen_path, remote_specimen_path
+        受信と同時にSHA-256を計算し、受信した大きさがリモートのファイルと一致することを確認する。
+        verify_hashがTrueの場合は、リモートで計算したSHA-256とも照合する。
+        リモートのファイルを削除するのは、この確認を終えてからにすること。
+
+        受信したファイルは「local_dir_path/監視するディレクトリ/SHA-256/ファイル名」に置く。
+        まとめて受信した検体が実行待ちの間に、同じ名前で内容の異なる検体が届いたり、別のディレクトリから
+        同じ名前の検体が届いたりしても、実行待ちの検体を上書きしない。
+
+        Returns:
+            local_specimen_path (str): 受信したファイルのパス
+            sha256 (str): 受信したファイルのSHA-256
+
+        Raises:
+            TransferVerificationError: 受信したファイルがリモートのファイルと一致しない場合
+        """
+
+        specimen_filename = os.path.basename(remote_specimen_path)
+        source_dir_path = os.path.join(local_dir_path, source_dir_name(os.path.dirname(remote_specimen_path)))
+        os.makedirs(source_dir_path, exist_ok=True)
+        # SHA-256は受信を終えるまで分からないため、一意な名前の一時ファイルに受信してから移す
+        fd, receiving_path = tempfile.mkstemp(prefix=".receiving-", dir=source_dir_path)
+        os.close(fd)
+        try:
+            logging.info(f"{specimen_filename}を{source_dir_path}に転送")
+            transferred = download(self.open_sftp(), remote_specimen_path, receiving_path, SFTP_CHUNK_SIZE)
+            if verify_hash:
+                expected = remote_sha256(self.client, remote_specimen_path)
+                if expected is not None and expected != transferred.sha256:
+                    raise TransferVerificationError(f"{remote_specimen_path}のハッシュ値がリモートと一致しません")
+            local_specimen_path = os.path.join(source_dir_path, transferred.sha256, specimen_filename)
+            os.makedirs(os.path.dirname(local_specimen_path), exist_ok=True)
+            os.replace(receiving_path, local_specimen_path)
+        finally:
+            if os.path.exists(receiving_path):
+                os.remove(receiving_path)
+        rate = transferred.size / transferred.elapsed / 1024 if transferred.elapsed else 0
+        logging.info(f"転送完了（{transferred.size}バイト, {rate:.0f}KiB/秒）")
+        return local_specimen_path, transferred.sha256
 
     def remove_specimen(self, remote_specimen_path):
         """リモートのファイルを削除する"""
 
-        with self.client.open_sftp() as sftp_conn:
-            try:
-                logging.info(f"ハニーポットの{remote_specimen_path}を削除します。")
-                sftp_conn.remove(remote_specimen_path)
-                logging.info(f"ハニーポットの{remote_specimen_path}を削除しました。")
-            except IOError as e:
-                logging.warning(f"ハニーポットに{remote_specimen_path}が存在しない、もしくは書き込み権限がないため、削除できません。: {e}")
+        sftp_conn = self.open_sftp()
+        try:
+            logging.info(f"ハニーポットの{remote_specimen_path}を削除します。")
+            sftp_conn.remove(remote_specimen_path)
+            logging.info(f"ハニーポットの{remote_specimen_path}を削除しました。")
+        except IOError as e:
+            logging.warning(f"ハニーポットに{remote_specimen_path}が存在しない、もしくは書き込み権限がないため、削除できません。: {e}")
+
+
+class SSHSessionPool:
+    """長時間維持するSSHコネクションを管理し、検体ごとの鍵交換・認証を省く
+
+    コネクションとSFTPチャネルは使い回し、切断されていた場合やSSHException, EOFErrorが発生した場合は
+    指数バックオフを挟んで再接続する。
+
+    Attributes:
+        hits (int): 既存のコネクションを再利用できた回数
+        reconnects (int): 切断や例外により再接続した回数
+    """
+
+    def __init__(self, ip_addr, username, key_file_path, port=22,
+                 max_retries=5, backoff_base=1, backoff_max=60, keepalive_interval=30):
+        """初期化
+
+        Arguments:
+            ip_addr(str), username(str), key_file_path(str), port(str): SSHクラスと同様
+            max_retries(int): 1回の操作で再接続を試みる最大回数
+            backoff_base(float): 再接続までの待機時間の初期値（秒）
+            backoff_max(float): 再接続までの待機時間の上限（秒）
+            keepalive_interval(int): コネクション維持のためにkeepaliveを送る間隔（秒）
+        """
+        self.ip_addr = ip_addr
+        self.username = username
+        self.key_file_path = key_file_path
+        self.port = port
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.keepalive_interval = keepalive_interval
+        self.ssh = None
+        self.connected = False
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.reconnects = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """コネクションを閉じる"""
+
+        with self.lock:
+            self.__disconnect()
+        logging.info(f"{self.ip_addr}へのSSHセッション: {self.stats()}")
+
+    def stats(self):
+        """コネクション再利用の統計を返す"""
+
+        return {"hits": self.hits, "reconnects": self.reconnects}
+
+    def call(self, func, *args, **kwargs):
+        """プール内のコネクションを用いてfunc(ssh, *args, **kwargs)を実行し、その返り値を返す
+
+        SSH.receive_specimenのようなSSHクラスのメソッドをそのまま渡すことができる。
+        SSHException, EOFErrorや接続エラーが発生した場合は再接続して再試行し、
+        max_retries回失敗した場合は最後の例外を送出する。
+        """
+
+        with self.lock:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    return func(self.__session(), *args, **kwargs)
+                except RECONNECTABLE_ERRORS as e:
+                    self.__disconnect()
+                    if attempt == self.max_retries:
+                        raise
+                    wait = min(self.backoff_base * 2 ** attempt, self.backoff_max)
+                    logging.warning(f"{self.ip_addr}とのSSHセッションで{e}が発生。{wait}秒後に再接続")
+                    sleep(wait)
+
+    def __session(self):
+        """生きているコネクションを返す。切断されている場合は再接続する。"""
+
+        if self.ssh is not None and self.ssh.is_active():
+            self.hits += 1
+            return self.ssh
+
+        if self.ssh is not None:
+            self.__disconnect()
+        if self.connected:
+            self.reconnects += 1
+        self.ssh = SSH(self.ip_addr, self.username, self.key_file_path, self.port).__enter__()
+        self.ssh.client.get_transport().set_keepalive(self.keepalive_interval)
+        self.connected = True
+        logging.info(f"{self.ip_addr}にSSH接続")
+        return self.ssh
+
+    def __disconnect(self):
+        if self.ssh is None:
+            return
+        try:
+            self.ssh.__exit__(None, None, None)
+        except Exception as e:
+            logging.warning(f"{self.ip_addr}とのSSHコネクションを閉じる際に{e}が発生")
+        self.ssh = None
 
 
 if __name__ == "__main__":
-    pass
+    # python ssh.py 出力のパス... で検体の出力をデコードして表示する
+    for output_path in sys.argv[1:]:
+        print(read_output(output_path), end="")
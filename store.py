@@ -0,0 +1,262 @@
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+from util import SQLiteDatabase
+
+# ストアに保存した成果物。sha256は成果物自体の、specimenはその成果物を生んだ検体のSHA-256
+Artifact = namedtuple("Artifact", ["sha256", "kind", "specimen", "name", "created", "path"])
+
+# 成果物の種類
+SPECIMEN = "specimen"
+PCAP = "pcap"
+OUTPUT = "output"
+LOG = "log"
+
+
+class ArtifactStore(SQLiteDatabase):
+    """検体・pcap・出力・ログを内容のSHA-256をキーとしてgzipで圧縮して保存する
+
+    同じ内容のファイルは何度保存しても1つのオブジェクトしか持たないため、同じ検体が繰り返し届いても
+    容量は増えない。オブジェクトは「root/SHA-256の先頭2文字/SHA-256.gz」に置き、どの検体の何であるかは
+    SQLiteのartifactsテーブルに記録する。
+
+    max_bytes（圧縮後の合計）とmax_age（秒）を超えた成果物は古いものから削除し、
+    どの成果物からも参照されなくなったオブジェクトを削除する。
+    """
+
+    def __init__(self, root, max_bytes=0, max_age=0, compresslevel=6, prune_interval=60, timeout=30):
+        """初期化
+
+        Arguments:
+            root(str): ストアのディレクトリ
+            max_bytes(int): 保存するオブジェクトの圧縮後の合計の上限（バイト）。0の場合は無制限
+            max_age(float): 成果物を保存しておく期間（秒）。0の場合は無期限
+            compresslevel(int): gzipの圧縮レベル（1〜9）
+            prune_interval(float): 保存時に上限を確認する最短の間隔（秒）
+            timeout(float): SQLiteDatabaseを参照
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.compresslevel = compresslevel
+        self.prune_interval = prune_interval
+        self.last_pruned = 0
+        os.makedirs(os.path.join(root, "tmp"), exist_ok=True)
+
+        super().__init__(os.path.join(root, "store.db"), timeout)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS objects ("
+            "sha256 TEXT PRIMARY KEY, size INTEGER NOT NULL, stored_size INTEGER NOT NULL, created REAL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS artifacts ("
+            "id INTEGER PRIMARY KEY, sha256 TEXT NOT NULL, kind TEXT NOT NULL, specimen TEXT, name TEXT, "
+            "created REAL NOT NULL)"
+        )
+        for name, columns in (
+            ("artifacts_sha256", "sha256"),
+            ("artifacts_specimen", "specimen, kind"),
+            ("artifacts_created", "created"),
+            ("artifacts_kind", "kind, created"),
+        ):
+            self.conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON artifacts ({columns})")
+        logging.info(f"アーティファクトストア{root}を読み込み（{self.usage()}）")
+
+    def path(self, sha256):
+        """オブジェクトのファイルパスを返す"""
+
+        return os.path.join(self.root, sha256[:2], sha256 + ".gz")
+
+    def __contains__(self, sha256):
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM objects WHERE sha256 = ?", (sha256,)).fetchone()
+        return row is not None
+
+    def put(self, local_path, kind, specimen=None, name=None, sha256=None, remove=False):
+        """ファイルを圧縮しながらSHA-256を計算して保存し、成果物として記録する
+
+        同じ内容のオブジェクトが保存済みの場合は記録のみ追加する。sha256を指定した場合は、
+        保存済みであれば圧縮せずに済ませる。
+
+        Args:
+            local_path (str): 保存するファイルのパス
+            kind (str): 成果物の種類（SPECIMEN, PCAP, OUTPUT, LOG）
+            specimen (str): その成果物を生んだ検体のSHA-256
+            name (str): 元のファイル名。Noneの場合はlocal_pathのファイル名
+            sha256 (str): 計算済みであればlocal_pathのSHA-256
+            remove (bool): Trueの場合、保存した後でlocal_pathを削除する
+
+        Returns:
+            Artifact: 保存した成果物
+        """
+
+        name = name or os.path.basename(local_path)
+        now = time.time()
+        if sha256 is None or not self.__record(sha256, kind, specimen, name, now):
+            sha256 = self.__compress(local_path, kind, specimen, name, now)
+
+        if remove:
+            os.remove(local_path)
+        if (self.max_bytes or self.max_age) and time.monotonic() - self.last_pruned >= self.prune_interval:
+            self.prune()
+        return Artifact(sha256, kind, specimen, name, now, self.path(sha256))
+
+    def __record(self, sha256, kind, specimen, name, now, tmp_path=None, size=None):
+        """成果物を記録する。オブジェクトが保存済みでない場合、tmp_pathを指定していればオブジェクトとして置く
+
+        Returns:
+            bool: 記録した場合はTrue。オブジェクトが保存済みでなく、tmp_pathも指定していない場合はFalse
+        """
+
+        with self.lock:
+            # 削除と同時に行われないよう、オブジェクトの有無の確認から記録までを1つのトランザクションで行う
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self.conn.execute("SELECT 1 FROM objects WHERE sha256 = ?", (sha256,)).fetchone() is None:
+                    if tmp_path is None:
+                        self.conn.execute("ROLLBACK")
+                        return False
+                    object_path = self.path(sha256)
+                    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                    os.replace(tmp_path, object_path)
+                    self.conn.execute("INSERT INTO objects VALUES (?, ?, ?, ?)",
+                                      (sha256, size, os.path.getsize(object_path), now))
+                self.conn.execute(
+                    "INSERT INTO artifacts (sha256, kind, specimen, name, created) VALUES (?, ?, ?, ?, ?)",
+                    (sha256, kind, specimen, name, now)
+                )
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return True
+
+    def __compress(self, local_path, kind, specimen, name, now):
+        sha256 = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, "tmp"))
+        try:
+            # 読み込みながら圧縮して書き出すため、大きなpcapでもメモリを消費しない
+            with open(local_path, "rb") as src, os.fdopen(fd, "wb") as raw, \
+                    gzip.GzipFile(filename="", mode="wb", compresslevel=self.compresslevel, fileobj=raw,
+                                  mtime=0) as dst:
+                for chunk in iter(lambda: src.read(1024 * 1024), b""):
+                    sha256.update(chunk)
+                    dst.write(chunk)
+                    size += len(chunk)
+            digest = sha256.hexdigest()
+            self.__record(digest, kind, specimen, name, now, tmp_path, size)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return digest
+
+    def open(self, sha256):
+        """オブジェクトを展開しながら読み込むファイルオブジェクトを返す"""
+
+        return gzip.open(self.path(sha256), "rb")
+
+    def extract(self, sha256, local_path):
+        """オブジェクトを展開してlocal_pathに書き出す"""
+
+        with self.open(sha256) as src, open(local_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+
+    def artifacts(self, kind=None, specimen=None):
+        """記録された成果物を保存した順に返す
+
+        Args:
+            kind (str): 成果物の種類で絞り込む
+            specimen (str): 検体のSHA-256で絞り込む
+
+        Returns:
+            list(Artifact): 成果物のリスト
+        """
+
+        conditions, params = [], []
+        for column, value in (("kind", kind), ("specimen", specimen)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT sha256, kind, specimen, name, created FROM artifacts{where} ORDER BY id", params).fetchall()
+        return [Artifact(*row, self.path(row[0])) for row in rows]
+
+    def usage(self):
+        """保存しているオブジェクトの数と、展開後・圧縮後の合計の大きさを返す"""
+
+        with self.lock:
+            objects, size, stored_size = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(stored_size), 0) FROM objects").fetchone()
+        return {"objects": objects, "size": size, "stored_size": stored_size}
+
+    def prune(self):
+        """保存期間と容量の上限を超えた成果物を古いものから削除する
+
+        Returns:
+            int: 削除したオブジェクトの数
+        """
+
+        self.last_pruned = time.monotonic()
+        removed = []
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self.max_age:
+                    self.conn.execute("DELETE FROM artifacts WHERE created < ?", (time.time() - self.max_age,))
+                removed += self.__delete_orphans()
+                if self.max_bytes:
+                    total, = self.conn.execute("SELECT COALESCE(SUM(stored_size), 0) FROM objects").fetchone()
+                    # 最も新しく参照された時刻の古いオブジェクトから、上限を下回るまで削除する
+                    rows = self.conn.execute(
+                        "SELECT o.sha256, o.stored_size, MAX(a.created) AS last_used FROM objects o "
+                        "JOIN artifacts a ON a.sha256 = o.sha256 GROUP BY o.sha256 ORDER BY last_used"
+                    )
+                    expired = []
+                    for sha256, stored_size, _ in rows:
+                        if total <= self.max_bytes:
+                            break
+                        expired.append(sha256)
+                        total -= stored_size
+                    self.conn.executemany("DELETE FROM artifacts WHERE sha256 = ?", [(sha256,) for sha256 in expired])
+                    removed += self.__delete_orphans()
+                # オブジェクトのファイルはトランザクションの内部で削除し、同時に保存されるオブジェクトと競合しないようにする
+                for sha256 in removed:
+                    try:
+                        os.remove(self.path(sha256))
+                    except FileNotFoundError:
+                        pass
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        if removed:
+            logging.info(f"アーティファクトストアから{len(removed)}個のオブジェクトを削除（{self.usage()}）")
+        return len(removed)
+
+    def __delete_orphans(self):
+        orphans = [sha256 for sha256, in self.conn.execute(
+            "SELECT sha256 FROM objects WHERE sha256 NOT IN (SELECT sha256 FROM artifacts)")]
+        self.conn.executemany("DELETE FROM objects WHERE sha256 = ?", [(sha256,) for sha256 in orphans])
+        return orphans
+
+
+if __name__ == "__main__":
+    # python store.py SHA256 で展開した内容を標準出力に書き出し、python store.py で使用量を表示する
+    from settings import ARTIFACT_STORE_DIR
+
+    with ArtifactStore(ARTIFACT_STORE_DIR) as store:
+        if len(sys.argv) == 2:
+            with store.open(sys.argv[1]) as f:
+                shutil.copyfileobj(f, sys.stdout.buffer)
+        else:
+            print(store.usage())
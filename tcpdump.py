@@ -1,22 +1,182 @@
-from subprocess import Popen
-from time import sleep
+import logging
+import os
+import re
+import struct
+import threading
+from subprocess import PIPE, Popen, TimeoutExpired
+from time import monotonic, sleep
+
+from metrics import timed
+
+# pcapのグローバルヘッダと、パケットごとのレコードのヘッダの大きさ（バイト）
+PCAP_HEADER_SIZE = 24
+PCAP_RECORD_HEADER_SIZE = 16
+
+# tcpdumpが終了時に標準エラー出力に表示する統計
+STATS_PATTERN = re.compile(r"(\d+) packets? (captured|received by filter|dropped by kernel)")
+
+
+def control_traffic_filter(ip_addr, port=22):
+    """VMのSSHサーバへの制御用の通信を除外するBPFフィルタを返す
+
+    VMから外部のポート22への通信（SSHのスキャンなど）は除外しない。
+    """
+
+    return f"not (tcp and ((src host {ip_addr} and src port {port}) or (dst host {ip_addr} and dst port {port})))"
 
 
 class Tcpdump:
-    """with文を用いて確実にtcpdumpを開始・終了するためのクラス"""
+    """with文を用いて確実にtcpdumpを開始・終了するためのクラス
+
+    tcpdumpが標準エラー出力に"listening on"と表示した時点でキャプチャ開始とみなし、with文の内部に入る。
+    終了時はSIGTERMを送って終了を待ち、tcpdumpの表示したパケット数の統計をstatsに格納する。
+
+    Attributes:
+        stats (dict): キャプチャしたパケット数("captured")、フィルタが受け取ったパケット数("received by filter")、
+            カーネルが取りこぼしたパケット数("dropped by kernel")
+    """
 
-    def __init__(self, pcap_filepath, interface, pre_execution_time=0, post_execution_time=0):
+    def __init__(self, pcap_filepath, interface, pre_execution_time=0, post_execution_time=0,
+                 snaplen=0, bpf_filter=None, ready_timeout=10, stop_timeout=10):
+        """初期化
+
+        Arguments:
+            pcap_filepath(str): 保存するpcapのパス
+            interface(str): キャプチャするインターフェース名
+            pre_execution_time(float): キャプチャ開始を確認した後、さらに待機する時間（秒）
+            post_execution_time(float): with文を抜けてからキャプチャを終了するまでの時間（秒）
+            snaplen(int): パケットごとに保存する最大バイト数。0の場合はtcpdumpの既定値
+            bpf_filter(str): キャプチャするパケットを絞り込むBPFフィルタ
+            ready_timeout(float): キャプチャ開始を待つ時間の上限（秒）
+            stop_timeout(float): SIGTERMを送ってからtcpdumpの終了を待つ時間の上限（秒）
+        """
         self.pcap_filepath = pcap_filepath
         self.proc = None
         self.interface = interface
         self.pre_execution_time = pre_execution_time
         self.post_execution_time = post_execution_time
+        self.snaplen = snaplen
+        self.bpf_filter = bpf_filter
+        self.ready_timeout = ready_timeout
+        self.stop_timeout = stop_timeout
+        self.ready = threading.Event()
+        self.stderr_lines = []
+        self.stats = {}
 
     def __enter__(self):
-        self.proc = Popen(["tcpdump", "-w", self.pcap_filepath, "-i", self.interface], text=True)
+        # -Uでパケットごとにpcapへ書き出し、強制終了されても末尾が失われないようにする
+        command = ["tcpdump", "-w", self.pcap_filepath, "-i", self.interface, "-s", str(self.snaplen), "-U"]
+        if self.bpf_filter:
+            command.append(self.bpf_filter)
+        self.proc = Popen(command, text=True, stderr=PIPE)
+        self.stderr_reader = threading.Thread(target=self.__read_stderr, daemon=True)
+        self.stderr_reader.start()
+
+        start = monotonic()
+        if not self.ready.wait(self.ready_timeout):
+            if self.proc.poll() is not None:
+                self.stderr_reader.join()
+                raise RuntimeError(f"tcpdumpが異常終了しました: {' '.join(self.stderr_lines)}")
+            logging.warning(f"{self.ready_timeout}秒以内にtcpdumpのキャプチャ開始を確認できませんでした")
+        else:
+            logging.info(f"tcpdumpのキャプチャ開始を確認（{monotonic() - start:.2f}秒）")
         sleep(self.pre_execution_time)
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         sleep(self.post_execution_time)
-        self.proc.terminate()
+        with timed("capture_teardown"):
+            self.proc.terminate()
+            try:
+                self.proc.wait(self.stop_timeout)
+            except TimeoutExpired:
+                logging.warning("tcpdumpが終了しないため強制終了")
+                self.proc.kill()
+                self.proc.wait()
+            self.stderr_reader.join()
+        logging.info(f"パケットキャプチャ終了: {self.stats}")
+
+    def __read_stderr(self):
+        """tcpdumpの標準エラー出力を読み、キャプチャ開始の通知と終了時の統計を拾う"""
+
+        for line in self.proc.stderr:
+            line = line.strip()
+            self.stderr_lines.append(line)
+            if "listening on" in line:
+                self.ready.set()
+            match = STATS_PATTERN.search(line)
+            if match:
+                self.stats[match.group(2)] = int(match.group(1))
+
+
+class TrafficMonitor:
+    """キャプチャ中のpcapに書き出されたパケット数を監視し、通信が途絶えたことを検知する
+
+    tcpdumpには-Uを指定してパケットごとに書き出させるため、pcapのレコード数はキャプチャのBPFフィルタを
+    通過したパケット数と一致する。インターフェースの統計と異なり、除外したSSHの制御用の通信やARPなどで
+    通信が続いているとみなすことがない。前回読んだ位置からレコードのヘッダのみを読み進めるため、
+    pcapが大きくなっても確認にかかる時間は増えない。
+    """
+
+    def __init__(self, pcap_path, interval=1):
+        """初期化
+
+        Arguments:
+            pcap_path(str): 監視するpcapのパス（Tcpdumpが書き込み中のもの）
+            interval(float): パケット数を確認する間隔（秒）
+        """
+        self.pcap_path = pcap_path
+        self.interval = interval
+        self.endian = None
+        self.offset = 0
+        self.packets = 0
+
+    def packet_count(self):
+        """pcapに書き出し済みのパケット数を返す。書き込み途中のレコードは数えない"""
+
+        try:
+            f = open(self.pcap_path, "rb")
+        except FileNotFoundError:
+            return self.packets
+        with f:
+            if self.offset == 0:
+                # グローバルヘッダからエンディアンを判定する（マイクロ秒・ナノ秒のいずれの形式も同じ）
+                header = f.read(PCAP_HEADER_SIZE)
+                if len(header) < PCAP_HEADER_SIZE:
+                    return self.packets
+                self.endian = "<" if header[:4] in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1") else ">"
+                self.offset = PCAP_HEADER_SIZE
+            f.seek(self.offset)
+            while True:
+                record_header = f.read(PCAP_RECORD_HEADER_SIZE)
+                if len(record_header) < PCAP_RECORD_HEADER_SIZE:
+                    break
+                incl_len, = struct.unpack_from(self.endian + "I", record_header, 8)
+                end = self.offset + PCAP_RECORD_HEADER_SIZE + incl_len
+                if os.fstat(f.fileno()).st_size < end:
+                    break
+                self.offset = end
+                self.packets += 1
+                f.seek(end)
+        return self.packets
+
+    def wait_idle(self, grace_time, deadline):
+        """通信がgrace_time秒途絶えるか、deadline（time.monotonicの値）に達するまで待機する
+
+        Returns:
+            bool: 通信が途絶えたことで待機を終えた場合True
+        """
+
+        last_count = self.packet_count()
+        idle_since = monotonic()
+        while True:
+            now = monotonic()
+            if now - idle_since >= grace_time:
+                return True
+            if now >= deadline:
+                return False
+            sleep(min(self.interval, deadline - now))
+            count = self.packet_count()
+            if count != last_count:
+                last_count = count
+                idle_since = monotonic()
@@ -0,0 +1,120 @@
+import hashlib
+import logging
+import os
+import shlex
+from collections import namedtuple
+from time import perf_counter
+
+# 転送したファイルの大きさ（バイト）・SHA-256・所要時間（秒）
+Transferred = namedtuple("Transferred", ["size", "sha256", "elapsed"])
+
+
+class TransferVerificationError(EOFError):
+    """転送したファイルが転送元と一致しない（途中で切れた、もしくは転送中に書き換えられた）
+
+    EOFErrorのサブクラスのため、SSHSessionPoolは再接続して転送をやり直す。
+    """
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def download(sftp, remote_path, local_path, chunk_size=1024 * 1024):
+    """リモートのファイルを先読みしながら受信し、受信と同時にSHA-256を計算する
+
+    読み込み要求をファイルの末尾までまとめて送っておき、応答を待たずに次の要求を送るため、
+    遅延の大きい回線でもSFTPのウィンドウの大きさまで並行して転送できる。
+    受信中はlocal_pathに".part"を付けたファイルに書き込み、大きさを確認してから置き換えるため、
+    途中で切れたファイルがlocal_pathに残ることはない。
+
+    Args:
+        sftp (SFTPClient): SFTPチャネル
+        remote_path (str): 受信するリモートのファイルのパス
+        local_path (str): 保存するローカルのパス
+        chunk_size (int): 1回に読み込んでローカルに書き込む大きさ（バイト）
+
+    Returns:
+        Transferred: 受信した大きさとSHA-256
+
+    Raises:
+        TransferVerificationError: 受信した大きさがリモートのファイルと異なる場合、
+            もしくは受信中にリモートのファイルが更新された場合
+    """
+
+    start = perf_counter()
+    sha256 = hashlib.sha256()
+    partial_path = local_path + ".part"
+    size = 0
+    try:
+        with sftp.open(remote_path, "rb") as remote, open(partial_path, "wb") as local:
+            before = remote.stat()
+            remote.prefetch(before.st_size)
+            for chunk in iter(lambda: remote.read(chunk_size), b""):
+                sha256.update(chunk)
+                local.write(chunk)
+                size += len(chunk)
+            after = remote.stat()
+        if size != after.st_size or (before.st_size, before.st_mtime) != (after.st_size, after.st_mtime):
+            raise TransferVerificationError(
+                f"{remote_path}の受信が不完全です（受信 {size}バイト, 転送元 {before.st_size}→{after.st_size}バイト）")
+    except BaseException:
+        _remove(partial_path)
+        raise
+    os.replace(partial_path, local_path)
+    return Transferred(size, sha256.hexdigest(), perf_counter() - start)
+
+
+def upload(sftp, local_path, remote_path, chunk_size=1024 * 1024):
+    """ローカルのファイルを書き込みの応答を待たずに送信し続け、送信先の大きさを確認する
+
+    Args:
+        sftp (SFTPClient): SFTPチャネル
+        local_path (str): 送信するローカルのファイルのパス
+        remote_path (str): 送信先のパス
+        chunk_size (int): 1回に読み込んで送信する大きさ（バイト）
+
+    Returns:
+        Transferred: 送信した大きさとSHA-256
+
+    Raises:
+        TransferVerificationError: 送信先のファイルの大きさが送信した大きさと異なる場合
+    """
+
+    start = perf_counter()
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(local_path, "rb") as local, sftp.open(remote_path, "wb") as remote:
+        # 書き込みの成否は閉じるときにまとめて確認される
+        remote.set_pipelined(True)
+        for chunk in iter(lambda: local.read(chunk_size), b""):
+            sha256.update(chunk)
+            remote.write(chunk)
+            size += len(chunk)
+    remote_size = sftp.stat(remote_path).st_size
+    if remote_size != size:
+        raise TransferVerificationError(f"{remote_path}への送信が不完全です（送信 {size}バイト, 送信先 {remote_size}バイト）")
+    return Transferred(size, sha256.hexdigest(), perf_counter() - start)
+
+
+def remote_sha256(client, remote_path, timeout=60):
+    """リモートでsha256sumを実行し、ファイルのSHA-256を返す
+
+    Args:
+        client (SSHClient): SSHのクライアント
+        remote_path (str): ハッシュ値を計算するリモートのファイルのパス
+        timeout (float): sha256sumの実行時間の上限（秒）
+
+    Returns:
+        str: SHA-256。リモートでsha256sumを実行できない場合はNone
+    """
+
+    _, stdout, _ = client.exec_command(f"sha256sum -- {shlex.quote(remote_path)}", timeout=timeout)
+    output = stdout.read().decode(errors="replace")
+    if stdout.channel.recv_exit_status() != 0 or not output:
+        logging.warning(f"リモートで{remote_path}のハッシュ値を計算できません: {output.strip()}")
+        return None
+    return output.split()[0].lower()
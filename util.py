@@ -1,9 +1,58 @@
 import logging
+import sqlite3
 import sys
+import threading
 
+from paramiko.ssh_exception import SSHException
 
-def die(msg: str, err: Exception):
-    """任意のエラーメッセージを出力してプログラムを終了する。"""
+from metrics import FAILURES
 
-    logging.error(f"{msg}: {err}", file=sys.stderr)
+
+def die(msg: str, err: Exception = None):
+    """任意のエラーメッセージを出力してプログラムを終了する。errを指定した場合はその内容も出力する。"""
+
+    logging.error(msg if err is None else f"{msg}: {err}")
     sys.exit(1)
+
+
+class SQLiteDatabase:
+    """スレッド間で共有するSQLiteのコネクションを保持する
+
+    WALモードにすることで、書き込み中も他のプロセスが読み込める。
+    複数のプロセスが同じファイルを共有でき、プロセス内ではself.lockを取得してからself.connを用いる。
+    """
+
+    def __init__(self, db_path, timeout=30):
+        """初期化
+
+        Arguments:
+            db_path(str): SQLiteのファイルパス
+            timeout(float): 他のプロセスが書き込み中の場合にロックを待つ時間（秒）
+        """
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def log_collection_error(e: Exception):
+    """挙動収集中に発生した例外を種類ごとに記録する。挙動収集自体は続行する。"""
+
+    if isinstance(e, EOFError):
+        pattern = "pattern1"
+    elif isinstance(e, SSHException):
+        pattern = "pattern2"
+    else:
+        pattern = "pattern3"
+    FAILURES.inc(pattern=pattern)
+    logging.error(f"{pattern}: {e}が発生。挙動収集は続行。")
@@ -1,31 +1,59 @@
+import hashlib
 import logging
 import os
 import sys
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from subprocess import CalledProcessError, run
-from time import sleep
+from time import perf_counter
 
 import libvirt
 
+from metrics import timed
+from settings import IP_ACQUISITION_TIMEOUT, STANDBY_MAX_IDLE, VM_STATE_TIMEOUT
 from util import die
+from vmevents import guest_monitor
+
+
+def stable_mac_address(name):
+    """名前から常に同じMACアドレスを決める。libvirtと同じくQEMUのOUI（52:54:00）を用いる"""
+
+    digest = hashlib.sha256(name.encode()).digest()
+    return "52:54:00:" + ":".join(f"{b:02x}" for b in digest[:3])
+
+
+class VMError(RuntimeError):
+    """VMの用意もしくは破棄に失敗した
+
+    ワーカーのスレッドで送出されても、その検体の失敗として記録されるのみでワーカーは次の検体に移る。
+    """
 
 
 class VM:
     """バーチャルマシンを管理するクラス"""
 
-    def __init__(self, domain_name: str, clone: bool = False, new_domain_name: str = None, snapshot_name: str = "default"):
+    def __init__(self, domain_name: str, clone: bool = False, new_domain_name: str = None, snapshot_name: str = "default",
+                 ephemeral: bool = False, overlay_dir: str = None):
         """初期化
 
         Arguments:
             domain_name(str): 扱う仮想マシンのドメインネーム
             clone(bool): Trueの場合、実行環境はcloneによって用意する。Falseの場合はスナップショット機能で復元する
-            new_domain_name(str): cloneの場合、クローン先の仮想マシンのドメインネーム
+            new_domain_name(str): cloneもしくはephemeralの場合、作成する仮想マシンのドメインネーム
             snapshot_name(str): 作成するスナップショットの名前
+            ephemeral(bool): Trueの場合、クローン元のディスクイメージを元にしたqcow2のオーバーレイを作成し、
+                その上で一時的なドメインを起動する。ディスクイメージ全体をコピーしないため、cloneより高速に用意できる
+            overlay_dir(str): ephemeralの場合、オーバーレイを作成するディレクトリ。Noneの場合はクローン元のイメージと同じディレクトリ
         """
         self.domain_name = domain_name
         self.new_domain_name = new_domain_name
         self.clone = clone
         self.snapshot_name = snapshot_name
+        self.ephemeral = ephemeral
+        self.overlay_dir = overlay_dir
+        self.overlay_path = None
+        self.interfaces = None
 
     def __enter__(self):
         """with文に入るときに実行する。
@@ -35,7 +63,12 @@ class VM:
 
         with self.__connect_qemu_hypervisor() as conn:
 
-            if self.clone:  # クローンによる実行環境の用意
+            if self.ephemeral:  # オーバーレイによる一時的な実行環境の用意
+                self.dom = self.__create_overlay_vm(conn)
+
+            elif self.clone:  # クローンによる実行環境の用意
+                # 前回の失敗で残った同じ名前のクローンがあると、virt-cloneが失敗し続けるため先に削除する
+                self.__remove_leftover_clone(conn)
                 try:
                     self.__clone_vm(self.domain_name, self.new_domain_name)
                 except KeyboardInterrupt:
@@ -46,7 +79,13 @@ class VM:
                     sys.exit(1)
                 else:
                     self.dom = conn.lookupByName(self.new_domain_name)
-                    self.__start_vm()
+                    try:
+                        self.__start_vm()
+                    except VMError:
+                        # with文の内部に入らないため__exit__は呼ばれない。ここでクローンを削除する
+                        self.__delete_imagefile()
+                        self.__undefine()
+                        raise
 
             else:  # スナップショットによる実行環境の用意
                 self.dom = conn.lookupByName(self.domain_name)
@@ -59,13 +98,26 @@ class VM:
     def __exit__(self, *args, **kwargs):
         """いかなる原因でも（エラー含めて）with文を抜けるときに確実に実行する"""
 
-        if self.clone:
-            self.__destroy_vm()
-            self.__delete_imagefile()
-            self.__undefine()
+        if self.ephemeral:
+            # 一時的なドメインは強制終了すると定義ごと消える
+            try:
+                self.__destroy_vm()
+            finally:
+                self.__delete_overlay()
+        elif self.clone:
+            try:
+                self.__destroy_vm()
+            finally:
+                self.__delete_imagefile()
+                self.__undefine()
         else:
             self.__revert_to_snapshot()
 
+    def reset(self):
+        """with文の内部で、スナップショットの状態に復元し直す"""
+
+        self.__revert_to_snapshot()
+
     @classmethod
     def start_if_shutoff(cls, domain_name):
         """特定のドメイン名のVMが起動していない場合起動する。
@@ -74,9 +126,18 @@ class VM:
         https://libvirt.org/html/libvirt-libvirt-domain.html#virDomainState
         """
 
+        # 状態を確認する前に監視を始め、確認した直後の停止も取りこぼさないようにする
+        monitor = guest_monitor()
         with libvirt.open("qemu:///system") as conn:
             domain = conn.lookupByName(domain_name)
             state = domain.info()[0]
+            if state == 4:
+                # 終了処理中の場合は停止のイベントを待ち、時間内に停止しなければ強制終了する
+                logging.info(f"{domain_name}の停止を待機中")
+                if not monitor.wait_for_stop(domain, VM_STATE_TIMEOUT) and domain.info()[0] != 5:
+                    logging.warning(f"{domain_name}が{VM_STATE_TIMEOUT}秒以内に停止しないため強制終了")
+                    domain.destroy()
+                state = 5
             if state == 1:
                 pass
             elif state == 5:
@@ -93,7 +154,7 @@ class VM:
         try:
             conn = libvirt.open("qemu:///system")
         except libvirt.libvirtError as e:
-            die("ハイパーバイザに接続できませんでした", e)
+            raise VMError(f"ハイパーバイザに接続できませんでした: {e}") from e
 
         return conn
 
@@ -123,7 +184,12 @@ class VM:
 
         復元後のVMの状態は実行中であるよう指定している。
         """
-        self.dom.revertToSnapshot(self.snapshot, flags=libvirt.VIR_DOMAIN_SNAPSHOT_REVERT_RUNNING)
+        self.interfaces = None
+        # 復元前の停止のイベントを、復元後のゲストの停止と取り違えないようにする。
+        # dnsmasqは復元前のリースを保持し続けるため、ゲストがそのIPアドレスで応答するまでそれも用いない
+        guest_monitor().forget(self.dom, self.__mac_address())
+        with timed("snapshot_revert"):
+            self.dom.revertToSnapshot(self.snapshot, flags=libvirt.VIR_DOMAIN_SNAPSHOT_REVERT_RUNNING)
         logging.info(f"スナップショット'{self.snapshot_name}'の状態に復元")
 
     def __clone_vm(self, old_domain_name, new_domain_name):
@@ -140,18 +206,90 @@ class VM:
             logging.info(f"{old_domain_name}のクローン開始")
             run(["virt-clone", "-o", old_domain_name, "-n", new_domain_name, "--auto-clone", "-q"], check=True, text=False)
         except CalledProcessError as e:
-            die("VMのクローンに失敗しました。", e)
+            raise VMError(f"VMのクローンに失敗しました。: {e}") from e
 
         logging.info("クローンが正常に終了しました")
         return
 
+    def __remove_leftover_clone(self, conn):
+        """new_domain_nameのドメインが残っていれば、強制終了してディスクイメージごと削除する"""
+
+        try:
+            self.dom = conn.lookupByName(self.new_domain_name)
+        except libvirt.libvirtError:
+            return
+        logging.warning(f"前回のクローン{self.new_domain_name}が残っているため削除します")
+        if self.dom.info()[0] == 1:
+            self.__destroy_vm()
+        self.__delete_imagefile()
+        self.__undefine()
+
+    def __create_overlay_vm(self, conn):
+        """クローン元のディスクイメージをバッキングファイルとするオーバーレイを作成し、その上で一時的なドメインを起動する
+
+        クローン元のディスクイメージには書き込まないため、クローン元のVMは停止している必要がある。
+
+        Returns:
+            dom (virDomain): 起動した一時的なドメイン
+        """
+
+        base = conn.lookupByName(self.domain_name)
+        root = ET.fromstring(base.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+
+        # 名前とUUIDはクローン元と重複しないようlibvirtに割り当てさせる。
+        # MACアドレスは作成するたびに変わるとDHCPのリースが溜まっていくため、ドメインネームから決める
+        root.find("name").text = self.new_domain_name
+        uuid = root.find("uuid")
+        if uuid is not None:
+            root.remove(uuid)
+        for index, interface in enumerate(root.findall("devices/interface")):
+            mac = interface.find("mac")
+            if mac is None:
+                mac = ET.SubElement(interface, "mac")
+            mac.set("address", stable_mac_address(f"{self.new_domain_name}/{index}"))
+
+        disk = root.find("devices/disk[@device='disk']")
+        source = disk.find("source")
+        driver = disk.find("driver")
+        backing_path = source.get("file")
+        backing_format = driver.get("type", "qcow2")
+        overlay_dir = self.overlay_dir or os.path.dirname(backing_path)
+        self.overlay_path = os.path.join(overlay_dir, f"{self.new_domain_name}.qcow2")
+
+        try:
+            logging.info(f"{backing_path}のオーバーレイを作成")
+            run(["qemu-img", "create", "-q", "-f", "qcow2", "-F", backing_format, "-b", backing_path, self.overlay_path],
+                check=True, text=False)
+        except CalledProcessError as e:
+            raise VMError(f"オーバーレイの作成に失敗しました。: {e}") from e
+        source.set("file", self.overlay_path)
+        driver.set("type", "qcow2")
+
+        try:
+            dom = conn.createXML(ET.tostring(root, encoding="unicode"), 0)
+        except libvirt.libvirtError as e:
+            self.__delete_overlay()
+            raise VMError(f"{self.new_domain_name}を起動できません。: {e}") from e
+        logging.info(f"一時的なドメイン{self.new_domain_name}を起動")
+        return dom
+
+    def __delete_overlay(self):
+        """オーバーレイのディスクイメージを削除する"""
+
+        try:
+            os.remove(self.overlay_path)
+        except OSError as e:
+            logging.warning(f"オーバーレイ{self.overlay_path}の削除に失敗しました。: {e}")
+        else:
+            logging.info(f"オーバーレイ{self.overlay_path}を削除しました。")
+
     def __start_vm(self):
         """vmを起動する。"""
 
         try:
             self.dom.create()
         except libvirt.libvirtError as e:
-            die(f"{self.dom.name()}を起動できません。", e)
+            raise VMError(f"{self.dom.name()}を起動できません。: {e}") from e
 
     def __destroy_vm(self):
         """VMを強制終了する。"""
@@ -160,39 +298,60 @@ class VM:
         try:
             result = self.dom.destroy()
         except libvirt.libvirtError as e:
-            die(f"{self.dom.name()}の強制終了に失敗しました.", e)
+            raise VMError(f"{self.dom.name()}の強制終了に失敗しました。: {e}") from e
 
         # 強制終了操作はできるが失敗したときは通知のみ
         if result < 0:
-            logging.warning(f"{self.dom.name()}の強制終了に失敗しました。", file=sys.stderr)
+            logging.warning(f"{self.dom.name()}の強制終了に失敗しました。")
         else:
             logging.info(f"{self.dom.name()}を強制終了")
 
     def get_interfaces(self):
         """インターフェースにまつわる情報を返す
 
+        一度取得した情報はスナップショットを復元するまで使い回す。
+
         Returns:
             ip : ip address
             mac: mac address
             interface_name: 仮想ブリッジのVMに繋げたネットワークインターフェース名
         """
 
-        iface_info = None
+        if self.interfaces is not None:
+            return self.interfaces
+
+        interface = ET.fromstring(self.dom.XMLDesc(0)).find("devices/interface")
+        mac = interface.find("mac").get("address")
+        interface_name = interface.find("target").get("dev")
+
         logging.info("IPアドレスを取得中")
-        # vmが起動してからipアドレスが割り振られるまでの時間を待機
-        while not iface_info:
-            iface_info = self.dom.interfaceAddresses(libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE, 0)
-            # １つ目の謎の引数についてはここに詳細あり
-            # https://libvirt.org/html/libvirt-libvirt-domain.html#virDomainInterfaceAddressesSource
-            sleep(1)
+        # vmが起動してからipアドレスが割り振られるまで待機する。
+        # リースファイルの更新かドメインのイベントで直ちに起き、IP_ACQUISITION_TIMEOUT秒を超えた場合は例外を送出する
+        with timed("ip_acquisition"):
+            ip = guest_monitor().wait_for_address(self.dom, mac, self.__query_address, IP_ACQUISITION_TIMEOUT)
 
-        interface_name = list(iface_info.keys())[0]
-        addr_info = iface_info[interface_name]
+        self.interfaces = ip, mac, interface_name
+        return self.interfaces
 
-        ip = addr_info['addrs'][0]['addr']
-        mac = addr_info['hwaddr']
+    def __mac_address(self):
+        """ゲストのネットワークインターフェースのMACアドレスを返す"""
 
-        return ip, mac, interface_name
+        return ET.fromstring(self.dom.XMLDesc(0)).find("devices/interface/mac").get("address")
+
+    def __query_address(self):
+        """libvirtにゲストのIPアドレスを問い合わせる。割り当てられていない場合はNone"""
+
+        try:
+            iface_info = self.dom.interfaceAddresses(libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE, 0)
+            # １つ目の謎の引数についてはここに詳細あり
+            # https://libvirt.org/html/libvirt-libvirt-domain.html#virDomainInterfaceAddressesSource
+        except libvirt.libvirtError as e:
+            logging.debug(f"IPアドレスを問い合わせられませんでした: {e}")
+            return None
+        for addr_info in iface_info.values():
+            if addr_info["addrs"]:
+                return addr_info["addrs"][0]["addr"]
+        return None
 
     def __delete_imagefile(self):
         """ディスクイメージファイルを削除する"""
@@ -202,7 +361,7 @@ class VM:
         try:
             os.remove(imagefile_path)
         except TypeError:
-            logging.warning(f"{self.dom.name()}のディスクイメージの削除に失敗しました。", file=sys.stderr)
+            logging.warning(f"{self.dom.name()}のディスクイメージの削除に失敗しました。")
         else:
             logging.info(f"{self.dom.name()}のディスクイメージを削除しました。")
 
@@ -210,6 +369,84 @@ class VM:
         """VMを削除する"""
 
         if self.dom.undefine() < 0:
-            logging.info(f"{self.dom.name()}の削除に失敗しました。", file=sys.stderr)
+            logging.info(f"{self.dom.name()}の削除に失敗しました。")
         else:
             logging.info(f"{self.dom.name()}を削除しました。")
+
+
+class StandbyVM:
+    """スナップショットの復元とIPアドレスの取得を裏で済ませ、すぐに検体を実行できる状態のVMを用意しておく
+
+    VMをwith文で使うと入るときと出るときの2回スナップショットを復元するが、StandbyVMでは使用後の1回のみ復元し、
+    その復元とIPアドレスの取得を次の検体の受信・判定や他のVMでの実行と並行して行う。
+    ただし準備を終えてからmax_idle秒を超えて使われなかった場合は、取り出す際に復元し直す。
+    """
+
+    def __init__(self, domain_name: str, snapshot_name: str = "default", max_idle: float = STANDBY_MAX_IDLE):
+        """初期化。直ちに裏でVMの準備を開始する
+
+        Arguments:
+            domain_name(str): 扱う仮想マシンのドメインネーム
+            snapshot_name(str): 復元するスナップショットの名前
+            max_idle(float): 準備済みのVMをそのまま使う最長の待機時間（秒）。0の場合は復元し直さない
+        """
+        self.vm = VM(domain_name, snapshot_name=snapshot_name)
+        self.max_idle = max_idle
+        self.entered = False
+        self.prepared_at = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{domain_name}-standby")
+        self.ready = self.executor.submit(self.__prepare)
+
+    def __prepare(self):
+        """スナップショットを復元してIPアドレスを取得し、各段階の所要時間を返す"""
+
+        start = perf_counter()
+        if self.entered:
+            self.vm.reset()
+        else:
+            self.vm.__enter__()
+            self.entered = True
+        reverted = perf_counter()
+        self.vm.get_interfaces()
+        self.prepared_at = perf_counter()
+        return {"revert": reverted - start, "ip": self.prepared_at - reverted}
+
+    @contextmanager
+    def acquire(self):
+        """準備済みのVMを取り出す。with文を抜けると裏で次の準備を開始する
+
+        Yields:
+            VM: IPアドレス取得済みのVM
+        """
+
+        start = perf_counter()
+        try:
+            timings = self.ready.result()
+            idle = perf_counter() - self.prepared_at
+            if self.max_idle and idle > self.max_idle:
+                # 待機中にゲストの状態が変わっている可能性があるため、復元した直後の状態に戻す
+                logging.info(f"{self.vm.domain_name}が準備後{idle:.0f}秒使われなかったため、スナップショットを復元し直す")
+                self.ready = self.executor.submit(self.__prepare)
+                timings = self.ready.result()
+        except Exception:
+            # 準備に失敗した場合は次回に向けて準備し直す
+            self.ready = self.executor.submit(self.__prepare)
+            raise
+        waited = perf_counter() - start
+        hidden = max(timings["revert"] + timings["ip"] - waited, 0)
+        logging.info(
+            f"{self.vm.domain_name}の準備待ち: {waited:.1f}秒"
+            f"（復元 {timings['revert']:.1f}秒, IPアドレス取得 {timings['ip']:.1f}秒のうち{hidden:.1f}秒を隠蔽）"
+        )
+
+        try:
+            yield self.vm
+        finally:
+            self.ready = self.executor.submit(self.__prepare)
+
+    def close(self):
+        """準備中の処理の完了を待って、VMをスナップショットの状態に戻す"""
+
+        self.executor.shutdown(wait=True)
+        if self.entered:
+            self.vm.__exit__()
@@ -0,0 +1,248 @@
+import json
+import logging
+import os
+import socket
+import threading
+from time import monotonic, sleep, time
+
+import libvirt
+
+from settings import DHCP_LEASE_FILE, STALE_LEASE_GRACE, STALE_LEASE_PROBE_PORT
+
+# リースファイルの更新を確認する間隔（秒）
+LEASE_POLL_INTERVAL = 0.1
+# リースファイルを監視できない場合に、IPアドレスを問い合わせ直す間隔（秒）
+QUERY_INTERVAL = 1
+# 復元前のリースのIPアドレスにゲストが応答するか確かめる間隔と、1回の接続を待つ時間（秒）
+PROBE_INTERVAL = 1
+PROBE_TIMEOUT = 1
+
+# 停止したとみなすドメインのライフサイクルイベント
+STOPPED = "stopped"
+
+
+class GuestUnavailableError(TimeoutError):
+    """ゲストが時間内に応答可能にならなかった、もしくは待機中に停止した
+
+    TimeoutErrorのサブクラスのため、SSHの一時的なエラーと同様に再試行の対象となる。
+    """
+
+
+def probe_guest(ip_addr, port, timeout):
+    """ゲストがip_addrのportでTCPの接続を受け付けるか否かを返す"""
+
+    try:
+        with socket.create_connection((ip_addr, port), timeout):
+            return True
+    except OSError:
+        return False
+
+
+class GuestMonitor:
+    """libvirtのイベントと、DHCPのリースファイルの更新を裏で受け取り、待機中のスレッドを直ちに起こす
+
+    ドメインのライフサイクルとゲストエージェントの接続・切断はlibvirtのイベントループで受け取る。
+    libvirtにはDHCPのリースの変化を通知するイベントがないため、libvirtのdnsmasqが更新する
+    リースファイルの更新時刻を監視し、MACアドレスからIPアドレスを引くキャッシュを作り直す。
+
+    クローンやオーバーレイのドメインは同じ名前で作り直すため、ドメインの状態はUUIDごとに記録する。
+
+    dnsmasqはスナップショットを復元してもリースを保持し続けるため、復元前のリースはゲストの準備ができたことを
+    意味しない。forgetでMACアドレスを指定すると、そのリースが更新されるか、ゲストエージェントが接続するか、
+    ゲストがそのIPアドレスで接続を受け付けるまで、リースとlibvirtへの問い合わせ（同じリースを返す）を用いずに待つ。
+    復元したゲストはリースを更新しないことが多いため、いずれも起きなくてもstale_grace秒後には復元前のリースを用いる。
+    """
+
+    def __init__(self, uri="qemu:///system", lease_path=DHCP_LEASE_FILE, probe_port=STALE_LEASE_PROBE_PORT,
+                 stale_grace=STALE_LEASE_GRACE):
+        """初期化。直ちにイベントループとリースファイルの監視を開始する
+
+        Arguments:
+            uri(str): イベントを受け取るハイパーバイザのURI
+            lease_path(str): libvirtのdnsmasqが書き出すリースファイル（JSON）のパス
+            probe_port(int): 復元前のリースのIPアドレスでゲストの応答を確かめるTCPのポート
+            stale_grace(float): 復元前のリースを用いずに待つ時間の上限（秒）
+        """
+        self.lease_path = lease_path
+        self.probe_port = probe_port
+        self.stale_grace = stale_grace
+        self.condition = threading.Condition()
+        # MACアドレスをキー、(IPアドレス, リースの期限)を値とする
+        self.leases = {}
+        # 復元前のリースを用いないMACアドレスをキー、(ドメインのUUID, 復元前のリース, 忘れた時刻)を値とする
+        self.stale = {}
+        # ドメインのUUIDごとの直近のライフサイクルイベント
+        self.states = {}
+        # イベントを受け取るたびに増やし、確認してから待機するまでの間のイベントを取りこぼさないようにする
+        self.generation = 0
+
+        # イベントループの実装はイベントを受け取るコネクションを開く前に登録する必要がある
+        libvirt.virEventRegisterDefaultImpl()
+        threading.Thread(target=self.__run_event_loop, name="libvirt-events", daemon=True).start()
+        self.conn = libvirt.open(uri)
+        self.conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self.__on_lifecycle, None)
+        self.conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_AGENT_LIFECYCLE, self.__on_agent, None)
+
+        self.watching_leases = os.path.exists(lease_path)
+        if self.watching_leases:
+            threading.Thread(target=self.__watch_leases, name="dhcp-leases", daemon=True).start()
+        else:
+            logging.warning(f"リースファイル{lease_path}が存在しないため、IPアドレスは{QUERY_INTERVAL}秒ごとに問い合わせます")
+
+    @staticmethod
+    def __run_event_loop():
+        while True:
+            libvirt.virEventRunDefaultImpl()
+
+    def __notify(self):
+        self.generation += 1
+        self.condition.notify_all()
+
+    def __on_lifecycle(self, conn, dom, event, detail, opaque):
+        # スナップショットの復元に伴う停止は、直後に起動のイベントが続くため無視する
+        if event == libvirt.VIR_DOMAIN_EVENT_STOPPED and detail == libvirt.VIR_DOMAIN_EVENT_STOPPED_FROM_SNAPSHOT:
+            return
+        stopped = event in (libvirt.VIR_DOMAIN_EVENT_STOPPED, libvirt.VIR_DOMAIN_EVENT_CRASHED,
+                            libvirt.VIR_DOMAIN_EVENT_UNDEFINED)
+        with self.condition:
+            self.states[dom.UUIDString()] = STOPPED if stopped else event
+            self.__notify()
+
+    def __on_agent(self, conn, dom, state, reason, opaque):
+        # ゲストエージェントの接続はゲストのOSが起動した合図となるため、待機中のスレッドに問い合わせ直させる
+        with self.condition:
+            if state == libvirt.VIR_CONNECT_DOMAIN_EVENT_AGENT_LIFECYCLE_STATE_CONNECTED:
+                uuid = dom.UUIDString()
+                self.stale = {mac: stale for mac, stale in self.stale.items() if stale[0] != uuid}
+            self.__notify()
+
+    def __watch_leases(self):
+        last_modified = None
+        while True:
+            try:
+                modified = os.stat(self.lease_path).st_mtime_ns
+                if modified != last_modified:
+                    last_modified = modified
+                    self.__load_leases()
+            except (OSError, ValueError) as e:
+                # dnsmasqが書き換えている途中のファイルを読んだ場合は、次の確認で読み直す
+                last_modified = None
+                logging.debug(f"リースファイルを読み込めませんでした: {e}")
+            sleep(LEASE_POLL_INTERVAL)
+
+    def __load_leases(self):
+        with open(self.lease_path) as f:
+            content = f.read()
+        entries = json.loads(content) if content.strip() else []
+        now = time()
+        # 期限切れのリースは、別のMACアドレスに同じIPアドレスが割り当てられている可能性があるため使わない
+        leases = {entry["mac-address"].lower(): (entry["ip-address"], entry.get("expiry-time")) for entry in entries
+                  if not entry.get("expiry-time") or entry["expiry-time"] > now}
+        with self.condition:
+            self.leases = leases
+            self.__notify()
+
+    def forget(self, dom, mac=None):
+        """スナップショットの復元や起動の前に、そのドメインの直近の状態を忘れる
+
+        macを指定した場合は、そのMACアドレスの現在のリースも復元前のものとして用いない。
+        リースファイルを監視できない場合は更新を検知できないため、リースは忘れない。
+        """
+
+        if mac is not None and self.watching_leases:
+            # 監視スレッドがまだ読み込んでいない更新を、復元後の更新と取り違えないよう読み込み直しておく
+            try:
+                self.__load_leases()
+            except (OSError, ValueError) as e:
+                logging.debug(f"リースファイルを読み込めませんでした: {e}")
+        with self.condition:
+            uuid = dom.UUIDString()
+            self.states.pop(uuid, None)
+            if mac is not None and self.watching_leases:
+                mac = mac.lower()
+                self.stale[mac] = (uuid, self.leases.get(mac), monotonic())
+
+    def wait_for_address(self, dom, mac, query=None, timeout=120):
+        """ゲストにIPアドレスが割り当てられるまで待つ
+
+        リースファイルの更新やドメインのイベントがあった時点で起き、キャッシュとqueryを確認する。
+        ゲストエージェントの接続もイベントとして受け取るため、ゲストの起動直後にqueryを確認し直す。
+        forgetで忘れたリースは、更新されるか、ゲストエージェントが接続するか、ゲストがそのIPアドレスで
+        接続を受け付けるか、stale_grace秒が過ぎるまで用いない。
+
+        Args:
+            dom (virDomain): 待機するドメイン
+            mac (str): ゲストのネットワークインターフェースのMACアドレス
+            query (callable): IPアドレスを問い合わせる関数。見つからない場合はNoneを返す
+            timeout (float): 待機する時間の上限（秒）
+
+        Returns:
+            str: IPアドレス
+
+        Raises:
+            GuestUnavailableError: 時間内にIPアドレスが得られない場合、もしくは待機中にドメインが停止した場合
+        """
+
+        deadline = monotonic() + timeout
+        mac = mac.lower()
+        uuid = dom.UUIDString()
+        while True:
+            with self.condition:
+                generation = self.generation
+                lease = self.leases.get(mac)
+                stale = self.stale.get(mac)
+                if stale is not None and lease is not None and (
+                        lease != stale[1] or monotonic() - stale[2] >= self.stale_grace):
+                    # 復元後にゲストがDHCPでリースを更新したか、更新を待つ時間の上限に達した
+                    del self.stale[mac]
+                    stale = None
+                ip_addr = lease[0] if lease is not None and stale is None else None
+                stopped = self.states.get(uuid) == STOPPED
+            # libvirtへの問い合わせ中にイベントの受け取りを止めないよう、ロックの外で問い合わせる
+            if stale is not None and lease is not None and \
+                    probe_guest(lease[0], self.probe_port, min(PROBE_TIMEOUT, max(deadline - monotonic(), 0))):
+                # 復元したゲストが復元前のリースのIPアドレスで応答した
+                with self.condition:
+                    self.stale.pop(mac, None)
+                return lease[0]
+            if ip_addr is None and query is not None and stale is None:
+                ip_addr = query()
+            if ip_addr is not None:
+                return ip_addr
+            if stopped:
+                raise GuestUnavailableError(f"{dom.name()}がIPアドレスの取得中に停止しました")
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                raise GuestUnavailableError(f"{dom.name()}に{timeout}秒以内にIPアドレスが割り当てられませんでした")
+            if not self.watching_leases:
+                remaining = min(remaining, QUERY_INTERVAL)
+            if stale is not None:
+                # 応答の確認と、待つ時間の上限に達したかの確認のため定期的に起きる
+                remaining = min(remaining, PROBE_INTERVAL)
+            with self.condition:
+                self.condition.wait_for(lambda: self.generation != generation, remaining)
+
+    def wait_for_stop(self, dom, timeout=60):
+        """ドメインが停止するまで待つ
+
+        Returns:
+            bool: 時間内に停止した場合はTrue
+        """
+
+        uuid = dom.UUIDString()
+        with self.condition:
+            return self.condition.wait_for(lambda: self.states.get(uuid) == STOPPED, timeout)
+
+
+_monitor = None
+_monitor_lock = threading.Lock()
+
+
+def guest_monitor():
+    """プロセスで共有するGuestMonitorを返す。初回の呼び出しで監視を開始する"""
+
+    global _monitor
+    with _monitor_lock:
+        if _monitor is None:
+            _monitor = GuestMonitor()
+        return _monitor
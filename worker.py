@@ -0,0 +1,107 @@
+import logging
+import threading
+
+from scheduler import Scheduler
+from settings import OVERLAY_DIR, USE_OVERLAY_VM
+from util import log_collection_error
+from vm import VM
+
+
+def clone_vm(domain_name, worker_id, ephemeral=USE_OVERLAY_VM):
+    """ワーカーが専有するクローンVMを用意する
+
+    クローンVMは実行ごとに破棄されるため、検体間で環境が汚染されることはない。
+    ephemeralがTrueの場合はvirt-cloneの代わりにqcow2のオーバーレイで用意する（既定はUSE_OVERLAY_VM）。
+    """
+
+    return VM(domain_name, clone=not ephemeral, new_domain_name=f"{domain_name}-worker{worker_id}",
+              ephemeral=ephemeral, overlay_dir=OVERLAY_DIR)
+
+
+class Worker(threading.Thread):
+    """VMを1台専有し、スケジューラから渡された検体を順番に実行するワーカー
+
+    Attributes:
+        domain_name (str): 検体を実行するVM（クローンの場合はクローン元）のドメインネーム
+        worker_id (int): 同じドメインのワーカーの中での番号
+        scheduler (Scheduler): 実行する検体の引数を受け取るスケジューラ
+        analyze (callable): analyze(vm, *task)の形で呼び出す、VM内で検体を実行する関数
+        open_vm (callable): open_vm(domain_name, worker_id)の形で呼び出し、with文で扱えるVMを返す関数
+    """
+
+    def __init__(self, domain_name, worker_id, scheduler, analyze, open_vm=clone_vm):
+        super().__init__(name=f"{domain_name}-worker{worker_id}", daemon=True)
+        self.domain_name = domain_name
+        self.worker_id = worker_id
+        self.scheduler = scheduler
+        self.analyze = analyze
+        self.open_vm = open_vm
+
+    def run(self):
+        while True:
+            task = self.scheduler.get(self.domain_name)
+            if task is None:
+                return
+            try:
+                logging.info(f"{self.name}で実行開始")
+                with self.open_vm(self.domain_name, self.worker_id) as vm:
+                    self.analyze(vm, *task)
+            except Exception as e:
+                log_collection_error(e)
+
+
+class WorkerPool:
+    """OSごとに複数のワーカーを起動し、検体を並列に実行する
+
+    実行待ちの検体はSchedulerがOSごとに保持し、空いたワーカーが優先度の高いものから取り出す。
+    virt-cloneやオーバーレイの仕様上、クローン元のVMは停止（もしくは一時停止）している必要がある。
+    """
+
+    def __init__(self, worker_nums: dict, analyze, open_vm=clone_vm, scheduler=None):
+        """初期化
+
+        Arguments:
+            worker_nums(dict): ドメインネームをキー、ワーカー数を値とする辞書
+            analyze(callable): analyze(vm, *task)の形で呼び出す、VM内で検体を実行する関数
+            open_vm(callable): open_vm(domain_name, worker_id)の形で呼び出し、with文で扱えるVMを返す関数。
+                省略した場合はワーカーごとにクローンVMを用意する
+            scheduler(Scheduler): 実行待ちの検体を保持するスケジューラ。省略した場合は新たに作成する
+        """
+
+        domain_names = [domain_name for domain_name, num in worker_nums.items() if num > 0]
+        self.scheduler = scheduler or Scheduler(domain_names)
+        self.workers = [
+            Worker(domain_name, worker_id, self.scheduler, analyze, open_vm)
+            for domain_name, num in worker_nums.items()
+            for worker_id in range(num)
+        ]
+
+    def start(self):
+        """すべてのワーカーを起動する"""
+
+        for worker in self.workers:
+            worker.start()
+        logging.info(f"{len(self.workers)}個のワーカーを起動")
+
+    def submit(self, domain_name, *task, family=None, resubmission=False, near_duplicate=False):
+        """検体をスケジューラに渡す。そのドメインの実行待ちの検体が上限に達している場合は空きができるまで待機する
+
+        Args:
+            domain_name (str): 検体を実行するVMのドメインネーム
+            task: ワーカーのanalyzeに渡す引数
+            family (str): 検体のファミリ。初めて見るファミリの検体を優先する
+            resubmission (bool): 同じファイル名で再投下された検体か否か
+            near_duplicate (bool): 実行済みの検体に類似する検体か否か
+
+        Returns:
+            bool: スケジューラに渡した場合はTrue、そのドメインのワーカーが存在しない場合はFalse
+        """
+
+        return self.scheduler.put(domain_name, task, family, resubmission, near_duplicate)
+
+    def shutdown(self):
+        """実行待ちの検体をすべて処理した後、ワーカーを終了する"""
+
+        self.scheduler.close()
+        for worker in self.workers:
+            worker.join()